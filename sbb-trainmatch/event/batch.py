@@ -1,5 +1,6 @@
 # std python imports
 import logging
+import time
 
 # sci imports
 import pandas as pd
@@ -12,88 +13,257 @@ from getstops import getstops
 from traineval.calc_distances import calc_distances
 from traineval.fpga import fpga
 from traineval.eval_itin_quality import get_best_itinerary
-from traineval.output_to_postgres import save_output, save_failed_trips
-from metrics.metrics import write_metrics
+from traineval.output_to_postgres import save_output, save_failed_trips, save_incomplete_trips
+from metrics.metrics import write_batch_metrics, log_point_stats, observe_stage
 from sbbrequest.trip import Trip
 import sbbrequest.init_data_struct as ids
 
 
 
 class Batch(object):
-    def __init__(self, batch_id, list_mod_id, loc_bounds, CONFIG, DB):
+    LIVE = 'live'
+    BACKFILL = 'backfill'
+
+    def __init__(self, batch_id, list_mod_id, loc_bounds, CONFIG, DB, traffic_class=LIVE):
         self.batch_id = batch_id
         self.list_mot_id = list_mod_id
         self.loc_bounds = loc_bounds
         self.CONFIG = CONFIG
         self.DB = DB
+        # live or backfill, the SPF responses of each class are consumed from their own queue when lanes are enabled
+        self.traffic_class = traffic_class
+        self.created = time.time()
 
         logging.info('Processing batch ID: {b}, including MoT segments: {s}'.format(b=self.batch_id, s=self.list_mot_id))
 
         # Just timing execution time for logs
         self.time_log = TimeLogger()
+        self.stage_start = time.time()
 
         # Get the start/end stops associated with each MoT segment (aka trip)
         self.trips = getstops.get_stops(self.list_mot_id, self.DB, self.CONFIG)
-        self.time_log.log_runtime(msg='Get Stops. ({n} found for {bid})'.format(bid=self.batch_id, n=self.trips.shape[0]))
+        self.log_stage('get_stops', 'Get Stops. ({n} found for {bid})'.format(bid=self.batch_id, n=self.trips.shape[0]))
         self.trip_objs = dict()
         self.trips_processed = 0
+        # unix time after which the batch is scored with whatever trips are complete (see finalize_incomplete)
+        self.deadline = None
+
+        # Accumulated over the scored trips for the batch metrics
+        self.scored_trip_ids = []
+        self.stats = None
+        self.n_mot_with_itin = 0
+
+    def to_state(self):
+        """
+        State needed to resume the batch in another process (see state_codec). CONFIG, DB and the time logger are
+        rebuilt by from_state() rather than stored.
+        """
+        return {'batch_id': self.batch_id,
+                'list_mot_id': list(self.list_mot_id),
+                'loc_bounds': self.loc_bounds,
+                'trips': self.trips,
+                'trips_processed': self.trips_processed,
+                'deadline': self.deadline,
+                'traffic_class': self.traffic_class,
+                'created': self.created,
+                'scored_trip_ids': self.scored_trip_ids,
+                'stats': self.stats,
+                'n_mot_with_itin': self.n_mot_with_itin,
+                'trip_objs': [t.to_state() for t in self.trip_objs.itervalues()]}
+
+    @classmethod
+    def from_state(cls, state, CONFIG, DB):
+        # Bypass __init__, which would query the stops again
+        b = cls.__new__(cls)
+        b.batch_id = state['batch_id']
+        b.list_mot_id = state['list_mot_id']
+        b.loc_bounds = state['loc_bounds']
+        b.CONFIG = CONFIG
+        b.DB = DB
+        b.time_log = TimeLogger()
+        b.stage_start = time.time()
+        b.trips = state['trips']
+        b.trips_processed = state['trips_processed']
+        b.deadline = state.get('deadline')
+        b.traffic_class = state.get('traffic_class', cls.LIVE)
+        b.created = state.get('created', time.time())
+        b.scored_trip_ids = state.get('scored_trip_ids', [])
+        b.stats = state.get('stats')
+        b.n_mot_with_itin = state.get('n_mot_with_itin', 0)
+        b.trip_objs = dict()
+        for trip_state in state['trip_objs']:
+            t = Trip.from_state(trip_state, CONFIG)
+            b.trip_objs[t.trip_id] = t
+        return b
+
+    @classmethod
+    def from_legacy(cls, b, CONFIG, DB):
+        """
+        Converts a Batch unpickled from redis, written before the state format, including the itineraries of its trips
+        """
+        state = dict(vars(b))
+        state['trip_objs'] = []
+        legacy = cls.from_state(state, CONFIG, DB)
+        for t in b.trip_objs.itervalues():
+            t = Trip.from_legacy(t, CONFIG)
+            legacy.trip_objs[t.trip_id] = t
+        return legacy
 
     def init_trips(self):
         for _, trip in self.trips.iterrows():
             t = Trip(trip, self.batch_id, self.CONFIG)
             self.trip_objs[t.trip_id] = t
 
-    def send_trip_requests(self):
+    def send_trip_requests(self, routing_key='', priority=None):
         for t in self.trip_objs.itervalues():
+            t.routing_key = routing_key
+            t.priority = priority
             t.publish_reqs()
 
+    def completion(self):
+        """
+        :return: fraction of the SPF requests of the batch which were processed
+        """
+        total = sum(len(t.request_params) for t in self.trip_objs.itervalues())
+        if not total:
+            return 1.0
+        return sum(t.requests_processed for t in self.trip_objs.itervalues()) / float(total)
+
+    def request_priority(self, max_priority, now=None):
+        """
+        AMQP priority of the SPF requests (and so responses) of the batch, between 1 and max_priority. It grows with the
+        completion of the batch and its age relative to its deadline, so that the responses a nearly finished batch
+        still waits on don't queue behind those of new batches.
+
+        :return: None when priorities are disabled (max_priority 0 or None)
+        """
+        if not max_priority:
+            return None
+        if now is None:
+            now = time.time()
+        age = 0.0
+        if self.deadline and self.deadline > self.created:
+            age = min(1.0, max(0.0, (now - self.created) / float(self.deadline - self.created)))
+        score = (self.completion() + age) / 2.0
+        return 1 + int(round(score * (max_priority - 1)))
+
+    def finalize_incomplete(self):
+        """
+        Processes the batch with the trips that received all their SPF responses. Trips still waiting on responses are
+        dropped from the batch and logged as failed.
+
+        :return: list of the mot_segment_id which were dropped
+        """
+        incomplete = [t for t in self.trip_objs.itervalues() if not t.is_complete()]
+        incomplete_mot_id = [t.trip['mot_segment_id'] for t in incomplete]
+        for t in incomplete:
+            del self.trip_objs[t.trip_id]
+
+        if incomplete_mot_id:
+            logging.warning('Batch {bi} reached its deadline with {n} incomplete trips: {ids}'.format(
+                bi=self.batch_id, n=len(incomplete_mot_id), ids=incomplete_mot_id))
+            self.trips = self.trips[~self.trips['mot_segment_id'].isin(incomplete_mot_id)]
+            self.list_mot_id = [x for x in self.list_mot_id if x not in incomplete_mot_id]
+            save_incomplete_trips(incomplete_mot_id, self.DB)
+
+        self.process_trips()
+        return incomplete_mot_id
+
+    def process_trip(self, trip):
+        """
+        Scores and saves a single completed trip without waiting for the rest of the batch. Its tables are released
+        afterwards, batch level metrics are written by process_trips() once every trip is done.
+        """
+        self.score_trips([trip])
+        trip.release_dfs()
+
     def process_trips(self):
-        trip_link, itineraries, legs, segments = self.build_trip_dfs()
+        """
+        Scores the trips that haven't been processed through process_trip() yet, then writes the batch metrics
+        """
+        remaining = [t for t in self.trip_objs.itervalues() if t.trip_id not in self.scored_trip_ids]
+        if remaining:
+            self.score_trips(remaining)
+
+        # MoT segments without start/end stations never became trips, log them once for the whole batch. Passing the
+        # trips as the trip_link leaves out the segments that got a station but no routing, already logged per trip.
+        save_failed_trips(self.list_mot_id, self.trips, self.trips[['mot_segment_id']], self.DB)
 
         # Escapes if no trips are returned (SBB API can't output valid routes between any of the start/end station/time
-        if trip_link.shape[0] == 0:
+        if self.stats is None:
             msg = 'No Itineraries returned for any of the MoT Segments IDs. Batch_ID={bi}. MoT_IDs={ids}'
             logging.warning(msg.format(bi=self.batch_id, ids=self.list_mot_id))
-            save_failed_trips(self.list_mot_id, self.trips, trip_link, self.DB)
+            return
+
+        # Stores metrics in grafana
+        write_batch_metrics(self.list_mot_id, self.trips, self.n_mot_with_itin, self.stats, self.CONFIG)
+
+    def log_stage(self, stage, msg=None):
+        """
+        Records the time elapsed since the previous stage in the latency histograms, and in the logs when msg is given
+        """
+        if msg is not None:
+            self.time_log.log_runtime(msg=msg)
+        now = time.time()
+        observe_stage(self.CONFIG, stage, int((now - self.stage_start) * 1000))
+        self.stage_start = now
+
+    def score_trips(self, trip_objs):
+        self.stage_start = time.time()
+        trip_ids = [t.trip_id for t in trip_objs]
+        self.scored_trip_ids.extend(trip_ids)
+
+        list_mot_id = [t.trip['mot_segment_id'] for t in trip_objs]
+        trips = self.trips[self.trips['mot_segment_id'].isin(list_mot_id)]
+
+        trip_link, itineraries, legs, segments = self.build_trip_dfs(trip_objs)
+
+        if trip_link.shape[0] == 0:
+            save_failed_trips(list_mot_id, trips, trip_link, self.DB)
             return
 
         # Order the table for faster indexed searches in pandas
         ordered_col_list = ['vid', 'mot_segment_id', 'itinerary_id', 'leg_id', 'segment_id']
         trip_link = trip_link.reset_index().sort_values(ordered_col_list).set_index(ordered_col_list)
-        self.time_log.log_runtime(msg='Apply parallel. ({bid})'.format(bid=self.batch_id))
+        self.log_stage('build_trips', 'Apply parallel. ({bid})'.format(bid=self.batch_id))
 
         # For some stupid reason pandas inverts boolean into (-1,0) integers rather than the inverse boolean...
-        points, point_meta = calc_distances(self.trips, itineraries, legs[legs['leg_type'] == ''],
+        points, point_meta = calc_distances(trips, itineraries, legs[legs['leg_type'] == ''],
                                             segments[segments['waypoint'] == False], trip_link, self.DB, self.CONFIG)
         if trip_link.shape[0] == 0:
-            save_failed_trips(self.list_mot_id, self.trips, trip_link, self.DB)
+            save_failed_trips(list_mot_id, trips, trip_link, self.DB)
             return
-        self.time_log.log_runtime(msg='Calc Distance. ({bid})'.format(bid=self.batch_id))
+        self.log_stage('calc_distances', 'Calc Distance. ({bid})'.format(bid=self.batch_id))
 
         # Adds points at start and end of each leg, so that legs which don't overlap with any data don't trick the code
         points, point_meta = fpga(points, point_meta, legs[legs['leg_type'] == ''],
                                   segments[segments['segment_number'] == 0], trip_link, self.DB)
+        self.log_stage('fpga')
         # FPGA points should be stored separately as enforcing unicity between segments is not enforced
 
         # Builds the diagnostics and evaluate best itinerary
         stats, diagnostics = get_best_itinerary(trip_link, points, point_meta, self.CONFIG)
-        self.time_log.log_runtime(msg='Get Best Itinerary. ({bid})'.format(bid=self.batch_id))
+        self.log_stage('best_itinerary', 'Get Best Itinerary. ({bid})'.format(bid=self.batch_id))
 
-        # Stores metrics in grafana
-        write_metrics(self.list_mot_id, trip_link, self.trips, stats, point_meta, points, self.CONFIG)
+        # Keep what the batch metrics need, the points themselves are only logged
+        log_point_stats(point_meta, points)
+        self.n_mot_with_itin += trip_link.reset_index()['mot_segment_id'].nunique()
+        self.stats = stats if self.stats is None else pd.concat([self.stats, stats])
 
         # Save all the required outputs (both sm_ tables and train_trips/train_trips_leg
-        save_output(trip_link, self.trips, itineraries, segments, legs, points, point_meta, stats, diagnostics,
+        save_output(trip_link, trips, itineraries, segments, legs, points, point_meta, stats, diagnostics,
                     self.loc_bounds, self.DB)
-        save_failed_trips(self.list_mot_id, self.trips, trip_link, self.DB)
-        self.time_log.log_runtime(msg='Update postgres. ({bid})'.format(bid=self.batch_id))
+        save_failed_trips(list_mot_id, trips, trip_link, self.DB)
+        self.log_stage('save_output', 'Update postgres. ({bid})'.format(bid=self.batch_id))
 
+    def build_trip_dfs(self, trip_objs=None):
+        if trip_objs is None:
+            trip_objs = self.trip_objs.values()
 
-    def build_trip_dfs(self):
         trip_link, itineraries, legs, segments = ids.initialize_all_empty_df()
         trip_link.set_index(['itinerary_id', 'leg_id', 'segment_id', ], inplace=True)
 
-        for t in self.trip_objs.itervalues():
+        for t in trip_objs:
             trip_link_i, itinerary_i, legs_i, segments_i = t.trip_link_df, t.itinerary_df, t.legs_df, t.segments_df
             trip_link = pd.concat([trip_link, trip_link_i])
             itineraries = pd.concat([itineraries, itinerary_i])
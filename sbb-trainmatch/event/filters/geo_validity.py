@@ -2,9 +2,156 @@ import pandas as pd
 import numpy as np
 import logging
 import os
+import hashlib
+from shapely.geometry import box
 from shapely.geometry.point import Point
+from shapely.prepared import prep
 from shapely.wkt import loads
 
+try:
+    from shapely import vectorized
+except ImportError:
+    vectorized = None
+
+OUTSIDE, INSIDE, BOUNDARY = 0, 1, 2
+
+
+class RegionGrid(object):
+    """
+    Raster of a region over its bounding box: each cell is INSIDE, OUTSIDE or BOUNDARY of the region, so that only
+    points in boundary cells need an exact polygon test. Built by recursively splitting the bounding box (cells fully
+    inside or outside are filled at once, only the ones crossed by the border are split down to the finest level)
+    and cached on disk next to the WKT.
+    """
+
+    def __init__(self, cells, bounds, checksum):
+        self.cells = cells
+        self.bounds = bounds
+        self.checksum = checksum
+        minx, miny, maxx, maxy = bounds
+        self.ny, self.nx = cells.shape
+        self.dx = (maxx - minx) / float(self.nx)
+        self.dy = (maxy - miny) / float(self.ny)
+
+    @classmethod
+    def build(cls, geom, resolution, checksum):
+        """
+        :param resolution: number of cells along the longest side of the bounding box
+        """
+        minx, miny, maxx, maxy = geom.bounds
+        size = max(maxx - minx, maxy - miny) / float(resolution)
+        nx, ny = max(1, int(np.ceil((maxx - minx) / size))), max(1, int(np.ceil((maxy - miny) / size)))
+        bounds = (minx, miny, minx + nx * size, miny + ny * size)
+        cells = np.zeros((ny, nx), dtype=np.uint8)
+
+        prepared = prep(geom)
+        # (row0, row1, col0, col1) blocks of cells left to classify
+        blocks = [(0, ny, 0, nx)]
+        while blocks:
+            r0, r1, c0, c1 = blocks.pop()
+            cell = box(minx + c0 * size, miny + r0 * size, minx + c1 * size, miny + r1 * size)
+            if prepared.contains_properly(cell):
+                cells[r0:r1, c0:c1] = INSIDE
+            elif prepared.disjoint(cell):
+                cells[r0:r1, c0:c1] = OUTSIDE
+            elif r1 - r0 == 1 and c1 - c0 == 1:
+                cells[r0, c0] = BOUNDARY
+            else:
+                rm, cm = (r0 + r1 + 1) // 2, (c0 + c1 + 1) // 2
+                blocks.extend(b for b in [(r0, rm, c0, cm), (r0, rm, cm, c1), (rm, r1, c0, cm), (rm, r1, cm, c1)]
+                              if b[0] < b[1] and b[2] < b[3])
+
+        # Points are located with floating point arithmetic, the neighbours of the boundary cells are tested exactly
+        # as well so that a point rounded into the next cell can't be misclassified
+        boundary = cells == BOUNDARY
+        dilated = boundary.copy()
+        dilated[1:, :] |= boundary[:-1, :]
+        dilated[:-1, :] |= boundary[1:, :]
+        dilated[:, 1:] |= boundary[:, :-1]
+        dilated[:, :-1] |= boundary[:, 1:]
+        cells[dilated] = BOUNDARY
+        return cls(cells, bounds, checksum)
+
+    @classmethod
+    def load(cls, path, checksum):
+        """
+        :return: None when there is no cache or it was built from another WKT
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            cached = np.load(path)
+            if str(cached['checksum']) != checksum:
+                return None
+            return cls(cached['cells'], tuple(cached['bounds']), checksum)
+        except Exception as e:
+            logging.warning('Could not read geo-validity grid {p}: {e}'.format(p=path, e=e))
+            return None
+
+    def save(self, path):
+        try:
+            with open(path, 'wb') as f:
+                np.savez_compressed(f, cells=self.cells, bounds=np.array(self.bounds), checksum=np.array(self.checksum))
+        except (IOError, OSError) as e:
+            logging.warning('Could not cache geo-validity grid {p}: {e}'.format(p=path, e=e))
+
+    def lookup(self, lon, lat):
+        """
+        :return: array of the state of the cells of the points, which must be within the bounds
+        """
+        minx, miny = self.bounds[0], self.bounds[1]
+        cols = np.clip(((lon - minx) / self.dx).astype(int), 0, self.nx - 1)
+        rows = np.clip(((lat - miny) / self.dy).astype(int), 0, self.ny - 1)
+        return self.cells[rows, cols]
+
+
+class GeoValidity(object):
+    """
+    Tests many points at once against the regions of geo-validity. A point is valid when it is within every region
+    (same as testing each geometry with contains). Points outside the bounding box of a region are rejected without
+    a polygon test, the others are tested with shapely.vectorized in a single call per region, or one by one against
+    the prepared geometry when it isn't available. With grids (see RegionGrid) only the points in the boundary cells
+    of a region are tested against its polygon.
+    """
+
+    def __init__(self, geoms, grids=None):
+        self.geoms = geoms
+        self.prepared = [prep(geom) for geom in geoms]
+        self.grids = grids or [None] * len(geoms)
+
+    def contains(self, lon, lat):
+        """
+        :return: boolean array, True where the point is within all the regions
+        """
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        mask = np.ones(len(lon), dtype=bool)
+        for geom, prepared, grid in zip(self.geoms, self.prepared, self.grids):
+            minx, miny, maxx, maxy = geom.bounds
+            idx = np.flatnonzero(mask & (lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy))
+            mask = np.zeros(len(lon), dtype=bool)
+            if grid is not None and len(idx):
+                state = grid.lookup(lon[idx], lat[idx])
+                mask[idx[state == INSIDE]] = True
+                idx = idx[state == BOUNDARY]
+            if len(idx) == 0:
+                continue
+            if vectorized is not None:
+                mask[idx] = vectorized.contains(geom, lon[idx], lat[idx])
+            else:
+                mask[idx] = [prepared.contains(Point(x, y)) for x, y in zip(lon[idx], lat[idx])]
+        return mask
+
+    def segments_within(self, p):
+        """
+        :param p: DataFrame of MoT segments with start_lat, start_lon, end_lat and end_lon
+        :return: boolean array, True for the segments whose start and end points are both valid
+        """
+        n = len(p)
+        within = self.contains(np.concatenate([p['start_lon'].values, p['end_lon'].values]),
+                               np.concatenate([p['start_lat'].values, p['end_lat'].values]))
+        return within[:n] & within[n:]
+
 
 def geo_valid(json_input, CONFIG):
     """
@@ -17,7 +164,7 @@ def geo_valid(json_input, CONFIG):
     """
 
 
-    geoms = read_geo_valid(CONFIG)
+    geo_validity = load_geo_validity(CONFIG)
     p = pd.DataFrame(json_input)
 
     p = p[p['mot'] == 'train']
@@ -25,8 +172,7 @@ def geo_valid(json_input, CONFIG):
         logging.debug('No train journey within json')
         return []
 
-    is_within = p.apply(lambda x: np.all([geom.contains(Point(x['start_lon'], x['start_lat'])) and
-                                          geom.contains(Point(x['end_lon'], x['end_lat'])) for geom in geoms]), axis=1)
+    is_within = geo_validity.segments_within(p)
 
     return p.loc[is_within, 'mot_segment_id'].tolist()
 
@@ -36,17 +182,51 @@ def read_geo_valid(CONFIG):
     :param CONFIG: The parsed config file
     :return: A list of geometries (polygons) defining out geo valid regions
     """
+    return [geom for geom, _, _ in read_regions(CONFIG)]
+
+
+def read_regions(CONFIG):
+    """
+    :return: list of (geometry, wkt file path, checksum of the wkt) of the geo valid regions
+    """
     path = os.path.dirname(os.path.realpath(__file__))
     filenames = CONFIG.get('geovalidity', 'VALID_REGION_WKT').split(',')
-    geoms = []
+    regions = []
     for filename in filenames:
         filepath = path + '/wkt/' + filename + '.wkt'
         try:
             f = open(filepath)
-            geoms.append(loads(f.read()))
+            wkt = f.read()
+            regions.append((loads(wkt), filepath, hashlib.md5(wkt).hexdigest()))
         except:
             logging.critical('Could not read shapefile {filepath}'.format(filepath=filepath))
             raise IOError
-    return geoms
+    return regions
+
+
+def load_geo_validity(CONFIG):
+    """
+    :return: GeoValidity of the regions of the config, with their grids (GRID_RESOLUTION cells along the longest side,
+    0 disables them) loaded from the cache next to the WKT files or built and cached
+    """
+    resolution = 1024
+    if CONFIG.has_option('geovalidity', 'GRID_RESOLUTION'):
+        resolution = CONFIG.getint('geovalidity', 'GRID_RESOLUTION')
+
+    geoms, grids = [], []
+    for geom, filepath, checksum in read_regions(CONFIG):
+        geoms.append(geom)
+        if not resolution:
+            grids.append(None)
+            continue
+        checksum = '{c}-{r}'.format(c=checksum, r=resolution)
+        grid_path = os.path.splitext(filepath)[0] + '.grid.npz'
+        grid = RegionGrid.load(grid_path, checksum)
+        if grid is None:
+            logging.info('Building geo-validity grid {p}'.format(p=grid_path))
+            grid = RegionGrid.build(geom, resolution, checksum)
+            grid.save(grid_path)
+        grids.append(grid)
+    return GeoValidity(geoms, grids)
 
 
@@ -3,8 +3,12 @@ import pandas as pd
 
 try:
     from ..dbutil.temptable_template import temptable_template
+    from ..traineval.route_cache import get_route_cache
 except:
     from dbutil.temptable_template import temptable_template
+    from traineval.route_cache import get_route_cache
+
+ORDER_COLUMNS = ['itinerary_id', 'leg_id', 'segment_id', 'point_id', 'data_order', 'time_order']
 
 def order_filter(trips, legs, points, trip_link, point_meta, DB, CONFIG):
     """
@@ -34,13 +38,21 @@ def order_filter(trips, legs, points, trip_link, point_meta, DB, CONFIG):
     points_joined = points_joined.merge(points.reset_index(), on='point_id')
     points_joined = points_joined.merge(trips.reset_index(), on='mot_segment_id', suffixes=('_legs', '_trips'))
 
-    sql = DB.get_query('temporaryooo', __file__)
-    sql = temptable_template(points_joined[['itinerary_id', 'leg_id', 'segment_id', 'point_id', 'route_name', 'agency_id',
-                                            'stop_id_start_legs', 'stop_id_end_legs', 'time', 'lat', 'lon']], sql, DB)
-    sql += DB.get_query('getgeoms', __file__)
+    engine = 'sql'
+    if CONFIG.has_option('params', 'ORDER_FILTER_ENGINE'):
+        engine = CONFIG.get('params', 'ORDER_FILTER_ENGINE')
+
+    if engine == 'numpy':
+        df = line_orders(points_joined, get_route_cache(CONFIG), DB)
+    else:
+        sql = DB.get_query('temporaryooo', __file__)
+        sql = temptable_template(points_joined[['itinerary_id', 'leg_id', 'segment_id', 'point_id', 'route_name',
+                                                'agency_id', 'stop_id_start_legs', 'stop_id_end_legs', 'time', 'lat',
+                                                'lon']], sql, DB)
+        sql += DB.get_query('getgeoms', __file__)
 
-    # points_joined.to_excel('2.xlsx')
-    df = DB.postgres2pandas(sql)
+        # points_joined.to_excel('2.xlsx')
+        df = DB.postgres2pandas(sql)
 
     # We first define how different the data order is from the time order (i.e. the true order)
     df['orderdiff'] = (df['data_order'] - df['time_order']).abs()
@@ -65,3 +77,41 @@ def order_filter(trips, legs, points, trip_link, point_meta, DB, CONFIG):
     df['ooo_outlier'] = ((df.orderdiff - df.orderdiff_mean) / df.orderdiff_std) >= ORDER_FILTER_CUTOFF
 
     return df[['itinerary_id', 'segment_id',  'point_id', 'ooo_outlier']]
+
+
+def line_orders(points_joined, route_cache, DB):
+    """
+    Same as getgeoms.sql, with the points located on the cached route geometries rather than with ST_LINELOCATEPOINT.
+    Points of legs without train route geometry are left out, as by the join of the query.
+
+    :param points_joined: The points joined with their legs, segments and trips (the temp_ooo rows)
+    :param route_cache: RouteCache of the route geometries
+    :param DB: An instance of the PostgresManager class
+    :return: Returns a dataframe with the ORDER_COLUMNS
+    """
+    points_joined = points_joined.reset_index(drop=True)
+    keys = [tuple(k) for k in points_joined[['route_name', 'agency_id', 'stop_id_start_legs',
+                                              'stop_id_end_legs']].values]
+    routes = route_cache.lines(keys, DB)
+
+    key_rows = {}
+    for row, key in enumerate(keys):
+        key_rows.setdefault(key, []).append(row)
+
+    located = []
+    for key, rows in key_rows.items():
+        for line in routes[key]:
+            df = points_joined.loc[rows, ['itinerary_id', 'leg_id', 'segment_id', 'point_id', 'time']]
+            df['position'] = line.locate(points_joined.loc[rows, 'lat'].values, points_joined.loc[rows, 'lon'].values)
+            located.append(df)
+
+    if not located:
+        return pd.DataFrame(columns=ORDER_COLUMNS)
+    df = pd.concat(located, ignore_index=True)
+
+    by_position = df.sort_values(['leg_id', 'position', 'time', 'point_id'], kind='mergesort')
+    df['data_order'] = by_position.groupby('leg_id').cumcount() + 1
+    by_time = df.sort_values(['leg_id', 'time', 'position', 'point_id'], kind='mergesort')
+    df['time_order'] = by_time.groupby('leg_id').cumcount() + 1
+
+    return df.sort_values(['time', 'data_order'])[ORDER_COLUMNS]
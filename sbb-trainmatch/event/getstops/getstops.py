@@ -1,5 +1,18 @@
+import time
+
 import pandas as pd
 
+from hop_matrix import HopMatrix
+from stop_index import StopIndex, select_stop_pairs
+from visit_cache import VisitCache
+
+# Loaded on first use by get_stop_index, when the nearest stops are found in process
+STOP_INDEX = None
+# Loaded on first use by get_hop_matrix, when STATION_HOPS_MATRIX is set
+HOP_MATRIX = None
+# Created on first use by get_visit_cache, when VISIT_CACHE_SIZE is set
+VISIT_CACHE = None
+
 
 def get_stops(list_mot_id, DB, CONFIG):
     """ Get start/end stops associated with each MoT ID and bounding trip times
@@ -30,9 +43,15 @@ def get_trip_times(list_mot_id, DB, CONFIG):
     # sql_str_fname = 'event/getstops/sql/get_trip_times.sql'
     # data_bounds = pd_read_sql_from_file(list_mot_id, sql_str_fname, CONFIG)
 
+    min_visit_dur = CONFIG.getint('pointprocessing', 'MIN_VISIT_DURATION')
+
+    visit_cache = get_visit_cache(CONFIG)
+    if visit_cache is not None:
+        return visit_cache.trip_times(list_mot_id, DB, min_visit_dur)
+
     sql = DB.get_query('get_trip_times', __file__)
     sql_var = {'mot_id': tuple(list_mot_id),
-               'min_visit_dur': CONFIG.getint('pointprocessing', 'MIN_VISIT_DURATION')}
+               'min_visit_dur': min_visit_dur}
 
     data_bounds = DB.postgres2pandas(sql, params=sql_var)
 
@@ -49,11 +68,18 @@ def find_nearest_stop(list_mot_id, DB, CONFIG):
     :return:
     """
 
-    sql = DB.get_query('find_nearest_stop', __file__)
-    sql_var = {'mot_id': list_mot_id,
-               'dist_lim': int(CONFIG.get('params', 'MAX_WALK_DIST'))}
+    engine = 'sql'
+    if CONFIG.has_option('params', 'NEAREST_STOP_ENGINE'):
+        engine = CONFIG.get('params', 'NEAREST_STOP_ENGINE')
+
+    if engine == 'kdtree':
+        data = find_nearest_stop_in_process(list_mot_id, DB, CONFIG)
+    else:
+        sql = DB.get_query('find_nearest_stop', __file__)
+        sql_var = {'mot_id': list_mot_id,
+                   'dist_lim': int(CONFIG.get('params', 'MAX_WALK_DIST'))}
 
-    data = DB.postgres2pandas(sql, params=sql_var)
+        data = DB.postgres2pandas(sql, params=sql_var)
 
     # Drop trips where the start and end station is identical because it causes OTP to crash
     data = data[(data['lat_start'] != data['lat_end']) & (data['lon_start'] != data['lon_end'])]
@@ -62,3 +88,69 @@ def find_nearest_stop(list_mot_id, DB, CONFIG):
     data.reset_index(inplace=True, drop=True)
 
     return data
+
+
+def find_nearest_stop_in_process(list_mot_id, DB, CONFIG):
+    """
+    Same as find_nearest_stop.sql, but only the endpoints of the MoT segments and the connectivity of their candidate
+    stations are queried, the stations near the endpoints are found with the in process StopIndex
+
+    :return: DataFrame with the columns of find_nearest_stop.sql
+    """
+    sql = DB.get_query('find_mot_endpoints', __file__)
+    endpoints = DB.postgres2pandas(sql, params={'mot_id': list_mot_id})
+
+    candidates = get_stop_index(DB, CONFIG).candidates(endpoints)
+
+    hops = get_hop_matrix(CONFIG)
+    if hops is None:
+        is_start = candidates['is_start'].astype(bool)
+        sql = DB.get_query('station_hops', __file__)
+        sql_var = {'start_ids': candidates.loc[is_start, 'stop_id_parent'].unique().tolist(),
+                   'end_ids': candidates.loc[~is_start, 'stop_id_parent'].unique().tolist()}
+        hops = DB.postgres2pandas(sql, params=sql_var)
+
+    return select_stop_pairs(candidates, hops)
+
+
+def get_stop_index(DB, CONFIG):
+    """
+    :return: the StopIndex, reloaded when older than STOP_INDEX_REFRESH_INTERVAL seconds (stations rarely change)
+    """
+    global STOP_INDEX
+    refresh_interval = 3600
+    if CONFIG.has_option('params', 'STOP_INDEX_REFRESH_INTERVAL'):
+        refresh_interval = CONFIG.getint('params', 'STOP_INDEX_REFRESH_INTERVAL')
+
+    if STOP_INDEX is None or time.time() - STOP_INDEX.loaded_at > refresh_interval:
+        STOP_INDEX = StopIndex.load(DB)
+    return STOP_INDEX
+
+
+def get_hop_matrix(CONFIG):
+    """
+    :return: the HopMatrix written by setup/build_sbb_stn_graph.py at STATION_HOPS_MATRIX, None if not configured (the
+    hops are then queried from stn_hops)
+    """
+    global HOP_MATRIX
+    if HOP_MATRIX is None and CONFIG.has_option('params', 'STATION_HOPS_MATRIX'):
+        path = CONFIG.get('params', 'STATION_HOPS_MATRIX')
+        if path:
+            HOP_MATRIX = HopMatrix.load(path)
+    return HOP_MATRIX
+
+
+def get_visit_cache(CONFIG):
+    """
+    :return: the VisitCache of the last VISIT_CACHE_SIZE vids, None if not configured (the trip times are then
+    computed by get_trip_times.sql)
+    """
+    global VISIT_CACHE
+    if VISIT_CACHE is None and CONFIG.has_option('params', 'VISIT_CACHE_SIZE'):
+        max_vids = CONFIG.getint('params', 'VISIT_CACHE_SIZE')
+        ttl = 86400
+        if CONFIG.has_option('params', 'VISIT_CACHE_TTL'):
+            ttl = CONFIG.getint('params', 'VISIT_CACHE_TTL')
+        if max_vids > 0:
+            VISIT_CACHE = VisitCache(max_vids, ttl)
+    return VISIT_CACHE
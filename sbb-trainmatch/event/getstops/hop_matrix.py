@@ -0,0 +1,51 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+# Written by setup/build_sbb_stn_graph.py: <path>.npy holds the n by n uint8 hop matrix, <path>.stations.txt the
+# stop_id_parent of each of its rows/columns (one per line, same order)
+MATRIX_SUFFIX = '.npy'
+STATIONS_SUFFIX = '.stations.txt'
+
+# Disconnected stations (-1 in stn_hops), also returned for stations missing from the matrix
+DISCONNECTED = 255
+
+
+class HopMatrix(object):
+    """
+    The stn_hops table as an in memory (memory mapped) matrix, so that the candidate start/end station pairs are ranked
+    by indexing rather than by joining stn_hops
+    """
+
+    def __init__(self, station_ids, hops):
+        """
+        :param station_ids: stop_id_parent of each row/column of hops
+        :param hops: n by n uint8 array of the number of hops between stations i and j, DISCONNECTED if not connected
+        """
+        self.stations = pd.Index(station_ids)
+        self.hops = hops
+
+    @classmethod
+    def load(cls, path):
+        with open(path + STATIONS_SUFFIX) as f:
+            station_ids = [line.strip() for line in f if line.strip()]
+        hops = np.load(path + MATRIX_SUFFIX, mmap_mode='r')
+        if hops.shape != (len(station_ids), len(station_ids)):
+            raise ValueError('Hop matrix {path} is {shape} for {n} stations'.format(path=path, shape=hops.shape,
+                                                                                     n=len(station_ids)))
+        logging.info('Loaded the hops between {n} stations from {path}'.format(n=len(station_ids), path=path))
+        return cls(station_ids, hops)
+
+    def n_hops(self, start_ids, end_ids):
+        """
+        :return: array of the number of hops between each start_ids[k] and end_ids[k], -1 if disconnected (as stn_hops)
+        """
+        i = self.stations.get_indexer(np.asarray(start_ids))
+        j = self.stations.get_indexer(np.asarray(end_ids))
+        known = (i >= 0) & (j >= 0)
+
+        n_hops = np.full(len(i), -1, dtype=int)
+        n_hops[known] = self.hops[i[known], j[known]]
+        n_hops[n_hops == DISCONNECTED] = -1
+        return n_hops
@@ -0,0 +1,70 @@
+"""
+Maintains the geohash11 and is_outlier columns of the locations read by find_nearest_stop.sql and
+find_mot_endpoints.sql (see sql/location_flags_migration.sql). New locations are resolved by the insert trigger, this
+job creates the columns, backfills the locations inserted before the migration and re-resolves is_outlier when
+hotspots_gh11 is rebuilt:
+
+    python location_flags.py [migrate] [refresh]
+"""
+import logging
+import os
+import sys
+
+# Number of locations resolved per UPDATE while backfilling
+BATCH_SIZE = 10000
+
+
+def migrate(DB):
+    DB.execute(DB.replace_schemas(DB.get_query('location_flags_migration', __file__)))
+    logging.info('Created the geohash11/is_outlier columns of the locations')
+
+
+def update_location_flags(DB, batch_size=BATCH_SIZE):
+    """
+    Resolves the locations which have no geohash11 yet, batch_size at a time until none is left
+
+    :return: number of locations resolved
+    """
+    sql_pending = DB.get_query('location_flags_pending', __file__)
+    sql_update = DB.replace_schemas(DB.get_query('location_flags_update', __file__))
+
+    n_total = 0
+    while True:
+        pending = DB.postgres2pandas(sql_pending, params={'batch_size': batch_size})
+        if pending.empty:
+            break
+        DB.execute(DB.query_mogrify(sql_update, {'location_id': pending['id'].tolist()}))
+        n_total += pending.shape[0]
+        logging.info('Resolved the geohash11/is_outlier of {n} locations'.format(n=n_total))
+
+    return n_total
+
+
+def refresh_outliers(DB):
+    DB.execute(DB.replace_schemas(DB.get_query('location_flags_refresh', __file__)))
+    logging.info('Re-resolved is_outlier of the locations from hotspots_gh11')
+
+
+def main(args):
+    from vibepy.load_logger import load_logger
+    from vibepy.read_config import read_config
+    import vibepy.class_postgres as class_postgres
+
+    load_logger()
+    CONFIG = read_config(ini_filename='application.ini',
+                         ini_path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+    DB = class_postgres.PostgresManager(CONFIG, 'database')
+
+    batch_size = BATCH_SIZE
+    if CONFIG.has_option('params', 'LOCATION_FLAGS_BATCH_SIZE'):
+        batch_size = CONFIG.getint('params', 'LOCATION_FLAGS_BATCH_SIZE')
+
+    if 'migrate' in args:
+        migrate(DB)
+    update_location_flags(DB, batch_size)
+    if 'refresh' in args:
+        refresh_outliers(DB)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,54 @@
+-- Start and end point of each MoT segment (the nearest non outlier point when it is an outlier), the stations near
+-- them are resolved in process by StopIndex. Same points as find_nearest_stop.sql
+SELECT
+    m.mot_segment_id,
+    m.is_start,
+    l.datetime_created AT TIME ZONE l.tz AS datetime_created,
+    l.tz,
+    ST_Y(COALESCE(x.coordinate,l.coordinate)) AS lat,
+    ST_X(COALESCE(x.coordinate,l.coordinate)) AS lon
+FROM (
+    SELECT
+        m1.id AS mot_segment_id,
+        m1.start_location_id AS location_id,
+        TRUE AS is_start
+    FROM <POSTGRES_SCHEMA>.mot_segments m1
+    WHERE m1.id = ANY( %(mot_id)s::uuid[] )
+
+    UNION
+
+    SELECT
+        m2.id AS mot_segment_id,
+        m2.end_location_id AS location_id,
+        FALSE AS is_start
+    FROM <POSTGRES_SCHEMA>.mot_segments m2
+    WHERE m2.id = ANY( %(mot_id)s::uuid[] )
+    ) m
+-- Location point ID associated with start/end of segment
+JOIN (
+    SELECT
+        l1.id AS id,
+        l1.mot_segment_id AS mot_segment_id,
+        l1.vid AS vid,
+        l1.datetime_created AS datetime_created,
+        coalesce(l1.timezone_coordinate, l1.timezone_created) AS tz,
+        l1.coordinate AS coordinate,
+        COALESCE(l1.is_outlier, FALSE) AS is_outlier
+    FROM <POSTGRES_SCHEMA>.locations l1
+    ) l ON m.mot_segment_id=l.mot_segment_id AND m.location_id=l.id
+--  If location is an outlier replace with nearest (in time) non-outlier
+LEFT JOIN LATERAL (
+    SELECT
+        l2.coordinate AS coordinate
+    FROM <POSTGRES_SCHEMA>.locations l2
+    WHERE l.vid=l2.vid
+        AND l.id != l2.id
+        AND l2.is_outlier IS FALSE
+        -- Same window as a range on datetime_created, to use locations_vid_non_outlier_idx
+        AND l2.datetime_created > l.datetime_created - INTERVAL '600 seconds'
+        AND l2.datetime_created < l.datetime_created + INTERVAL '600 seconds'
+    ORDER BY ABS(EXTRACT (EPOCH FROM (l.datetime_created-l2.datetime_created)))
+    LIMIT 1
+    ) x ON l.is_outlier IS TRUE
+WHERE COALESCE(x.coordinate,l.coordinate) IS NOT NULL
+;
@@ -34,9 +34,8 @@ LEFT JOIN (
         l1.datetime_created AS datetime_created,
         coalesce(l1.timezone_coordinate, l1.timezone_created) AS tz,
         l1.coordinate AS coordinate,
-        COALESCE(h.is_outlier, FALSE) AS is_outlier
+        COALESCE(l1.is_outlier, FALSE) AS is_outlier
     FROM <POSTGRES_SCHEMA>.locations l1 
-    LEFT JOIN <POSTGRES_SCHEMA>.hotspots_gh11 h ON ST_GeoHash(l1.coordinate, 11)=h.geohash11
     ) l ON m.mot_segment_id=l.mot_segment_id AND m.location_id=l.id
 --  If location is an outlier replace with nearest (in time) non-outlier
 LEFT JOIN LATERAL (
@@ -48,11 +47,12 @@ LEFT JOIN LATERAL (
         coalesce(l2.timezone_coordinate, l2.timezone_created) AS tz,
         l2.coordinate AS coordinate
     FROM <POSTGRES_SCHEMA>.locations l2
-    LEFT JOIN <POSTGRES_SCHEMA>.hotspots_gh11 h2 ON ST_GeoHash(l2.coordinate, 11)=h2.geohash11
     WHERE l.vid=l2.vid
         AND l.id != l2.id
-        AND h2.is_outlier IS FALSE
-        AND ABS(EXTRACT (EPOCH FROM (l.datetime_created-l2.datetime_created))) < 600
+        AND l2.is_outlier IS FALSE
+        -- Same window as a range on datetime_created, to use locations_vid_non_outlier_idx
+        AND l2.datetime_created > l.datetime_created - INTERVAL '600 seconds'
+        AND l2.datetime_created < l.datetime_created + INTERVAL '600 seconds'
     ORDER BY ABS(EXTRACT (EPOCH FROM (l.datetime_created-l2.datetime_created)))
     LIMIT 1
     ) x ON l.is_outlier IS TRUE
@@ -0,0 +1,26 @@
+-- Stores the geohash11 of each location and its is_outlier flag from hotspots_gh11, so that the get-stops queries read
+-- them instead of computing ST_GeoHash for every row. is_outlier is NULL for locations which aren't in a hotspot (as the
+-- LEFT JOIN it replaces), rows still to be resolved by location_flags.py have a NULL geohash11
+ALTER TABLE <POSTGRES_SCHEMA>.locations ADD COLUMN IF NOT EXISTS geohash11 varchar(11);
+ALTER TABLE <POSTGRES_SCHEMA>.locations ADD COLUMN IF NOT EXISTS is_outlier boolean;
+
+-- Nearest non outlier of the same vid (LATERAL search of find_nearest_stop.sql)
+CREATE INDEX IF NOT EXISTS locations_vid_non_outlier_idx ON <POSTGRES_SCHEMA>.locations (vid, datetime_created)
+    WHERE is_outlier IS FALSE;
+-- Rows left to backfill, empty once location_flags.py caught up
+CREATE INDEX IF NOT EXISTS locations_geohash11_pending_idx ON <POSTGRES_SCHEMA>.locations (id)
+    WHERE geohash11 IS NULL;
+CREATE INDEX IF NOT EXISTS locations_geohash11_idx ON <POSTGRES_SCHEMA>.locations (geohash11);
+
+-- New locations are resolved as they arrive
+CREATE OR REPLACE FUNCTION <POSTGRES_SCHEMA>.locations_set_flags() RETURNS trigger AS $$
+BEGIN
+    NEW.geohash11 := ST_GeoHash(NEW.coordinate, 11);
+    NEW.is_outlier := (SELECT h.is_outlier FROM <POSTGRES_SCHEMA>.hotspots_gh11 h WHERE h.geohash11 = NEW.geohash11 LIMIT 1);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS locations_set_flags ON <POSTGRES_SCHEMA>.locations;
+CREATE TRIGGER locations_set_flags BEFORE INSERT OR UPDATE OF coordinate ON <POSTGRES_SCHEMA>.locations
+    FOR EACH ROW EXECUTE PROCEDURE <POSTGRES_SCHEMA>.locations_set_flags();
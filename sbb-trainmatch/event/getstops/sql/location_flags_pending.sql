@@ -0,0 +1,7 @@
+-- Locations inserted before the migration, not resolved yet
+SELECT id
+FROM <POSTGRES_SCHEMA>.locations
+WHERE geohash11 IS NULL
+    AND coordinate IS NOT NULL
+LIMIT %(batch_size)s
+;
@@ -0,0 +1,12 @@
+-- Re-resolves is_outlier after hotspots_gh11 was rebuilt
+UPDATE <POSTGRES_SCHEMA>.locations l
+SET is_outlier = h.is_outlier
+FROM (
+    SELECT l1.id, h1.is_outlier
+    FROM <POSTGRES_SCHEMA>.locations l1
+    LEFT JOIN <POSTGRES_SCHEMA>.hotspots_gh11 h1 ON l1.geohash11=h1.geohash11
+    WHERE l1.geohash11 IS NOT NULL
+    ) h
+WHERE l.id = h.id
+    AND l.is_outlier IS DISTINCT FROM h.is_outlier
+;
@@ -0,0 +1,6 @@
+UPDATE <POSTGRES_SCHEMA>.locations l
+SET geohash11 = ST_GeoHash(l.coordinate, 11),
+    is_outlier = (SELECT h.is_outlier FROM <POSTGRES_SCHEMA>.hotspots_gh11 h
+                  WHERE h.geohash11 = ST_GeoHash(l.coordinate, 11) LIMIT 1)
+WHERE l.id = ANY( %(location_id)s )
+;
@@ -0,0 +1,10 @@
+-- vid and time (UTC) of each MoT segment, matched to the visit boundaries of its vid by VisitCache. Same as the vidtime
+-- of get_trip_times.sql
+SELECT DISTINCT ON(mot_segment_id)
+    mot_segment_id,
+    vid,
+    datetime_created AT TIME ZONE 'UTC' AS datetime_created
+FROM <POSTGRES_SCHEMA>.locations
+WHERE mot_segment_id IN %(mot_id)s
+ORDER BY mot_segment_id
+;
@@ -0,0 +1,10 @@
+-- Connectivity of the candidate start/end station pairs, disconnected stations are labeled as -1
+SELECT
+    station_i AS stop_id_start,
+    station_j AS stop_id_end,
+    n_hops
+FROM <POSTGRES_SCHEMA_PROVIDER>.stn_hops
+WHERE station_i = ANY( %(start_ids)s )
+    AND station_j = ANY( %(end_ids)s )
+    AND n_hops > 0
+;
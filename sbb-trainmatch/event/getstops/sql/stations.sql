@@ -0,0 +1,8 @@
+-- Stations which can be matched (part of the station graph), loaded once by StopIndex
+SELECT DISTINCT
+    stop_id_parent,
+    ST_Y(ST_Transform(s.stop,4326)) AS lat,
+    ST_X(ST_Transform(s.stop,4326)) AS lon
+FROM <POSTGRES_SCHEMA_PROVIDER>.stops s
+WHERE stop_id_parent IN (SELECT station_i FROM <POSTGRES_SCHEMA_PROVIDER>.stn_hops)
+;
@@ -0,0 +1,13 @@
+-- Visits (times in UTC) of each vid that arrived since the last visit already in the VisitCache, all of them for the
+-- vids which aren't cached yet. Same visits as get_trip_times.sql
+SELECT
+    v.vid,
+    v.id,
+    v.datetime_arrived AT TIME ZONE 'UTC' AS datetime_arrived,
+    v.datetime_departed AT TIME ZONE 'UTC' AS datetime_departed,
+    coalesce(v.timezone_coordinate, v.timezone_created) AS tz
+FROM <POSTGRES_SCHEMA>.visits v
+JOIN unnest(%(vid)s, %(since)s::timestamp[]) AS w(vid, since) ON v.vid=w.vid
+WHERE v.datetime_arrived >= w.since AT TIME ZONE 'UTC'
+    AND (v.datetime_departed - v.datetime_arrived) > interval '%(min_visit_dur)s seconds'
+;
@@ -0,0 +1,107 @@
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+try:
+    import geodesic
+except ImportError:
+    # Imported through the event package (tests) rather than from the event directory
+    from event import geodesic
+
+# find_nearest_stop.sql looks for the stations within 10000 web mercator (EPSG:3857) units of the MoT endpoints
+SEARCH_RADIUS = 10000
+MERCATOR_RADIUS = 6378137.0
+
+CANDIDATE_COLUMNS = ['mot_segment_id', 'stop_lat', 'stop_lon', 'datetime_created', 'distance', 'stop_id_parent', 'tz']
+OUTPUT_COLUMNS = ['mot_segment_id', 'lat_start', 'lon_start', 'time_start', 'distance_start', 'stop_id_start',
+                  'timezone_start', 'lat_end', 'lon_end', 'time_end', 'distance_end', 'stop_id_end', 'timezone_end']
+
+
+def web_mercator(lat, lon):
+    """
+    :return: (n, 2) array of the EPSG:3857 coordinates of the points
+    """
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    return np.column_stack([MERCATOR_RADIUS * lon, MERCATOR_RADIUS * np.log(np.tan(np.pi / 4 + lat / 2))])
+
+
+class StopIndex(object):
+    """
+    The stations of the station graph in a KD-tree of their web mercator coordinates, so that the stations near the
+    MoT endpoints are found in process rather than with a spatial join in find_nearest_stop.sql. Loaded once and
+    reloaded by get_stop_index() when older than its refresh interval.
+    """
+
+    def __init__(self, stations):
+        """
+        :param stations: DataFrame with stop_id_parent, lat and lon, one row per stop of the station
+        """
+        self.stations = stations.reset_index(drop=True)
+        self.tree = cKDTree(web_mercator(self.stations['lat'].values, self.stations['lon'].values))
+        self.loaded_at = time.time()
+
+    @classmethod
+    def load(cls, DB):
+        stations = DB.postgres2pandas(DB.get_query('stations', __file__))
+        logging.info('Loaded {n} stops in the stop index'.format(n=stations.shape[0]))
+        return cls(stations)
+
+    def candidates(self, endpoints, radius=SEARCH_RADIUS):
+        """
+        :param endpoints: DataFrame of points with (at least) lat and lon columns
+        :return: one row per (endpoint, station) within radius: the endpoint columns, the stop_id_parent, stop_lat and
+        stop_lon of the station and the distance (meters) between them
+        """
+        endpoints = endpoints.reset_index(drop=True)
+        if endpoints.empty:
+            matches = []
+        else:
+            matches = self.tree.query_ball_point(web_mercator(endpoints['lat'].values, endpoints['lon'].values),
+                                                 radius)
+        counts = np.array([len(m) for m in matches], dtype=int)
+        endpoint_idx = np.repeat(np.arange(len(counts)), counts)
+        station_idx = np.array([i for m in matches for i in m], dtype=int)
+
+        pairs = endpoints.iloc[endpoint_idx].reset_index(drop=True)
+        pairs['stop_id_parent'] = self.stations['stop_id_parent'].values[station_idx]
+        pairs['stop_lat'] = self.stations['lat'].values[station_idx]
+        pairs['stop_lon'] = self.stations['lon'].values[station_idx]
+        pairs['distance'] = geodesic.distance(pairs['lat'].values, pairs['lon'].values,
+                                              pairs['stop_lat'].values, pairs['stop_lon'].values)
+        return pairs
+
+
+def select_stop_pairs(candidates, hops):
+    """
+    Picks the start and end station of each MoT segment among the candidate stations of its endpoints
+
+    :param candidates: StopIndex.candidates() of the endpoints, with their mot_segment_id, is_start, datetime_created
+    and tz
+    :param hops: DataFrame of the n_hops between stop_id_start and stop_id_end, pairs which aren't connected are left out,
+    or a HopMatrix, looked up for all the candidate pairs at once instead of joined
+    :return: DataFrame with the columns of find_nearest_stop.sql, one row per MoT segment
+    """
+    is_start = candidates['is_start'].astype(bool).values
+    starts = candidates.loc[is_start, CANDIDATE_COLUMNS]
+    starts.columns = OUTPUT_COLUMNS[:7]
+    ends = candidates.loc[~is_start, CANDIDATE_COLUMNS]
+    ends.columns = OUTPUT_COLUMNS[:1] + OUTPUT_COLUMNS[7:]
+
+    pairs = pd.merge(starts, ends, on='mot_segment_id')
+    if isinstance(hops, pd.DataFrame):
+        pairs = pd.merge(pairs, hops, on=['stop_id_start', 'stop_id_end'])
+    else:
+        pairs['n_hops'] = hops.n_hops(pairs['stop_id_start'].values, pairs['stop_id_end'].values)
+    pairs['dist_tot'] = pairs['distance_start'] + pairs['distance_end']
+    pairs = pairs[pairs['n_hops'] > 0]
+
+    # Same order as find_nearest_stop.sql. Its is_near compares each distance with the minimum over the window of the
+    # one row lateral, i.e. with itself, so it is n_hops for every pair: fewest hops first, then shortest total walk
+    pairs = pairs.sort_values(['mot_segment_id', 'n_hops', 'dist_tot'], kind='mergesort')
+    pairs = pairs.drop_duplicates('mot_segment_id')
+
+    return pairs[OUTPUT_COLUMNS].reset_index(drop=True)
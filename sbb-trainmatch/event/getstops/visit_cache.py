@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# Visits arrived since this are loaded for the vids which aren't cached yet, i.e. all of them
+EPOCH = datetime(1970, 1, 1)
+
+VISIT_COLUMNS = ['vid', 'id', 'datetime_arrived', 'datetime_departed', 'tz']
+TRIP_TIMES_COLUMNS = ['vid', 'mot_segment_id', 'trip_time_start', 'trip_time_end', 'visit_id_start', 'visit_id_end']
+
+
+def local_time(utc, tz):
+    """
+    :param utc: naive UTC times
+    :param tz: time zone of each time
+    :return: array of the naive local times, as AT TIME ZONE tz
+    """
+    utc = pd.DatetimeIndex(utc)
+    tz = np.asarray(tz)
+    local = np.empty(len(utc), dtype='datetime64[ns]')
+    for zone in pd.unique(tz):
+        mask = tz == zone
+        local[mask] = utc[mask].tz_localize('UTC').tz_convert(zone).tz_localize(None).values
+    return local
+
+
+def visit_boundaries(visits, now=None):
+    """
+    The subquery of get_trip_times.sql: trips between each visit and the following visit of the same vid, the last one
+    ending now
+
+    :param visits: DataFrame with VISIT_COLUMNS
+    :return: DataFrame with vid, visit_id_start, visit_id_end, start, end (UTC) and tz
+    """
+    visits = visits.sort_values(['vid', 'datetime_arrived'], kind='mergesort')
+    following = visits.groupby('vid')[['id', 'datetime_arrived']].shift(-1)
+    now = now or datetime.utcnow()
+
+    return pd.DataFrame({'vid': visits['vid'].values,
+                         'visit_id_start': visits['id'].values,
+                         'visit_id_end': following['id'].values,
+                         'start': visits['datetime_departed'].values,
+                         'end': following['datetime_arrived'].fillna(now).values,
+                         'tz': visits['tz'].values})
+
+
+class VisitCache(object):
+    """
+    The qualifying visits (longer than MIN_VISIT_DURATION) of recently seen vids, so that get_trip_times only queries
+    the visits which arrived since the last cached visit of each vid instead of the whole visit history. The last
+    cached visit is queried again, in case it was still ongoing. Least recently used vids are evicted beyond max_vids
+    and each vid is reloaded in full after ttl seconds.
+    """
+
+    def __init__(self, max_vids=10000, ttl=86400):
+        self.max_vids = max_vids
+        self.ttl = ttl
+        # vid -> (DataFrame of its visits, time it was loaded in full)
+        self.vids = OrderedDict()
+        self.lock = threading.Lock()
+
+    def trip_times(self, list_mot_id, DB, min_visit_dur):
+        """
+        :return: same DataFrame as get_trip_times.sql
+        """
+        sql = DB.get_query('mot_vid_times', __file__)
+        mot_times = DB.postgres2pandas(sql, params={'mot_id': tuple(list_mot_id)})
+        if mot_times.empty:
+            return pd.DataFrame(columns=TRIP_TIMES_COLUMNS)
+
+        visits = self.update(mot_times['vid'].unique().tolist(), DB, min_visit_dur)
+
+        trips = pd.merge(mot_times, visit_boundaries(visits), on='vid')
+        trips = trips[(trips['datetime_created'] >= trips['start']) & (trips['datetime_created'] <= trips['end'])]
+
+        return pd.DataFrame({'vid': trips['vid'].values,
+                             'mot_segment_id': trips['mot_segment_id'].values,
+                             'trip_time_start': local_time(trips['start'], trips['tz']),
+                             'trip_time_end': local_time(trips['end'], trips['tz']),
+                             'visit_id_start': trips['visit_id_start'].values,
+                             'visit_id_end': trips['visit_id_end'].values}, columns=TRIP_TIMES_COLUMNS)
+
+    def update(self, vids, DB, min_visit_dur):
+        """
+        Loads the visits that arrived since the last cached visit of each vid
+
+        :return: DataFrame of all the cached visits of the vids
+        """
+        now = time.time()
+        with self.lock:
+            since = []
+            for vid in vids:
+                cached = self.vids.get(vid)
+                if cached is None or now - cached[1] > self.ttl or cached[0].empty:
+                    self.vids.pop(vid, None)
+                    since.append(EPOCH)
+                else:
+                    since.append(pd.Timestamp(cached[0]['datetime_arrived'].max()).to_pydatetime())
+
+        sql = DB.get_query('vid_visits', __file__)
+        new = DB.postgres2pandas(sql, params={'vid': vids, 'since': since, 'min_visit_dur': min_visit_dur})
+        logging.debug('Loaded {n} visits of {v} vids'.format(n=new.shape[0], v=len(vids)))
+
+        new = dict((vid, group[VISIT_COLUMNS]) for vid, group in new.groupby('vid'))
+        with self.lock:
+            visits = []
+            for vid, vid_since in zip(vids, since):
+                vid_new = new.get(vid, pd.DataFrame(columns=VISIT_COLUMNS))
+                cached = self.vids.pop(vid, None)
+                if cached is None:
+                    vid_visits, loaded_at = vid_new, now
+                else:
+                    old = cached[0]
+                    vid_visits = pd.concat([old[old['datetime_arrived'] < vid_since], vid_new], ignore_index=True)
+                    loaded_at = cached[1]
+                self.vids[vid] = (vid_visits, loaded_at)
+                visits.append(vid_visits)
+
+            while len(self.vids) > self.max_vids:
+                self.vids.popitem(last=False)
+
+        return pd.concat(visits, ignore_index=True) if visits else pd.DataFrame(columns=VISIT_COLUMNS)
@@ -2,10 +2,23 @@ import logging
 import numpy as np
 
 from vibepy.write_grafana import write_grafana
+from vibebot.metrics_buffer import BufferedStatsClient
+from vibebot import latency
+
+# Process wide, see get_grafana_client
+GRAFANA_CLIENT = None
 
 
 def write_metrics(list_mot_id, trip_link, trips, stats, point_meta, points, CONFIG):
 
+    write_batch_metrics(list_mot_id, trips, trip_link.reset_index()['mot_segment_id'].nunique(), stats, CONFIG)
+    log_point_stats(point_meta, points)
+
+    return
+
+
+def write_batch_metrics(list_mot_id, trips, n_mot_with_itin, stats, CONFIG):
+
     error_msg = [r'WARNING -- Low Counts',
                  r'WARNING -- High Avg. Distance',
                  r'WARNING -- Low overlap with MoT segment']
@@ -16,7 +29,7 @@ def write_metrics(list_mot_id, trip_link, trips, stats, point_meta, points, CONF
         # of which had a start and end station in CH
         'mot_with_se_stn': trips.shape[0],
         # of which thr SBB routing engine found at least 1 itin
-        'mot_with_itin': trip_link.reset_index()['mot_segment_id'].nunique(),
+        'mot_with_itin': n_mot_with_itin,
         'mot_no_warnings': stats.loc[~stats['warning_bool'], 'warning_bool'].count(),
         'mot_nw_unambiguous': stats.loc[np.logical_and(~stats['warning_bool'],
                                                        np.logical_or(stats['delta_next'] < 0,
@@ -29,7 +42,55 @@ def write_metrics(list_mot_id, trip_link, trips, stats, point_meta, points, CONF
         'mot_w_low_overlap': stats['warning_str'].str.contains(error_msg[2]).astype(int).sum()
     }
 
-    write_grafana(CONFIG, metrics, output_type='incr')
+    incr_grafana(CONFIG, metrics)
+
+    return
+
+
+def incr_grafana(CONFIG, metrics):
+    """
+    Same as write_grafana(CONFIG, metrics, output_type='incr') but aggregated in process and flushed periodically,
+    rather than a statsd packet per event
+    """
+    client = get_grafana_client(CONFIG)
+    if client is None:
+        write_grafana(CONFIG, metrics, output_type='incr')
+        return
+
+    for name, value in metrics.iteritems():
+        client.incr(name, int(value))
+
+
+def get_grafana_client(CONFIG):
+    """
+    :return: the process wide buffered statsd client, None when buffering is disabled ([statsd] STATSD_FLUSH_INTERVAL=0)
+    """
+    global GRAFANA_CLIENT
+    flush_interval = 1.0
+    if CONFIG.has_option('statsd', 'STATSD_FLUSH_INTERVAL'):
+        flush_interval = CONFIG.getfloat('statsd', 'STATSD_FLUSH_INTERVAL')
+    if flush_interval <= 0:
+        return None
+
+    if GRAFANA_CLIENT is None:
+        GRAFANA_CLIENT = BufferedStatsClient(CONFIG.get('statsd', 'STATSD_HOST'), CONFIG.get('statsd', 'STATSD_PORT'),
+                                             prefix=CONFIG.get('statsd', 'STATSD_NAMESPACE'),
+                                             flush_interval=flush_interval)
+    return GRAFANA_CLIENT
+
+
+def observe_stage(CONFIG, stage, millis):
+    """
+    Records the latency of a pipeline stage in the bot's histograms (see vibebot.latency, served on /metrics) and as
+    a statsd timing
+    """
+    latency.observe(stage, millis)
+    client = get_grafana_client(CONFIG)
+    if client is not None:
+        client.timing('stage.' + stage, millis)
+
+
+def log_point_stats(point_meta, points):
 
     # for stats on the properties, median of: stats['count', 'n_time_in', 'min_value']
     x = point_meta['ooo_outlier'].astype(int).sum() / point_meta['ooo_outlier'].count().astype(float)
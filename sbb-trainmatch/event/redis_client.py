@@ -1,26 +1,204 @@
+import threading
+import time
+from collections import OrderedDict
+
 import redis
 
 
 class RedisClient(object):
     EXPIRATION_TIME_IN_SECONDS = 60 * 60 * 24 * 2
+    # Sorted set of in-flight batch ids scored by the unix time at which they should be finalized
+    DEADLINE_KEY = 'sm_batch_deadlines'
+    DEFAULT_MAX_CONNECTIONS = 10
+    # Writes a hash only while its key is still in the deadline index, so that a batch claimed and deleted by another
+    # process isn't re-created. KEYS: deadline index, hash. ARGV: member, expiry, field/value pairs
+    UPLOAD_IF_DEADLINE = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    redis.call('HMSET', KEYS[2], unpack(ARGV, 3))
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+    def __init__(self, host, port, max_connections=DEFAULT_MAX_CONNECTIONS, cache_ttl=0, cache_size=1000,
+                 deadline_key=DEADLINE_KEY):
+        """
+        All methods taking a pipe argument queue their command on it when given (see pipeline/execute) so that
+        several commands share a single round trip. Without it the command is sent right away.
+
+        :param cache_ttl: seconds plain keys read through get_obj/get_many are cached locally, 0 disables the cache.
+        Hashes (i.e. batch states) are written by other consumers so they are never cached.
+        :param deadline_key: sorted set used as deadline index, bots owning their batches each get their own
+        """
+        # The pool is re-created by redis-py in forked consumer processes
+        self.pool = redis.ConnectionPool(host=host, port=int(port), max_connections=max_connections)
+        self.client = redis.StrictRedis(connection_pool=self.pool)
+
+        self.deadline_key = deadline_key
+        self.upload_if_deadline_script = self.client.register_script(self.UPLOAD_IF_DEADLINE)
+        # Shared by the consumer threads
+        self.round_trips = 0
+        self.round_trips_lock = threading.Lock()
+
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+
+    def pipeline(self):
+        return self.client.pipeline(transaction=False)
+
+    def execute(self, pipe):
+        self.count_round_trip()
+        return pipe.execute()
+
+    def count_round_trip(self):
+        with self.round_trips_lock:
+            self.round_trips += 1
 
-    def __init__(self, host, port):
-        self.client = redis.StrictRedis(host, port)
-
-    def upload_to_redis(self, key, value):
-        pipe = self.client.pipeline()
-        if isinstance(value, dict):
-            pipe.hmset(key, value)
-        else:
-            pipe.set(key, value)
-        pipe.expire(key, self.EXPIRATION_TIME_IN_SECONDS)
-        # for row in rows:
-        #     pipe.set(KEY_HERE, VALUE_HERE)
-        #     pipe.expire(KEY_HERE, self.EXPIRATION_TIME_IN_SECONDS)
-        pipe.execute()
+    def reset_round_trips(self):
+        """
+        :return: the number of round trips since the last reset
+        """
+        with self.round_trips_lock:
+            round_trips, self.round_trips = self.round_trips, 0
+        return round_trips
+
+    def upload_to_redis(self, key, value, pipe=None):
+        self.upload_many({key: value}, pipe=pipe)
+
+    def upload_many(self, mapping, pipe=None):
+        """
+        Sets several keys (with expiry) in one round trip, dict values are written as hashes
+        """
+        own_pipe = pipe is None
+        if own_pipe:
+            pipe = self.pipeline()
+
+        for key, value in mapping.iteritems():
+            self.invalidate(key)
+            if isinstance(value, dict):
+                pipe.hmset(key, value)
+                pipe.expire(key, self.EXPIRATION_TIME_IN_SECONDS)
+            else:
+                pipe.set(key, value, ex=self.EXPIRATION_TIME_IN_SECONDS)
+
+        if own_pipe:
+            self.execute(pipe)
 
     def get_obj(self, key):
-        return self.client.get(key)
+        return self.get_many([key])[0]
+
+    def get_many(self, keys, inner_key=None):
+        """
+        Reads several keys in one round trip (none if all of them are cached)
+
+        :param inner_key: field to read from each of the keys when they are hashes, bypassing the cache
+        :return: the values in the order of keys, None for missing keys
+        """
+        if not keys:
+            return []
+        if inner_key is not None:
+            pipe = self.pipeline()
+            for key in keys:
+                pipe.hmget(key, inner_key)
+            return [values[0] for values in self.execute(pipe)]
+
+        values = [self.get_cached(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if missing:
+            self.count_round_trip()
+            fetched = dict(zip(missing, self.client.mget(missing)))
+            values = [fetched[key] if value is None else value for key, value in zip(keys, values)]
+            for key in missing:
+                self.set_cached(key, fetched[key])
+        return values
+
+    def get_hm_obj(self, key, inner_key, pipe=None):
+        return self._send(pipe, 'hmget', key, inner_key)
+
+    def delete(self, key, pipe=None):
+        self.delete_many([key], pipe=pipe)
+
+    def delete_many(self, keys, pipe=None):
+        if not keys:
+            return
+        for key in keys:
+            self.invalidate(key)
+        self._send(pipe, 'delete', *keys)
+
+    def add_deadline(self, key, deadline, pipe=None):
+        self._send(pipe, 'zadd', self.deadline_key, deadline, key)
+
+    def remove_deadline(self, key):
+        """
+        Sent right away rather than pipelined, its result is the claim on the batch
+
+        :return: True if the key was in the deadline index. Only one caller can get True for a given key, which is
+        used to decide which process gets to finalize a batch.
+        """
+        return self._send(None, 'zrem', self.deadline_key, key) == 1
+
+    def remove_deadlines(self, keys):
+        """
+        Claims several keys in one round trip, the result of each removal is kept (see remove_deadline)
+
+        :return: the keys that were in the deadline index
+        """
+        if not keys:
+            return []
+        pipe = self.pipeline()
+        for key in keys:
+            pipe.zrem(self.deadline_key, key)
+        return [key for key, removed in zip(keys, self.execute(pipe)) if removed == 1]
+
+    def upload_if_deadline(self, key, mapping):
+        """
+        Atomic check-and-set of a hash (with expiry) keyed by a member of the deadline index
+
+        :return: True if written, False if the key is no longer in the deadline index (i.e. it was claimed)
+        """
+        args = [key, self.EXPIRATION_TIME_IN_SECONDS]
+        for field, value in mapping.items():
+            args += [field, value]
+        self.count_round_trip()
+        return self.upload_if_deadline_script(keys=[self.deadline_key, key], args=args) == 1
+
+    def get_expired_deadlines(self, now, limit=100):
+        return self._send(None, 'zrangebyscore', self.deadline_key, 0, now, start=0, num=limit)
+
+    def get_cached(self, key):
+        if not self.cache_ttl:
+            return None
+        with self.cache_lock:
+            if key not in self.cache:
+                return None
+            value, expires_at = self.cache[key]
+            if expires_at < time.time():
+                del self.cache[key]
+                return None
+            return value
+
+    def set_cached(self, key, value):
+        if not self.cache_ttl or value is None:
+            return
+        with self.cache_lock:
+            self.cache.pop(key, None)
+            self.cache[key] = (value, time.time() + self.cache_ttl)
+            # Least recently written keys go first
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def invalidate(self, key):
+        if not self.cache_ttl:
+            return
+        with self.cache_lock:
+            self.cache.pop(key, None)
 
-    def get_hm_obj(self, key, inner_key):
-        return self.client.hmget(key, inner_key)
\ No newline at end of file
+    def _send(self, pipe, command, *args, **kwargs):
+        if pipe is not None:
+            getattr(pipe, command)(*args, **kwargs)
+            return None
+        self.count_round_trip()
+        return getattr(self.client, command)(*args, **kwargs)
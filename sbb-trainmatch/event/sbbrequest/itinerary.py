@@ -22,7 +22,7 @@ class Itinerary(object):
         # config parser
         self.config = CONFIG
 
-        # sbb response
+        # sbb response, only needed while the dataframes are being populated
         self.response = response
 
         # Tuple of (itinerary_ID, itinerary_node)
@@ -71,8 +71,9 @@ class Itinerary(object):
         # Populate data frames
         self.populate_dfs()
 
-        # Node position in the etree is no longer needed, drop them
+        # Node position in the etree is no longer needed, drop them along with the response they point into
         self.drop_nodes()
+        self.response = None
 
         # counts the number of stops
         self.eval_n_seg('nb_train_stops')
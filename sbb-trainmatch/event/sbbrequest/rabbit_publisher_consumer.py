@@ -1,10 +1,10 @@
 import logging
-import json
 import time
 
 import pika
 
-from vibebot.rabbit_consumer import RabbitConsumer
+from vibebot import codec
+from vibebot.rabbit_consumer import RabbitConsumer, Message
 
 logger = logging.getLogger(__name__)
 
@@ -12,28 +12,34 @@ logger = logging.getLogger(__name__)
 class RabbitPublisherConsumer(RabbitConsumer):
 
     def on_message(self, unused_channel, basic_deliver, properties, body):
+        message = Message(body, properties.content_type, properties.content_encoding)
         logger.info(
             u" [{}] received message #{} from exchange {}: {}".format(self.bot_id,
                                                                      basic_deliver.delivery_tag, self.exchange,
-                                                                     body.decode('utf-8')))
-        # Ack the message before processing to tell rabbit we got it.
-        # TODO before sending ack we should persist the message in a local queue to avoid the possibility of losing it
+                                                                     self.describe(message)))
+        # Ack the message before processing to tell rabbit we got it, once persisted in the WAL (if any)
+        wal_ids = self.persist_messages([message])
         self.acknowledge_message(basic_deliver.delivery_tag)
 
+        self.process_message(message)
+        self.mark_processed(wal_ids)
+
+    def process_message(self, message):
         try:
-            json_body = json.loads(body)
+            json_body = codec.decode(message.body, message.content_type, message.content_encoding)
             response_messages = self.callback_func(json_body)
 
             logger.info(" [{}] Sending {} response messages".format(self.bot_id, len(response_messages)))
 
-            for message in response_messages:
-                self._channel.basic_publish(exchange=message['exchange'], routing_key=message['queue'],
-                                            body=message['body'])
-                logger.info(" [{}] published message {}".format(self.bot_id, message))
+            for response in response_messages:
+                self._channel.basic_publish(exchange=response['exchange'], routing_key=response['queue'],
+                                            body=response['body'])
+                logger.info(" [{}] published message {}".format(self.bot_id, response))
 
         except ValueError:
             logger.exception(
-                " [{}] Invalid JSON received from exchange {}, dropping message".format(self.bot_id, self.exchange))
+                " [{}] Invalid {} message received from exchange {}, dropping message".format(
+                    self.bot_id, message.content_type or codec.JSON, self.exchange))
 
         except:
             # todo: better exception handling this is not good practice
@@ -60,7 +66,8 @@ class PubSubBot(object):
 
         # setup consumer
         self.consumer = RabbitPublisherConsumer(sub_creds['queue'], sub_creds['exchange'], sub_creds['callback_func'], sub_creds['rabbit_user'],
-                                       sub_creds['rabbit_pw'], sub_creds['rabbit_host'], sub_creds['rabbit_port'])
+                                       sub_creds['rabbit_pw'], sub_creds['rabbit_host'], sub_creds['rabbit_port'],
+                                       wal_dir=sub_creds.get('wal_dir'))
 
     def start(self):
         # this only sets up the consumer - the publisher needs to be called manually (typically before this starts)
@@ -4,7 +4,7 @@ import json
 
 import requests
 
-from vibepy.write_grafana import write_grafana
+from metrics.metrics import incr_grafana
 
 
 def query_sbb_api(params, CONFIG):
@@ -107,5 +107,5 @@ def fulltag(tag):
 def increment_grafana_api_call_counter(CONFIG):
 
     metrics = {'hit': 1}
-    write_grafana(CONFIG, metrics, output_type='incr')
+    incr_grafana(CONFIG, metrics)
     return
\ No newline at end of file
@@ -15,6 +15,7 @@ import pandas as pd
 import numpy as np
 
 # Vibe
+from vibebot import codec
 from rabbit_publisher_consumer import PublisherBot
 
 # SBB
@@ -56,6 +57,12 @@ def check_trip_cache(params, max_res, leave_at):
     return ret
 
 class SBBPublisherBot(PublisherBot):
+    def __init__(self, pub_creds):
+        super(SBBPublisherBot, self).__init__(pub_creds)
+        # Codec of the responses published from the cache, the SPF requests themselves are always JSON
+        self.content_type = pub_creds.get('content_type') or codec.JSON
+        self.content_encoding = pub_creds.get('content_encoding')
+
     def publish(self, trip, loop_through, exchange, routing_key):
         xml_str_fname = os.path.dirname(os.path.realpath(__file__)) + '/xml/sbb_api.xml'
         request_exchange, response_exchange = exchange[0], exchange[1]
@@ -68,13 +75,20 @@ class SBBPublisherBot(PublisherBot):
             trip.params[(max_res, leave_at)] = params
             properties = pika.BasicProperties(app_id='example-publisher',
                                               content_type='application/json',
+                                              priority=trip.priority,
                                               headers=msg)
             resp = check_trip_cache(params, max_res, leave_at)
             if resp:
                 logging.debug("Duplicate trip, sending XML response")
                 json_resp = {"uuid": trip.batch_id + "_" + trip.trip_id + "_" + max_res + "_" + leave_at, "xml": resp}
-                self.pub_channel.basic_publish(response_exchange, routing_key, json.dumps(json_resp, ensure_ascii=True).encode('utf8'),
-                                           properties)
+                resp_properties = pika.BasicProperties(app_id='example-publisher',
+                                                       content_type=self.content_type,
+                                                       content_encoding=self.content_encoding,
+                                                       priority=trip.priority,
+                                                       headers=msg)
+                self.pub_channel.basic_publish(response_exchange, routing_key,
+                                               codec.encode(json_resp, self.content_type, self.content_encoding),
+                                               resp_properties)
             else:
                 # channel.basic_publish('spf_request_exchange', 'spf_response_queue', json.dumps(msg, ensure_ascii=True), properties)
                 self.pub_channel.basic_publish(request_exchange, routing_key, json.dumps(msg, ensure_ascii=False).encode('utf8'),
@@ -92,9 +106,13 @@ class Trip(object):
 
         self.batch_id = batch_id
 
-        self.trip_link_df, self.itinerary_df, self.legs_df, self.segments_df = ids.initialize_all_empty_df()
+        # Requests are published with this routing key so that their responses come back to the bot owning the batch
+        self.routing_key = ''
+        # AMQP priority of the requests, set by the batch before publishing (see Batch.request_priority)
+        self.priority = None
 
-        self.itineraries = []
+        # Extracted tables of all itineraries processed so far, the Itinerary objects themselves are not kept
+        self.trip_link_df, self.itinerary_df, self.legs_df, self.segments_df = ids.initialize_all_empty_df()
 
         # self.request_params = [(6, True), (6, False), (-6, True), (-6, False)]
         # key here - 0 = Started, 1 = in process, 2 = finished
@@ -104,17 +122,73 @@ class Trip(object):
 
         self.params = dict()
 
-        self.pub_creds = {'rabbit_user': self.config.get('rabbit', 'rabbit_user'),
-                         'rabbit_pw': self.config.get('rabbit', 'rabbit_pw'),
-                         'rabbit_host': self.config.get('rabbit', 'rabbit_host'),
-                         'rabbit_port': int(self.config.get('rabbit', 'rabbit_port'))}
-
+        self.pub_creds = self.build_pub_creds(self.config)
+
+    @staticmethod
+    def build_pub_creds(CONFIG):
+        creds = {'rabbit_user': CONFIG.get('rabbit', 'rabbit_user'),
+                 'rabbit_pw': CONFIG.get('rabbit', 'rabbit_pw'),
+                 'rabbit_host': CONFIG.get('rabbit', 'rabbit_host'),
+                 'rabbit_port': int(CONFIG.get('rabbit', 'rabbit_port'))}
+        for option in ('content_type', 'content_encoding'):
+            if CONFIG.has_option('rabbit', 'message_' + option):
+                creds[option] = CONFIG.get('rabbit', 'message_' + option)
+        return creds
+
+    def to_state(self):
+        # Tuple keys are flattened into lists since msgpack maps can't be keyed by tuples
+        return {'trip': self.trip,
+                'trip_id': self.trip_id,
+                'batch_id': self.batch_id,
+                'routing_key': self.routing_key,
+                'trip_link_df': self.trip_link_df,
+                'itinerary_df': self.itinerary_df,
+                'legs_df': self.legs_df,
+                'segments_df': self.segments_df,
+                'request_params': [[k[0], k[1], v] for k, v in self.request_params.iteritems()],
+                'requests_processed': self.requests_processed,
+                'params': [[k[0], k[1], v] for k, v in self.params.iteritems()]}
+
+    @classmethod
+    def from_state(cls, state, CONFIG):
+        t = cls.__new__(cls)
+        t.config = CONFIG
+        t.trip = state['trip']
+        t.trip_id = state['trip_id']
+        t.batch_id = state['batch_id']
+        t.routing_key = state.get('routing_key', '')
+        t.priority = None
+        t.trip_link_df = state['trip_link_df']
+        t.itinerary_df = state['itinerary_df']
+        t.legs_df = state['legs_df']
+        t.segments_df = state['segments_df']
+        # Format version 1 kept the tables of each itinerary separately until complete_processing
+        for itin in state.get('itineraries', []):
+            t.append_itinerary_dfs(itin['trip_link_df'], itin['legs_df'], itin['segments_df'])
+        t.request_params = dict(((max_res, leave_at), v) for max_res, leave_at, v in state['request_params'])
+        t.requests_processed = state['requests_processed']
+        t.params = dict(((max_res, leave_at), v) for max_res, leave_at, v in state['params'])
+        t.pub_creds = cls.build_pub_creds(CONFIG)
+        return t
+
+    @classmethod
+    def from_legacy(cls, t, CONFIG):
+        """
+        Converts a Trip unpickled from a batch written before the state format. Its itineraries still hold the tables
+        that complete_processing used to concatenate, they are folded in as the format version 1 itineraries are.
+        """
+        state = dict(vars(t))
+        state['itineraries'] = [{'trip_link_df': i.trip_link_df, 'legs_df': i.legs_df, 'segments_df': i.segments_df}
+                                for i in getattr(t, 'itineraries', [])]
+        state['request_params'] = [[k[0], k[1], v] for k, v in t.request_params.iteritems()]
+        state['params'] = [[k[0], k[1], v] for k, v in t.params.iteritems()]
+        return cls.from_state(state, CONFIG)
 
     def publish(self, publish_params):
         # this is our little sub-pub bot that handles publishing requests and listening for responses
         bot = SBBPublisherBot(self.pub_creds)
 
-        bot.publish(self, publish_params, ["spf_request_exchange", "spf_response_exchange"], '')
+        bot.publish(self, publish_params, ["spf_request_exchange", "spf_response_exchange"], self.routing_key)
 
         # stop the publisher
         bot.stop_publisher()
@@ -131,12 +205,16 @@ class Trip(object):
 
         self.publish(publish_param)
 
-    def complete_processing(self):
-        # concat stuff
-        self.concat_trip_dfs()
-        self.concat_legs_dfs()
-        self.concat_seg_dfs()
+    def is_complete(self):
+        return self.requests_processed == len(self.request_params)
 
+    def skip_request(self, max_res, leave_at):
+        # SPF returned an error that won't go away by retrying, count the request as processed without itineraries
+        logging.debug("Skipping request {r} for trip {t}".format(r=(max_res, leave_at), t=self.trip_id))
+        self.requests_processed += 1
+        self.request_params[(max_res, leave_at)] = 2
+
+    def complete_processing(self):
         if not self.trip_link_df.empty:
             self.trip_link_df['vid'] = self.trip['vid']
             self.trip_link_df['mot_segment_id'] = self.trip['mot_segment_id']
@@ -148,6 +226,10 @@ class Trip(object):
         self.trip_link_df.set_index(['itinerary_id', 'leg_id', 'segment_id', ], inplace=True)
 
 
+    def release_dfs(self):
+        # Once scored the tables are no longer needed, don't carry them around in the batch state
+        self.trip_link_df, self.itinerary_df, self.legs_df, self.segments_df = ids.initialize_all_empty_df()
+
     def gen_param_seg(self, MaxResultNumber=3, leave_at=True, api_version='v2'):
         # Some parameters need a bit of reformatting
         params = {
@@ -234,24 +316,20 @@ class Trip(object):
         # Only add a new itinerary if there are any nodes
         if len(itinerary_nodes) != 0:
             new_itinerary = itinerary.Itinerary(itinerary_nodes, self.config, response)
-            self.itineraries.append(new_itinerary)
 
             # concat the itinerary df because we need it for future itineraries
             self.itinerary_df = pd.concat([self.itinerary_df, new_itinerary.itinerary_df])
+            self.append_itinerary_dfs(new_itinerary.trip_link_df, new_itinerary.legs_df, new_itinerary.segments_df)
 
         # we are done processing
         self.request_params[(max_res, leave_at)] = 2
 
 
 
-    def concat_trip_dfs(self):
-        self.trip_link_df = pd.concat([self.trip_link_df] + [x.trip_link_df for x in self.itineraries], ignore_index=True)
-
-    def concat_legs_dfs(self):
-        self.legs_df = pd.concat([self.legs_df] + [x.legs_df for x in self.itineraries])
-
-    def concat_seg_dfs(self):
-        self.segments_df = pd.concat([self.segments_df] + [x.segments_df for x in self.itineraries])
+    def append_itinerary_dfs(self, trip_link_df, legs_df, segments_df):
+        self.trip_link_df = pd.concat([self.trip_link_df, trip_link_df], ignore_index=True)
+        self.legs_df = pd.concat([self.legs_df, legs_df])
+        self.segments_df = pd.concat([self.segments_df, segments_df])
 
     def skip_duplicates_itineraries(self, itinerary_nodes, previous_itineraries_cr, response):
 
@@ -2,24 +2,28 @@ import logging
 import os
 import json
 import uuid
+import time
+import socket
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 
-from shapely.geometry.point import Point
-from shapely.wkt import loads
-
 import pandas as pd
 import numpy as np
-from geopy.distance import vincenty
 
 # redis
 from redis_client import RedisClient
 import pickle
+import state_codec
 
 from vibebot import EventBot
+from vibebot.exchange_callback import ExchangeCallback
 from vibepy.class_postgres import PostgresManager
 from vibepy.read_config import read_config
 
+import geodesic
 from batch import Batch
+from filters.geo_validity import load_geo_validity
 from traineval.output_to_postgres import update_postgres
 
 from sbbrequest import sbb_response
@@ -34,22 +38,156 @@ class ScheduleMatchingBot(EventBot):
 
     def __init__(self):
 
-        queues_callbacks = {
-            CONFIG.get('rabbit', 'rabbit_mot_exchange'): self.callback_new_mot,
-            "spf_response_exchange": self.callback_process_mot
-        }
+        # Sticky mode: the SPF requests of a batch are published with this instance's routing key so that their
+        # responses come back to its own queue, the batches then stay in memory and redis is only a checkpoint
+        self.sticky_batches = False
+        if CONFIG.has_option('rabbit', 'sticky_batches'):
+            self.sticky_batches = CONFIG.getboolean('rabbit', 'sticky_batches')
+        self.instance_id = socket.gethostname()
+        if CONFIG.has_option('rabbit', 'instance_id'):
+            self.instance_id = CONFIG.get('rabbit', 'instance_id')
+
+        # Lanes: the SPF responses of live and backfill batches are routed to separate queues (and consumers) so that
+        # a backfill doesn't delay live trips. Priorities: requests are published with a priority growing with the
+        # completion and age of their batch (see Batch.request_priority) and the response queues are priority queues
+        self.traffic_lanes = False
+        if CONFIG.has_option('rabbit', 'traffic_lanes'):
+            self.traffic_lanes = CONFIG.getboolean('rabbit', 'traffic_lanes')
+        self.max_priority = None
+        if CONFIG.has_option('rabbit', 'max_priority'):
+            self.max_priority = CONFIG.getint('rabbit', 'max_priority') or None
+
+        self.batches = dict()
+        self.batch_locks = dict()
+        self.batches_lock = threading.Lock()
+        self.checkpoint_times = dict()
+
+        # The MoT and SPF response loads are bursty and unrelated, each exchange is scaled on its own queue depth
+        mot_min, mot_max = self.read_consumer_bounds('mot')
+        # Backpressure when postgres/redis slow down, disabled unless the thresholds are set
+        max_latency_ms, max_error_rate = None, None
+        if CONFIG.has_option('rabbit', 'flow_max_latency_ms'):
+            max_latency_ms = CONFIG.getint('rabbit', 'flow_max_latency_ms')
+        if CONFIG.has_option('rabbit', 'flow_max_error_rate'):
+            max_error_rate = CONFIG.getfloat('rabbit', 'flow_max_error_rate')
+        queues_callbacks = [
+            ExchangeCallback(CONFIG.get('rabbit', 'rabbit_mot_exchange'),
+                             self.count_redis_round_trips(self.callback_new_mot, 'new_mot'),
+                             consumer_count=mot_min, min_consumers=mot_min, max_consumers=mot_max,
+                             max_latency_ms=max_latency_ms, max_error_rate=max_error_rate)
+        ]
+        traffic_classes = [Batch.LIVE, Batch.BACKFILL] if self.traffic_lanes else [Batch.LIVE]
+        for traffic_class in traffic_classes:
+            bounds_name = 'response' if traffic_class == Batch.LIVE else traffic_class + '_response'
+            response_min, response_max = self.read_consumer_bounds(bounds_name)
+            queues_callbacks.append(
+                ExchangeCallback("spf_response_exchange",
+                                 self.count_redis_round_trips(self.callback_process_mot, 'process_mot'),
+                                 consumer_count=response_min, min_consumers=response_min, max_consumers=response_max,
+                                 routing_key=self.response_routing_key(traffic_class),
+                                 queue_name=self.response_queue_name(traffic_class),
+                                 max_latency_ms=max_latency_ms, max_error_rate=max_error_rate,
+                                 max_priority=self.max_priority))
 
         # load geometries initially to be used for entire session
-        self.geoms = self.read_geo_valid()
+        self.geo_validity = load_geo_validity(CONFIG)
+        self.geoms = self.geo_validity.geoms
 
         # Queue on the exchange the bot are reading from
         # %%RABBIT_MOT_EXCHANGE%%-bot-%%SCHEDULE_MATCHING_BOT_ID%%
 
-        super(ScheduleMatchingBot, self).__init__('sched_matching', CONFIG, queues_callbacks)
-        self.redis_client = RedisClient(CONFIG.get('redis','redis_host'), CONFIG.get('redis','redis_port'))
+        # In memory batches have to be shared between the consumers, hence threads rather than processes
+        super(ScheduleMatchingBot, self).__init__('sched_matching', CONFIG, queues_callbacks,
+                                                  use_threading=self.sticky_batches)
+        redis_max_connections = RedisClient.DEFAULT_MAX_CONNECTIONS
+        if CONFIG.has_option('redis', 'max_connections'):
+            redis_max_connections = CONFIG.getint('redis', 'max_connections')
+        redis_cache_ttl = 0
+        if CONFIG.has_option('redis', 'cache_ttl'):
+            redis_cache_ttl = CONFIG.getint('redis', 'cache_ttl')
+        # Owned batches are only swept by their owner, which holds their latest state
+        deadline_key = RedisClient.DEADLINE_KEY
+        if self.sticky_batches:
+            deadline_key += ':' + self.instance_id
+        self.redis_client = RedisClient(CONFIG.get('redis','redis_host'), CONFIG.get('redis','redis_port'),
+                                        max_connections=redis_max_connections, cache_ttl=redis_cache_ttl,
+                                        deadline_key=deadline_key)
+
+        # Sticky mode only, minimum seconds between two checkpoints of the same batch
+        self.checkpoint_interval = 60
+        if CONFIG.has_option('redis', 'checkpoint_interval'):
+            self.checkpoint_interval = CONFIG.getint('redis', 'checkpoint_interval')
+
+        self.state_compression = 'zlib'
+        if CONFIG.has_option('redis', 'state_compression'):
+            self.state_compression = CONFIG.get('redis', 'state_compression')
+
+        # The raw SPF responses are not needed once extracted, only keep them in redis when asked to (e.g. debugging)
+        self.store_responses = False
+        if CONFIG.has_option('redis', 'store_responses'):
+            self.store_responses = CONFIG.getboolean('redis', 'store_responses')
+
+        # Batches still waiting on SPF responses after batch_timeout seconds are scored with the trips that completed
+        self.batch_timeout = 900
+        if CONFIG.has_option('redis', 'batch_timeout'):
+            self.batch_timeout = CONFIG.getint('redis', 'batch_timeout')
+        self.deadline_sweep_interval = 30
+        if CONFIG.has_option('redis', 'deadline_sweep_interval'):
+            self.deadline_sweep_interval = CONFIG.getint('redis', 'deadline_sweep_interval')
+
+        # Score each trip as soon as its SPF responses are in, batch metrics are still written once at the end
+        self.stream_trips = False
+        if CONFIG.has_option('params', 'STREAM_COMPLETED_TRIPS'):
+            self.stream_trips = CONFIG.getboolean('params', 'STREAM_COMPLETED_TRIPS')
 
         logger.info("Event bot created")
 
+    @staticmethod
+    def read_consumer_bounds(name):
+        """
+        :return: ([rabbit] <name>_min_consumers, <name>_max_consumers), one consumer by default
+        """
+        min_consumers = 1
+        if CONFIG.has_option('rabbit', name + '_min_consumers'):
+            min_consumers = CONFIG.getint('rabbit', name + '_min_consumers')
+        max_consumers = min_consumers
+        if CONFIG.has_option('rabbit', name + '_max_consumers'):
+            max_consumers = CONFIG.getint('rabbit', name + '_max_consumers')
+        return min_consumers, max_consumers
+
+    def response_routing_key(self, traffic_class):
+        """
+        :return: routing key of the SPF requests of a batch, their responses are published with it by SPF
+        """
+        keys = []
+        if self.sticky_batches:
+            keys.append(self.instance_id)
+        if self.traffic_lanes:
+            keys.append(traffic_class)
+        return '.'.join(keys)
+
+    def response_queue_name(self, traffic_class):
+        """
+        :return: None for the default queue, shared by all the instances and traffic classes
+        """
+        if not self.sticky_batches and not self.traffic_lanes:
+            return None
+        queue_name = 'spf_response_exchange-bot-{b}'.format(b=CONFIG.get('bot', 'sched_matching'))
+        if self.sticky_batches:
+            # The queue outlives the instance so that a restarted instance (same instance_id) picks up the responses
+            # sent in the meantime and resumes its batches from their checkpoint
+            queue_name += '-' + self.instance_id
+        if self.traffic_lanes:
+            queue_name += '-' + traffic_class
+        return queue_name
+
+    def start(self):
+        sweeper = threading.Thread(target=self.run_deadline_sweeper, name='deadline-sweeper')
+        sweeper.daemon = True
+        sweeper.start()
+
+        super(ScheduleMatchingBot, self).start()
+
 
     def callback_new_mot(self, json_body):
 
@@ -75,15 +213,23 @@ class ScheduleMatchingBot(EventBot):
             # we are going to write the error to a separate queue
             return []
 
-        b = Batch(batch_id, list_mot_id, loc_bounds, CONFIG, DB)
+        # Anything not flagged as backfill is live traffic
+        traffic_class = Batch.BACKFILL if json_body.get('traffic_class') == Batch.BACKFILL else Batch.LIVE
+        b = Batch(batch_id, list_mot_id, loc_bounds, CONFIG, DB, traffic_class=traffic_class)
 
         b.init_trips()
-        # we have to clear out the DB attr since it can't be pickled
-        b.DB = None
+        b.deadline = time.time() + self.batch_timeout
+        if self.sticky_batches:
+            with self.batches_lock:
+                self.batches[batch_id] = b
+            self.checkpoint_times[batch_id] = time.time()
         # now we are doing this in redis
-        self.redis_client.upload_to_redis(batch_id, {'status': 0, 'batch': pickle.dumps(b)})
+        pipe = self.redis_client.pipeline()
+        self.redis_client.upload_to_redis(batch_id, {'status': 0, 'batch': self.dump_batch(b)}, pipe=pipe)
+        self.redis_client.add_deadline(batch_id, b.deadline, pipe=pipe)
+        self.redis_client.execute(pipe)
         # send reqs
-        b.send_trip_requests()
+        b.send_trip_requests(self.response_routing_key(b.traffic_class), b.request_priority(self.max_priority))
 
         # Empty list when not sending any message out otherwise rabbit consumer doesn't like it
         return []
@@ -92,54 +238,59 @@ class ScheduleMatchingBot(EventBot):
         logging.debug("[received] new SBB response")
         status = 1
         try:
-            # first let's put this in redis
-            self.redis_client.upload_to_redis(json_body.get('uuid'), json_body.get('xml'))
             batch_id, trip_id, max_res, leave_at = json_body.get('uuid').split("_")
             if not batch_id:
                 return []
 
-            # get obj
-            # now in redis
-            b_binary = self.redis_client.get_hm_obj(batch_id, 'batch')[0]
-            if not b_binary:
-                logging.warning('batch not found ({bi})'.format(bi=batch_id))
-                return []
-            else:
-                b = pickle.loads(b_binary)
-                # now we can lock up this batch for processing
-                # we need to update DB
-                b.DB = DB
+            with self.batch_lock(batch_id):
+                b = self.get_batch(batch_id, json_body)
+                if b is None:
+                    logging.warning('batch not found ({bi})'.format(bi=batch_id))
+                    return []
 
                 # ok, let's see which trip this is
                 trip = b.trip_objs[trip_id]
                 if trip.request_params[(max_res, leave_at)] == 0:
                     # this request hasn't been processed yet
-                    resp = sbb_response.SBBResponse(json_body['xml'].encode('utf-8'))
+                    xml = json_body['xml']
+                    if isinstance(xml, unicode):
+                        # JSON bodies hold the XML as text, msgpack ones may carry the raw bytes
+                        xml = xml.encode('utf-8')
+                    resp = sbb_response.SBBResponse(xml)
                     good_to_go = resp.check_if_error()
-                    if good_to_go > 0:
-                        # we are either going to retry or skip
-                        if good_to_go == 2:
-                            return []  # skipping
-                        else:
-                            # we will republish the request
-                            trip.republish_req([(max_res, leave_at)])
-                            return []
-
-                    trip.build_single_itinerary(resp, max_res, leave_at)
-                    if trip.requests_processed == len(trip.request_params):
+                    if good_to_go == 1:
+                        # we will republish the request, ahead of the requests of newer batches
+                        trip.priority = b.request_priority(self.max_priority)
+                        trip.republish_req([(max_res, leave_at)])
+                        return []
+                    elif good_to_go == 2:
+                        # skipping, but the trip can still complete with its other requests
+                        trip.skip_request(max_res, leave_at)
+                    else:
+                        trip.build_single_itinerary(resp, max_res, leave_at)
+
+                    if trip.is_complete():
                         # we've processed everything
                         b.trips_processed += 1
                         trip.complete_processing()
+                        if self.stream_trips:
+                            # score it now rather than waiting on the slowest trip of the batch
+                            b.process_trip(trip)
 
                     if b.trips_processed == len(b.trip_objs):
-                        # we are done processing
+                        # we are done processing, unless the deadline sweeper claimed the batch in the meantime:
+                        # whoever removes the deadline finalizes the batch
+                        if not self.redis_client.remove_deadline(b.batch_id):
+                            logging.warning('batch {bi} already finalized, dropping it'.format(bi=b.batch_id))
+                            self.forget_batch(b.batch_id)
+                            return []
                         logging.debug("batch %s ready for processing" % b.batch_id)
                         b.process_trips()
                         status = 2
+                        if b.deadline and time.time() > b.deadline:
+                            self.statsd.incr('batch.late')
 
-                    # we need to write the updated obj back in redis
-                    b.DB = None  # bye, you can't be pickled
-                    self.redis_client.upload_to_redis(batch_id, {'status' : status, 'batch' : pickle.dumps(b)})
+                    self.save_batch(b, status)
 
         except Exception as e:
             logging.error(e)
@@ -150,23 +301,140 @@ class ScheduleMatchingBot(EventBot):
         del b
         return []
 
-    def read_geo_valid(self):
+    @contextmanager
+    def batch_lock(self, batch_id):
         """
-        :param CONFIG: The parsed config file
-        :return: A list of geometries (polygons) defining out geo valid regions
+        Serializes the consumer threads working on the same in memory batch, no-op when the batches live in redis
+        """
+        if not self.sticky_batches:
+            yield
+            return
+        with self.batches_lock:
+            lock = self.batch_locks.setdefault(batch_id, threading.Lock())
+        with lock:
+            yield
+
+    def get_batch(self, batch_id, json_body):
+        """
+        :return: the batch from memory if this bot owns it, otherwise from redis. None if the batch is unknown
         """
-        path = os.path.dirname(os.path.realpath(__file__))
-        filenames = CONFIG.get('geovalidity', 'VALID_REGION_WKT').split(',')
-        geoms = []
-        for filename in filenames:
-            filepath = path + '/filters/wkt/' + filename + '.wkt'
+        b = self.batches.get(batch_id)
+        if b is not None:
+            self.statsd.incr('batch.memory.hit')
+            if self.store_responses:
+                self.redis_client.upload_to_redis(json_body.get('uuid'), json_body.get('xml'))
+            return b
+
+        # get obj, storing the response in the same round trip if needed
+        pipe = self.redis_client.pipeline()
+        if self.store_responses:
+            self.redis_client.upload_to_redis(json_body.get('uuid'), json_body.get('xml'), pipe=pipe)
+        self.redis_client.get_hm_obj(batch_id, 'batch', pipe=pipe)
+        b_binary = self.redis_client.execute(pipe)[-1][0]
+        if not b_binary:
+            return None
+
+        b = self.load_batch(b_binary)
+        if self.sticky_batches:
+            # Resuming a batch after a restart, its responses received since the last checkpoint are lost and it will
+            # be finalized by the deadline sweeper if they were needed
+            self.statsd.incr('batch.memory.miss')
+            with self.batches_lock:
+                self.batches[batch_id] = b
+            self.checkpoint_times[batch_id] = time.time()
+        return b
+
+    def save_batch(self, b, status):
+        """
+        Writes the batch back to redis (status 2 once processed, its deadline already claimed by the caller). Batches
+        kept in memory are only checkpointed every checkpoint_interval seconds and forgotten once processed. Pending
+        batches are only written while they still have a deadline: once claimed by the sweeper they are dropped rather
+        than re-created without one.
+        """
+        if status == 2:
+            if self.sticky_batches:
+                self.forget_batch(b.batch_id)
+                self.redis_client.delete(b.batch_id)
+            else:
+                # we need to write the updated obj back in redis
+                self.redis_client.upload_to_redis(b.batch_id, {'status': status, 'batch': self.dump_batch(b)})
+            return
+
+        if self.sticky_batches:
+            if time.time() - self.checkpoint_times.get(b.batch_id, 0) < self.checkpoint_interval:
+                return
+            self.checkpoint_times[b.batch_id] = time.time()
+
+        if not self.redis_client.upload_if_deadline(b.batch_id, {'status': status, 'batch': self.dump_batch(b)}):
+            logging.warning('batch {bi} finalized in the meantime, dropping it'.format(bi=b.batch_id))
+            self.forget_batch(b.batch_id)
+
+    def forget_batch(self, batch_id):
+        with self.batches_lock:
+            self.batches.pop(batch_id, None)
+            self.batch_locks.pop(batch_id, None)
+        self.checkpoint_times.pop(batch_id, None)
+
+    def count_redis_round_trips(self, callback, callback_name):
+        def _inner(json_body):
+            try:
+                return callback(json_body)
+            finally:
+                self.statsd.incr('redis.round_trips.' + callback_name, self.redis_client.reset_round_trips())
+        return _inner
+
+    def run_deadline_sweeper(self):
+        while True:
+            time.sleep(self.deadline_sweep_interval)
+            try:
+                self.sweep_expired_batches()
+            except Exception as e:
+                logging.error(e)
+                logging.error('Unable to sweep expired batches')
+
+    def sweep_expired_batches(self):
+        # Several bots may be sweeping, whoever removes the deadline owns the batch
+        batch_ids = self.redis_client.remove_deadlines(self.redis_client.get_expired_deadlines(time.time()))
+        if not batch_ids:
+            return
+
+        # The states of the claimed batches not held in memory are read in a single round trip, they can't change
+        # anymore since pending batches are only written while they have a deadline
+        stored_ids = [batch_id for batch_id in batch_ids if batch_id not in self.batches]
+        stored = dict(zip(stored_ids, self.redis_client.get_many(stored_ids, inner_key='batch')))
+        # Late responses for these batches will find nothing and be dropped
+        self.redis_client.delete_many(batch_ids)
+
+        for batch_id in batch_ids:
             try:
-                f = open(filepath)
-                geoms.append(loads(f.read()))
-            except:
-                logging.critical('Could not read shapefile {filepath}'.format(filepath=filepath))
-                raise IOError
-        return geoms
+                with self.batch_lock(batch_id):
+                    b = self.batches.get(batch_id)
+                    if b is None and stored.get(batch_id):
+                        b = self.load_batch(stored[batch_id])
+
+                    if b is None:
+                        logging.warning('expired batch not found ({bi})'.format(bi=batch_id))
+                    else:
+                        incomplete_mot_id = b.finalize_incomplete()
+                        self.statsd.incr('batch.deadline.expired')
+                        self.statsd.incr('batch.deadline.incomplete_trips', len(incomplete_mot_id))
+                        if len(b.trip_objs) == 0:
+                            self.statsd.incr('batch.deadline.no_complete_trips')
+
+            except Exception as e:
+                logging.error(e)
+                logging.error('Unable to finalize expired batch ({bi})'.format(bi=batch_id))
+
+            self.forget_batch(batch_id)
+
+    def dump_batch(self, b):
+        return state_codec.dumps(b.to_state(), compression=self.state_compression)
+
+    def load_batch(self, b_binary):
+        if not state_codec.is_encoded(b_binary):
+            # Batches written before the state format was introduced, can be removed once they have expired from redis
+            return Batch.from_legacy(pickle.loads(b_binary), CONFIG, DB)
+        return Batch.from_state(state_codec.loads(b_binary), CONFIG, DB)
 
     def geo_valid(self, json_input):
         """
@@ -187,13 +455,11 @@ class ScheduleMatchingBot(EventBot):
             return [], []
 
         # Is within region of geovalidity
-        is_within = p.apply(lambda x: np.all([geom.contains(Point(x['start_lon'], x['start_lat'])) and
-                                              geom.contains(Point(x['end_lon'], x['end_lat'])) for geom in self.geoms]),
-                            axis=1).values
+        is_within = self.geo_validity.segments_within(p)
         # is greater than the min distance
-        is_gt_min_dist = p.apply(lambda x: vincenty((x['start_lat'], x['start_lon']),(x['end_lat'], x['end_lon'])).meters
-                                           > CONFIG.getint('geovalidity', 'MIN_DIST_BTW_PTS'),
-                            axis=1).values
+        is_gt_min_dist = geodesic.distance(p['start_lat'].values, p['start_lon'].values,
+                                           p['end_lat'].values, p['end_lon'].values) \
+            > CONFIG.getint('geovalidity', 'MIN_DIST_BTW_PTS')
         # If trips need to be discarded, log in in the failed trips table
         if any(~is_within) or any(~is_gt_min_dist):
             p['failure_cause'] = ''
@@ -0,0 +1,199 @@
+import struct
+import uuid
+import zlib
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import msgpack
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+
+# Every blob starts with MAGIC, the format version and the compression codec. Bump FORMAT_VERSION whenever the layout
+# of the state dictionaries produced by Batch/Trip.to_state() changes in a non backward compatible way.
+MAGIC = b'SMS'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('>3sBB')
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+COMPRESSION_CODES = {'none': COMPRESSION_NONE, 'zlib': COMPRESSION_ZLIB, 'zstd': COMPRESSION_ZSTD}
+
+# msgpack extension types
+EXT_FRAME = 1
+EXT_SERIES = 2
+EXT_TIMESTAMP = 3
+EXT_DATETIME = 4
+EXT_TIMEDELTA = 5
+EXT_UUID = 6
+
+# dtype kinds that are stored as raw numpy buffers (bool, ints, floats, complex, datetime64, timedelta64)
+BUFFER_KINDS = 'biufcMm'
+
+
+class StateFormatError(ValueError):
+    pass
+
+
+def dumps(state, compression='zlib'):
+    """
+    Serializes a state dictionary (see Batch.to_state) into a versioned binary blob. DataFrames and Series are stored
+    column by column as numpy buffers, everything else as msgpack.
+
+    :param state: dict of plain python values, DataFrames and Series
+    :param compression: one of 'none', 'zlib' or 'zstd' (falls back to zlib if the zstandard module is not installed)
+    :return: bytes
+    """
+
+    if compression == 'zstd' and zstd is None:
+        compression = 'zlib'
+    codec = COMPRESSION_CODES[compression]
+
+    payload = msgpack.packb(state, default=_default, use_bin_type=True)
+    if codec == COMPRESSION_ZLIB:
+        payload = zlib.compress(payload, 1)
+    elif codec == COMPRESSION_ZSTD:
+        payload = zstd.ZstdCompressor(level=3).compress(payload)
+
+    return HEADER.pack(MAGIC, FORMAT_VERSION, codec) + payload
+
+
+def loads(blob):
+    """
+    Inverse of dumps()
+
+    :param blob: bytes as produced by dumps()
+    :return: the state dictionary
+    """
+
+    if not is_encoded(blob):
+        raise StateFormatError('Not a serialized state blob')
+
+    _, version, codec = HEADER.unpack(blob[:HEADER.size])
+    if version > FORMAT_VERSION:
+        raise StateFormatError('Unsupported state format version {v}'.format(v=version))
+
+    payload = blob[HEADER.size:]
+    if codec == COMPRESSION_ZLIB:
+        payload = zlib.decompress(payload)
+    elif codec == COMPRESSION_ZSTD:
+        if zstd is None:
+            raise StateFormatError('State is zstd compressed but the zstandard module is not installed')
+        payload = zstd.ZstdDecompressor().decompress(payload)
+
+    return msgpack.unpackb(payload, ext_hook=_ext_hook, raw=False)
+
+
+def is_encoded(blob):
+    return blob is not None and blob[:len(MAGIC)] == MAGIC
+
+
+def encode_array(values):
+    values = np.asarray(values)
+    if values.dtype.kind in BUFFER_KINDS:
+        return {'dtype': values.dtype.str, 'buffer': np.ascontiguousarray(values).tobytes()}
+    return {'dtype': 'O', 'values': values.tolist()}
+
+
+def decode_array(encoded):
+    if encoded['dtype'] == 'O':
+        values = np.empty(len(encoded['values']), dtype=object)
+        values[:] = encoded['values']
+        return values
+    # frombuffer returns a read-only view on the message, copy so that pandas can modify it in place
+    return np.frombuffer(encoded['buffer'], dtype=np.dtype(str(encoded['dtype']))).copy()
+
+
+def encode_frame(df):
+    return {'columns': df.columns.tolist(),
+            'data': [encode_array(df.iloc[:, i].values) for i in range(df.shape[1])],
+            'index': _encode_index(df.index)}
+
+
+def decode_frame(encoded):
+    index = _decode_index(encoded['index'])
+    data = dict((i, decode_array(col)) for i, col in enumerate(encoded['data']))
+    df = pd.DataFrame(data, index=index, columns=range(len(encoded['data'])))
+    df.columns = encoded['columns']
+    return df
+
+
+def encode_series(s):
+    return {'name': s.name, 'values': encode_array(s.values), 'index': _encode_index(s.index)}
+
+
+def decode_series(encoded):
+    return pd.Series(decode_array(encoded['values']), index=_decode_index(encoded['index']), name=encoded['name'])
+
+
+def _encode_index(index):
+    if isinstance(index, pd.RangeIndex):
+        # Default index, no need to ship the values
+        if len(index) == 0:
+            return {'range': [0, 0, 1], 'names': [index.name]}
+        step = int(index[1] - index[0]) if len(index) > 1 else 1
+        return {'range': [int(index[0]), int(index[-1]) + step, step], 'names': [index.name]}
+    return {'levels': [encode_array(index.get_level_values(i).values) for i in range(index.nlevels)],
+            'names': list(index.names)}
+
+
+def _decode_index(encoded):
+    names = encoded['names']
+    if 'range' in encoded:
+        return pd.RangeIndex(*encoded['range'], name=names[0])
+    levels = [decode_array(level) for level in encoded['levels']]
+    if len(levels) == 1:
+        return pd.Index(levels[0], name=names[0])
+    return pd.MultiIndex.from_arrays(levels, names=names)
+
+
+def _pack(obj):
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def _unpack(data):
+    return msgpack.unpackb(data, ext_hook=_ext_hook, raw=False)
+
+
+def _default(obj):
+    # Order matters: pd.Timestamp is a datetime subclass and pd.NaT is a Timestamp-like object
+    if isinstance(obj, pd.DataFrame):
+        return msgpack.ExtType(EXT_FRAME, _pack(encode_frame(obj)))
+    if isinstance(obj, pd.Series):
+        return msgpack.ExtType(EXT_SERIES, _pack(encode_series(obj)))
+    if obj is pd.NaT or isinstance(obj, (pd.Timestamp, np.datetime64)):
+        ts = pd.Timestamp(obj)
+        return msgpack.ExtType(EXT_TIMESTAMP, _pack([ts.value, str(ts.tz) if ts.tz is not None else None]))
+    if isinstance(obj, datetime):
+        return msgpack.ExtType(EXT_DATETIME, _pack([obj.year, obj.month, obj.day, obj.hour, obj.minute,
+                                                    obj.second, obj.microsecond]))
+    if isinstance(obj, (timedelta, np.timedelta64)):
+        return msgpack.ExtType(EXT_TIMEDELTA, _pack(pd.Timedelta(obj).value))
+    if isinstance(obj, uuid.UUID):
+        return msgpack.ExtType(EXT_UUID, obj.bytes)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('Cannot serialize {t} into batch state'.format(t=type(obj)))
+
+
+def _ext_hook(code, data):
+    if code == EXT_FRAME:
+        return decode_frame(_unpack(data))
+    if code == EXT_SERIES:
+        return decode_series(_unpack(data))
+    if code == EXT_TIMESTAMP:
+        value, tz = _unpack(data)
+        ts = pd.Timestamp(value)
+        return ts.tz_localize('UTC').tz_convert(tz) if tz is not None and ts is not pd.NaT else ts
+    if code == EXT_DATETIME:
+        return datetime(*_unpack(data))
+    if code == EXT_TIMEDELTA:
+        return pd.Timedelta(_unpack(data))
+    if code == EXT_UUID:
+        return uuid.UUID(bytes=data)
+    return msgpack.ExtType(code, data)
@@ -4,9 +4,13 @@ import logging
 try:
     from ..dbutil.temptable_template import temptable_template
     from ..filters.order import order_filter
+    from .route_cache import get_route_cache
+    from .route_distance import calc_point_distances
 except:
     from dbutil.temptable_template import temptable_template
     from filters.order import order_filter
+    from route_cache import get_route_cache
+    from route_distance import calc_point_distances
 
 def calc_distances(trips, itineraries, legs, segments, trip_link, DB, CONFIG):
     """
@@ -33,15 +37,23 @@ def calc_distances(trips, itineraries, legs, segments, trip_link, DB, CONFIG):
     # trip.
     # segments_joined = buffer_startend_time(segments_joined, CONFIG) # Now done after the SBB API CALL
 
-    # What we do here is add all the route information to a temporary table (see the temporarysegments query),
-    # run the distance query which does the requisite joins to calculate the distances to the correct train route geom.
-    sql = DB.get_query('temporarysegments', __file__)
-    sql = temptable_template(segments_joined.reset_index()[
-                                 ['segment_id', 'vid', 'route_name', 'agency_id', 'time_start', 'time_end',
-                                  'stop_id_start', 'stop_id_end']], sql, DB)
-    sql += DB.get_query('distance', __file__)
-
-    distances = DB.postgres2pandas(sql)
+    engine = 'sql'
+    if CONFIG.has_option('params', 'DISTANCE_ENGINE'):
+        engine = CONFIG.get('params', 'DISTANCE_ENGINE')
+
+    if engine == 'numpy':
+        # Only the location points come from the database, see route_distance.py
+        distances = calc_point_distances(segments_joined.reset_index(), DB, get_route_cache(CONFIG))
+    else:
+        # What we do here is add all the route information to a temporary table (see the temporarysegments query), run
+        # the distance query which does the requisite joins to calculate the distances to the correct train route geom.
+        sql = DB.get_query('temporarysegments', __file__)
+        sql = temptable_template(segments_joined.reset_index()[
+                                     ['segment_id', 'vid', 'route_name', 'agency_id', 'time_start', 'time_end',
+                                      'stop_id_start', 'stop_id_end']], sql, DB)
+        sql += DB.get_query('distance', __file__)
+
+        distances = DB.postgres2pandas(sql)
 
     points = distances.merge(trip_link.reset_index(), on='segment_id')
     points = points.merge(trips.reset_index(), on='mot_segment_id')
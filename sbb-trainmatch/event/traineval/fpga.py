@@ -2,7 +2,11 @@ import pandas as pd
 import numpy as np
 import logging
 
-from geopy.distance import vincenty
+try:
+    import geodesic
+except ImportError:
+    # Imported through the event package (tests) rather than from the event directory
+    from event import geodesic
 
 
 # Fake Point Generation Algorithm
@@ -23,7 +27,10 @@ def fpga(points, point_meta, legs, segments, trip_link, DB, n=3):
                                  legs[['time_end', 'stop_id_end']].reset_index().rename(columns=new_col_name)],
                                 ignore_index=True, axis=0)
     reformated_legs = pd.merge(reformated_legs, stops_position, left_on='stop_id', right_on='stop_id')
-    reformated_legs[['lat', 'lon', 'distance']] = reformated_legs.apply(lambda x: approx_edge_position(x, points), axis=1)
+    lat, lon, distance = approx_edge_positions(reformated_legs, points)
+    reformated_legs['lat'] = lat
+    reformated_legs['lon'] = lon
+    reformated_legs['distance'] = distance
     # Create point entries
     # points -- Point_id, lat, lon, time, horizontal_accuracy, within_mot_segment
     # point_meta -- segment_id, point_id, distance, ooo_outlier, is_long_stop
@@ -57,20 +64,45 @@ def fpga(points, point_meta, legs, segments, trip_link, DB, n=3):
     return points, point_meta
 
 
-def approx_edge_position(x, points, n=3):
-    # Initial selection of only the n nearest point in time
-    points_subset = points.iloc[np.abs(points['time'] - x['time']).argsort().iloc[:n],:]
-    # Select best point of the subset using selection_criterion()
-    xy = points_subset.iloc[points_subset.apply(lambda p: selection_criterion(x, p), axis=1).argsort().iloc[0], :]
-    # Need to return a serie for the .apply() method calling the .iloc[0] function
-    xy = xy[['lat','lon']]
-    # In case selection criterion is not exclusively distance
-    xy['distance'] = vincenty((x['lat'], x['lon']), (xy['lat'], xy['lon'])).meters
-    return xy
+def approx_edge_positions(legs, points, n=3):
+    """
+    For each leg start/end: initial selection of the n points nearest in time, then selection of the point of the
+    subset nearest to the station. Done for all the leg ends at once.
 
+    :param legs: DataFrame of the leg ends with their time and the lat/lon of their station
+    :return: lat, lon and distance to the station (meters) of the selected points, arrays aligned with legs
+    """
+    point_times = time_values(points['time'].values)
+    order = np.argsort(point_times, kind='mergesort')
+    sorted_times = point_times[order]
+    leg_times = time_values(legs['time'].values)
 
-def selection_criterion(x, p):
-    # t = np.abs(p['time'] - x['time'])
-    y = vincenty((x['lat'], x['lon']), (p['lat'], p['lon'])).meters  # Vincenty is a more precise great circle calc.
-    # print (t,t/np.timedelta64(1,'h')*speed,y)
-    return y
+    # The n nearest points in time are among the n points before and the n points after the leg end time
+    pos = np.searchsorted(sorted_times, leg_times)
+    window = pos[:, None] + np.arange(-n, n)[None, :]
+    valid = (window >= 0) & (window < len(sorted_times))
+    window = np.clip(window, 0, len(sorted_times) - 1)
+    time_diff = np.abs(sorted_times[window] - leg_times[:, None]).astype(float)
+    time_diff[~valid] = np.inf
+
+    rows = np.arange(len(leg_times))[:, None]
+    nearest = np.argsort(time_diff, axis=1, kind='mergesort')[:, :n]
+    candidates = order[window[rows, nearest]]
+    lat = points['lat'].values.astype(float)[candidates]
+    lon = points['lon'].values.astype(float)[candidates]
+    distance = geodesic.distance(legs['lat'].values[:, None], legs['lon'].values[:, None], lat, lon)
+    distance[~valid[rows, nearest]] = np.inf
+
+    best = np.argmin(distance, axis=1)
+    rows = rows[:, 0]
+    return lat[rows, best], lon[rows, best], distance[rows, best]
+
+
+def time_values(times):
+    # Comparable numbers (ns for timestamps)
+    times = np.asarray(times)
+    if times.dtype.kind == 'O':
+        times = pd.to_datetime(times).values
+    if times.dtype.kind == 'M':
+        return times.astype('int64')
+    return times.astype(float)
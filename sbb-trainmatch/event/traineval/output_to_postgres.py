@@ -330,6 +330,18 @@ def save_failed_trips(list_mot_id, trips, trip_link, DB):
     return
 
 
+def save_incomplete_trips(list_mot_id, DB):
+    failed_trips = pd.DataFrame([(idx, 'SPF responses missing at batch deadline', datetime.utcnow())
+                                 for idx in list_mot_id],
+                                columns=['mot_segment_id', 'failure_cause', 'datetime_created'])
+
+    if failed_trips.empty:
+        return
+
+    update_postgres(failed_trips, 'train_trips_failed', DB)
+    return
+
+
 def clear_reprocessed_trips(train_trips, DB):
     sql_var = {'bfi': train_trips.bound_from_id.tolist()}
     sql_query = DB.get_query('clear_reprocessed_trips', __file__)
@@ -0,0 +1,219 @@
+"""
+Process wide cache of the train route geometries (route_geoms of the train_routes of a route name, agency, start and
+end station), shared by the distance (route_distance.py) and order filter (filters/order.py) stages so that the
+geometries are queried once rather than joined for every batch. Each route is kept with its linear referencing
+precomputed: the cumulative planar length of the EPSG:4326 line (fractions of ST_LINEINTERPOLATEPOINT), its LV95
+projection with the cumulative distance in meters, and a simplified version of the projection to locate points on.
+"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from shapely import wkt
+from shapely.geometry import LineString
+
+try:
+    import geodesic
+except ImportError:
+    # Imported through the event package (tests) rather than from the event directory
+    from event import geodesic
+
+ROUTE_KEY = ['route_name', 'agency_id', 'stop_id_start', 'stop_id_end']
+
+# Meters, tolerance of the simplified line used to locate points
+SIMPLIFY_TOLERANCE = 10.0
+# Upper bound of the points x line segments distance matrix computed at once by locate
+LOCATE_CHUNK_SIZE = 1000000
+
+# Created on first use by get_route_cache
+ROUTE_CACHE = None
+
+
+def route_key_hash(key):
+    """
+    :param key: ROUTE_KEY tuple
+    :return: hash of the route key, the key of the cache
+    """
+    parts = [k if isinstance(k, bytes) else u'{}'.format(k).encode('utf-8') for k in key]
+    return hashlib.md5(b'\x1f'.join(parts)).hexdigest()
+
+
+def cumulative_length(x, y):
+    return np.concatenate([[0.0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))])
+
+
+class RouteGeometry(object):
+    """
+    A route linestring with its linear referencing
+    """
+
+    def __init__(self, lon, lat, simplify_tolerance=SIMPLIFY_TOLERANCE):
+        self.lon = np.asarray(lon, dtype=float)
+        self.lat = np.asarray(lat, dtype=float)
+        # Planar length in degrees, the fractions of ST_LINEINTERPOLATEPOINT on the EPSG:4326 geometry
+        self.cumlen = cumulative_length(self.lon, self.lat)
+
+        self.east, self.north = geodesic.to_lv95(self.lat, self.lon)
+        self.cumdist = cumulative_length(self.east, self.north)
+
+        if len(self.lon) > 2 and simplify_tolerance:
+            simplified = LineString(np.column_stack([self.east, self.north]))
+            simplified = simplified.simplify(simplify_tolerance, preserve_topology=False)
+            self.simplified_east, self.simplified_north = [np.asarray(c) for c in simplified.xy]
+        else:
+            self.simplified_east, self.simplified_north = self.east, self.north
+        self.simplified_cumdist = cumulative_length(self.simplified_east, self.simplified_north)
+
+    @classmethod
+    def from_wkt(cls, geom_wkt, simplify_tolerance=SIMPLIFY_TOLERANCE):
+        lon, lat = wkt.loads(geom_wkt).xy
+        return cls(lon, lat, simplify_tolerance)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.lon, self.lat, self.cumlen, self.east, self.north, self.cumdist,
+                                      self.simplified_east, self.simplified_north, self.simplified_cumdist))
+
+    @property
+    def length(self):
+        """
+        :return: length in meters of the LV95 projection
+        """
+        return self.cumdist[-1]
+
+    def interpolate(self, frac):
+        """
+        :return: (lon, lat) arrays of the points at each fraction of the length of the line, as ST_LINEINTERPOLATEPOINT
+        """
+        position = np.clip(frac, 0, 1) * self.cumlen[-1]
+        return np.interp(position, self.cumlen, self.lon), np.interp(position, self.cumlen, self.lat)
+
+    def locate(self, lat, lon):
+        """
+        Linear referencing of points on the simplified line, the ordering of ST_LINELOCATEPOINT
+
+        :return: array of the distance (meters) along the simplified line of the nearest point of each point
+        """
+        east, north = geodesic.to_lv95(lat, lon)
+        east, north = np.atleast_1d(east), np.atleast_1d(north)
+        x0, y0 = self.simplified_east[:-1], self.simplified_north[:-1]
+        dx, dy = np.diff(self.simplified_east), np.diff(self.simplified_north)
+        seg_len2 = dx ** 2 + dy ** 2
+        if len(seg_len2) == 0:
+            return np.zeros(len(east))
+
+        position = np.empty(len(east))
+        chunk = max(1, LOCATE_CHUNK_SIZE // len(seg_len2))
+        for start in range(0, len(east), chunk):
+            px, py = east[start:start + chunk, None], north[start:start + chunk, None]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = np.where(seg_len2 > 0, ((px - x0) * dx + (py - y0) * dy) / seg_len2, 0.0)
+            t = np.clip(t, 0, 1)
+            d2 = (x0 + t * dx - px) ** 2 + (y0 + t * dy - py) ** 2
+            nearest = np.argmin(d2, axis=1)
+            rows = np.arange(len(nearest))
+            position[start:start + chunk] = (self.simplified_cumdist[nearest] +
+                                             t[rows, nearest] * np.sqrt(seg_len2[nearest]))
+        return position
+
+
+class RouteCache(object):
+    """
+    The RouteGeometry of each route key, least recently used routes evicted beyond max_bytes, and the coordinates of
+    the stations for the straight line fallback of route_distance.py
+    """
+
+    def __init__(self, max_bytes=64 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # route key hash -> list of RouteGeometry, empty if the key has no train route
+        self.routes = OrderedDict()
+        # stop_id_parent -> (lon, lat), None if unknown
+        self.stations = {}
+        self.lock = threading.Lock()
+
+    def lines(self, keys, DB):
+        """
+        :param keys: list of ROUTE_KEY tuples
+        :return: dict of the RouteGeometry list of each key
+        """
+        hashes = dict((k, route_key_hash(k)) for k in set(keys))
+        with self.lock:
+            missing = [k for k, h in hashes.items() if h not in self.routes]
+            cached = dict((k, self.get(h)) for k, h in hashes.items() if h in self.routes)
+
+        if missing:
+            cached.update(self.load(missing, DB))
+        return cached
+
+    def get(self, key_hash):
+        # Most recently used last
+        lines = self.routes.pop(key_hash)
+        self.routes[key_hash] = lines
+        return lines
+
+    def load(self, keys, DB):
+        sql = DB.get_query('route_geometries', __file__)
+        params = dict((c, [k[i] for k in keys]) for i, c in enumerate(ROUTE_KEY))
+        geoms = DB.postgres2pandas(sql, params=params).drop_duplicates(ROUTE_KEY + ['geom_id'])
+
+        found = dict((k, []) for k in keys)
+        for row in geoms.itertuples(index=False):
+            found[tuple(getattr(row, c) for c in ROUTE_KEY)].append(RouteGeometry.from_wkt(row.wkt))
+        logging.info('Loaded the geometries of {n} train routes'.format(n=len(keys)))
+
+        with self.lock:
+            for key, lines in found.items():
+                key_hash = route_key_hash(key)
+                if key_hash in self.routes:
+                    self.nbytes -= sum(line.nbytes for line in self.routes.pop(key_hash))
+                self.routes[key_hash] = lines
+                self.nbytes += sum(line.nbytes for line in lines)
+            self.evict()
+        return found
+
+    def evict(self):
+        while self.nbytes > self.max_bytes and len(self.routes) > 1:
+            _, lines = self.routes.popitem(last=False)
+            self.nbytes -= sum(line.nbytes for line in lines)
+
+    def station_line(self, stop_id_start, stop_id_end, DB):
+        """
+        :return: straight RouteGeometry between the stations, None if either is unknown
+        """
+        self.load_stations([stop_id_start, stop_id_end], DB)
+        with self.lock:
+            start, end = self.stations[stop_id_start], self.stations[stop_id_end]
+        if start is None or end is None:
+            return None
+        return RouteGeometry([start[0], end[0]], [start[1], end[1]])
+
+    def load_stations(self, stop_ids, DB):
+        """
+        Queries the coordinates of the stations which aren't known yet
+        """
+        with self.lock:
+            missing = list(set(s for s in stop_ids if s not in self.stations))
+        if not missing:
+            return
+        sql = DB.get_query('station_coordinates', __file__)
+        stations = DB.postgres2pandas(sql, params={'stop_id': missing})
+        found = dict((s, None) for s in missing)
+        found.update(zip(stations['stop_id_parent'], zip(stations['lon'], stations['lat'])))
+        with self.lock:
+            self.stations.update(found)
+
+
+def get_route_cache(CONFIG):
+    """
+    :return: the process wide RouteCache, of at most ROUTE_CACHE_MB megabytes
+    """
+    global ROUTE_CACHE
+    if ROUTE_CACHE is None:
+        max_mb = 64
+        if CONFIG.has_option('params', 'ROUTE_CACHE_MB'):
+            max_mb = CONFIG.getint('params', 'ROUTE_CACHE_MB')
+        ROUTE_CACHE = RouteCache(max_mb * 1024 ** 2)
+    return ROUTE_CACHE
@@ -0,0 +1,94 @@
+"""
+In process alternative to distance.sql: the database only returns the location points of the segments, their distance
+to the train route is computed here from the route geometries of the RouteCache.
+"""
+import numpy as np
+import pandas as pd
+
+try:
+    import geodesic
+except ImportError:
+    # Imported through the event package (tests) rather than from the event directory
+    from event import geodesic
+
+try:
+    from ..dbutil.temptable_template import temptable_template
+    from .route_cache import ROUTE_KEY
+except:
+    from dbutil.temptable_template import temptable_template
+    from route_cache import ROUTE_KEY
+
+SEGMENT_COLUMNS = ['segment_id', 'vid', 'route_name', 'agency_id', 'time_start', 'time_end', 'stop_id_start',
+                   'stop_id_end']
+DISTANCE_COLUMNS = ['segment_id', 'horizontal_accuracy', 'distance', 'time', 'lat', 'lon', 'point_id']
+
+
+def segment_lines(segments, route_cache, DB):
+    """
+    The lines of each segment: its train routes, or the straight line between its stations if it has none
+
+    :return: (DataFrame of segment_id and line_id, list of RouteGeometry indexed by line_id)
+    """
+    keys = [tuple(k) for k in segments[ROUTE_KEY].values]
+    routes = route_cache.lines(keys, DB)
+    # Stations of all the segments without train route at once
+    route_cache.load_stations([s for k in keys if not routes[k] for s in k[2:]], DB)
+
+    lines, segment_ids, line_ids = [], [], []
+    line_index = {}
+    for segment_id, key in zip(segments['segment_id'], keys):
+        key_lines = routes[key] or [route_cache.station_line(key[2], key[3], DB)]
+        for line in key_lines:
+            if line is None:
+                continue
+            if id(line) not in line_index:
+                line_index[id(line)] = len(lines)
+                lines.append(line)
+            segment_ids.append(segment_id)
+            line_ids.append(line_index[id(line)])
+
+    return pd.DataFrame({'segment_id': segment_ids, 'line_id': line_ids}), lines
+
+
+def calc_point_distances(segments, DB, route_cache):
+    """
+    Same output as the temporarysegments.sql and distance.sql queries: the distance between each location point of a
+    segment and the point of its train route at the same fraction of the segment duration
+
+    :param segments: DataFrame with the SEGMENT_COLUMNS
+    :param DB: An instance of the PostgresManager class
+    :param route_cache: RouteCache of the route geometries
+    :return: DataFrame with the DISTANCE_COLUMNS
+    """
+
+    # One segment per vid, route and times as the DISTINCT of distance.sql
+    segments = segments[SEGMENT_COLUMNS].drop_duplicates(['vid'] + ROUTE_KEY + ['time_start', 'time_end'])
+    if segments.empty:
+        return pd.DataFrame(columns=DISTANCE_COLUMNS)
+
+    sql = DB.get_query('temporarysegments', __file__)
+    sql = temptable_template(segments, sql, DB)
+    sql += DB.get_query('segment_locations', __file__)
+    points = DB.postgres2pandas(sql)
+    if points.empty:
+        return pd.DataFrame(columns=DISTANCE_COLUMNS)
+
+    seg_lines, lines = segment_lines(segments, route_cache, DB)
+    points = pd.merge(points, segments[['segment_id', 'time_start', 'time_end']], on='segment_id')
+    points = pd.merge(points, seg_lines, on='segment_id', how='left')
+
+    # Fraction of the segment duration, 1 if it has none
+    time_start = pd.to_datetime(points['time_start'])
+    elapsed = (pd.to_datetime(points['time']) - time_start).values / np.timedelta64(1, 's')
+    duration = (pd.to_datetime(points['time_end']) - time_start).values / np.timedelta64(1, 's')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(duration != 0, elapsed / duration, 1.0)
+
+    route_lon = np.full(points.shape[0], np.nan)
+    route_lat = np.full(points.shape[0], np.nan)
+    for line_id, idx in points.groupby('line_id').indices.items():
+        route_lon[idx], route_lat[idx] = lines[int(line_id)].interpolate(frac[idx])
+
+    points['distance'] = geodesic.distance(points['lat'].values, points['lon'].values, route_lat, route_lon)
+
+    return points[DISTANCE_COLUMNS].reset_index(drop=True)
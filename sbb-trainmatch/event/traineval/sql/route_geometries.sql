@@ -0,0 +1,18 @@
+-- Train route geometries of (route name, agency, start and end station) keys, cached by route_distance.py
+SELECT
+    r.route_name,
+    r.agency_id,
+    r.stop_id_start,
+    r.stop_id_end,
+    train_routes.geom_id,
+    ST_AsText(route_geoms.geom) AS wkt
+FROM unnest(%(route_name)s, %(agency_id)s, %(stop_id_start)s, %(stop_id_end)s)
+    AS r(route_name, agency_id, stop_id_start, stop_id_end)
+JOIN <POSTGRES_SCHEMA>.train_routes ON (
+    train_routes.route_long_name=r.route_name AND
+    train_routes.agency_id=r.agency_id AND
+    train_routes.stop_id_start_parent=r.stop_id_start AND
+    train_routes.stop_id_end_parent=r.stop_id_end
+)
+JOIN <POSTGRES_SCHEMA>.route_geoms ON (train_routes.geom_id=route_geoms.geom_id)
+;
@@ -0,0 +1,15 @@
+-- Location points of each segment of temp_segments (see temporarysegments.sql), the same as distance.sql but without
+-- the distances, computed in process by route_distance.py
+SELECT
+    temp_segments.segment_id,
+    locations.horizontal_accuracy,
+    locations.datetime_created AT TIME ZONE 'Europe/Zurich' as time,
+    ST_Y(coordinate) as lat,
+    ST_X(coordinate) as lon,
+    locations.id as point_id
+FROM temp_segments
+JOIN <POSTGRES_SCHEMA>.locations ON (
+    locations.vid=temp_segments.vid AND
+    locations.datetime_created>(temp_segments.time_start::timestamp AT TIME ZONE 'Europe/Zurich') AND
+    locations.datetime_created<=(temp_segments.time_end::timestamp AT TIME ZONE 'Europe/Zurich')
+);
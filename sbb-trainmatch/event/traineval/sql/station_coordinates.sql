@@ -0,0 +1,10 @@
+-- One stop of each parent station, end of the straight line used by route_distance.py when a segment has no route
+-- geometry (the stationgeom of distance.sql)
+SELECT DISTINCT ON (stop_id_parent)
+    stop_id_parent,
+    ST_Y(ST_Transform(stop,4326)) AS lat,
+    ST_X(ST_Transform(stop,4326)) AS lon
+FROM <POSTGRES_SCHEMA_PROVIDER>.stops
+WHERE stop_id_parent = ANY( %(stop_id)s )
+ORDER BY stop_id_parent, stop_id
+;
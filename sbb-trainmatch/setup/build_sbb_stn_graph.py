@@ -3,11 +3,16 @@ import numpy as np
 from scipy.sparse.csgraph import dijkstra
 
 
-def build_stn_graph(fpath_gtfs, fname_out=None):
+# Number of hops of disconnected stations in the hop matrix (uint8), see event/getstops/hop_matrix.py
+DISCONNECTED = 255
+
+
+def build_stn_graph(fpath_gtfs, fname_out=None, fname_matrix=None):
     ''' Uses the two following GTFS files:
         - transfers.txt
         - stop_times.txt
     that are found in the fpath_gtfs directory
+    If fname_matrix is given, also saves the hop matrix read by event/getstops/hop_matrix.py
     '''
 
     # edges between different station IDs that are connected
@@ -41,6 +46,8 @@ def build_stn_graph(fpath_gtfs, fname_out=None):
     # Disconnected stations are assigned a -1 distance for easy filtering out (rather than an arbitrary large number)
     dj[np.logical_or(np.isinf(dj), np.isnan(dj))] = -1
 
+    if fname_matrix: save_hop_matrix(dj, unique_parent_id, fname_matrix)
+
     # Converts into a pandas dataframe for convenient stacking of the n by n matrix into n*(n-1) rows (one per i,j pair)
     dj_df = pd.DataFrame(dj.astype(int), columns=unique_parent_id, index=unique_parent_id).stack().reset_index()
 
@@ -50,6 +57,24 @@ def build_stn_graph(fpath_gtfs, fname_out=None):
     return dj_df
 
 
+def save_hop_matrix(dj, station_ids, fname_matrix):
+    """
+    Compact, memory-mappable alternative to the stn_hops table: fname_matrix.npy holds the n by n uint8 matrix of hops
+    (DISCONNECTED for disconnected stations, capped at DISCONNECTED - 1) and fname_matrix.stations.txt the station ID
+    of each row/column, one per line
+
+    :param dj: (np.array) n by n shortest number of hops, -1 for disconnected stations
+    :param station_ids: (list) station ID of each row/column of dj
+    :param fname_matrix: (str) Path including file name, without extension, of the two files
+    """
+    matrix = np.clip(dj, 0, DISCONNECTED - 1).astype(np.uint8)
+    matrix[dj < 0] = DISCONNECTED
+    np.save(fname_matrix + '.npy', matrix)
+
+    with open(fname_matrix + '.stations.txt', 'w') as text_file:
+        text_file.write('\n'.join(station_ids) + '\n')
+
+
 def create_table(table_name, schema, fname_out=None):
     """
     Table creation statement
@@ -83,11 +108,12 @@ if __name__ == "__main__":
     fpath_gtfs = 'gtfs_train_file_path/'
     fname_out_graph = fpath_gtfs+'station_ij_dist.csv'
     fname_out_table = fpath_gtfs + 'create_stn_hops_table.sql'
+    fname_out_matrix = fpath_gtfs + 'stn_hops'
     table_name = 'stn_hops'
     schema = 'sbb'
 
     # Build and save the graph locally
-    build_stn_graph(fpath_gtfs, fname_out=fname_out_graph)
+    build_stn_graph(fpath_gtfs, fname_out=fname_out_graph, fname_matrix=fname_out_matrix)
 
     # Table creation statement with appropriate schemas
     create_table(table_name, schema, fname_out=fname_out_table)
@@ -5,6 +5,8 @@ import pytest
 import pandas as pd
 
 from event.batch import Batch
+from event.sbbrequest.trip import Trip
+import event.sbbrequest.init_data_struct as ids
 from tests.data_structures import TRIPS_DF, TRIP_LINK_DF, ITINERARY_DF, LEGS_DF, SEGMENTS_DF
 
 class BatchTest(unittest.TestCase):
@@ -16,9 +18,12 @@ class BatchTest(unittest.TestCase):
     def setUp(self):
         self.db = Mock()
         self.config = Mock()
+        patcher = patch("event.batch.observe_stage")
+        self.observe_stage = patcher.start()
+        self.addCleanup(patcher.stop)
         with patch("event.getstops.getstops.get_stops") as gs:
             gs.return_value = self.TRIPS_DF
-            self.batch = Batch(self.BATCH_ID, self.LIST_MOT_ID, self.db, self.config)
+            self.batch = Batch(self.BATCH_ID, self.LIST_MOT_ID, None, self.config, self.db)
 
     # @patch("event.getstops.getstops.get_stops", return_value=["test"])
     # def test_CreateBatch(self, get_stops):
@@ -59,17 +64,150 @@ class BatchTest(unittest.TestCase):
     @patch("event.batch.calc_distances", return_value=[1, 2])
     @patch("event.batch.fpga", return_value=[1, 2])
     @patch("event.batch.get_best_itinerary", return_value=[1, 2])
-    @patch("event.batch.write_metrics")
+    @patch("event.batch.write_batch_metrics")
+    @patch("event.batch.log_point_stats")
     @patch("event.batch.save_output")
     @patch("event.batch.save_failed_trips")
-    def test_ProcessTrips(self, save_failed_trips_mock, save_output_mock, write_metrics_mock, get_best_itinerary_mock, fpga_mock, calc_distances_mock):
+    def test_ProcessTrips(self, save_failed_trips_mock, save_output_mock, log_point_stats_mock, write_batch_metrics_mock, get_best_itinerary_mock, fpga_mock, calc_distances_mock):
 
-        t = Mock()
+        t = self.scored_trip("blah", self.LIST_MOT_ID)
         self.batch.trip_objs = {"blah": t}
+
+        self.batch.process_trips()
+
+        self.assertEqual(self.batch.scored_trip_ids, ["blah"])
+        self.assertTrue(save_output_mock.called)
+        self.assertTrue(write_batch_metrics_mock.called)
+
+    @patch("event.batch.calc_distances", return_value=[1, 2])
+    @patch("event.batch.fpga", return_value=[1, 2])
+    @patch("event.batch.get_best_itinerary", return_value=[pd.DataFrame({'a': [1]}), 2])
+    @patch("event.batch.write_batch_metrics")
+    @patch("event.batch.log_point_stats")
+    @patch("event.batch.save_output")
+    @patch("event.batch.save_failed_trips")
+    def test_ProcessTripStreamsCompletedTrip(self, save_failed_trips_mock, save_output_mock, log_point_stats_mock,
+                                             write_batch_metrics_mock, get_best_itinerary_mock, fpga_mock,
+                                             calc_distances_mock):
+        pending_mot_id = '715b7d80-4746-486e-8ea0-c79a580b2e59'
+        pending_row = self.TRIPS_DF.copy()
+        pending_row['mot_segment_id'] = pending_mot_id
+        self.batch.trips = pd.concat([self.TRIPS_DF, pending_row], ignore_index=True)
+        done = self.scored_trip("done", self.LIST_MOT_ID)
+        pending = Mock()
+        pending.trip_id = "pending"
+        pending.trip = pd.Series({'mot_segment_id': pending_mot_id})
+        self.batch.trip_objs = {"done": done, "pending": pending}
+
+        self.batch.process_trip(done)
+
+        # Only the completed trip went through the pipeline
+        self.assertEqual(self.batch.scored_trip_ids, ["done"])
+        trips = calc_distances_mock.call_args[0][0]
+        self.assertEqual(trips['mot_segment_id'].tolist(), [self.LIST_MOT_ID])
+        self.assertEqual(save_output_mock.call_count, 1)
+        done.release_dfs.assert_called_once_with()
+        self.assertFalse(pending.release_dfs.called)
+        self.assertEqual(self.batch.stats.shape[0], 1)
+        # Batch metrics wait for the whole batch
+        self.assertFalse(write_batch_metrics_mock.called)
+
+    def scored_trip(self, trip_id, mot_segment_id):
+        t = Mock()
+        t.trip_id = trip_id
+        t.trip = pd.Series({'mot_segment_id': mot_segment_id})
         t.trip_link_df = pd.DataFrame(TRIP_LINK_DF)
         t.itinerary_df = pd.DataFrame(ITINERARY_DF)
         t.legs_df = pd.DataFrame(LEGS_DF)
         t.segments_df = pd.DataFrame(SEGMENTS_DF)
-
-        self.batch.process_trips()
-
+        return t
+
+
+    def test_LogStage(self):
+        self.batch.time_log = Mock()
+        self.batch.log_stage('fpga')
+        self.batch.log_stage('save_output', 'Update postgres.')
+
+        self.assertEqual([c[0][1] for c in self.observe_stage.call_args_list[-2:]], ['fpga', 'save_output'])
+        self.batch.time_log.log_runtime.assert_called_once_with(msg='Update postgres.')
+
+    @patch("event.batch.save_incomplete_trips")
+    def test_FinalizeIncomplete(self, save_incomplete_trips_mock):
+        done, pending = Mock(), Mock()
+        done.is_complete.return_value = True
+        pending.is_complete.return_value = False
+        pending.trip_id = 'pending'
+        pending.trip = {'mot_segment_id': self.LIST_MOT_ID}
+        self.batch.trip_objs = {'done': done, 'pending': pending}
+        self.batch.list_mot_id = [self.LIST_MOT_ID]
+        self.batch.process_trips = Mock()
+
+        dropped = self.batch.finalize_incomplete()
+
+        self.assertEqual(dropped, [self.LIST_MOT_ID])
+        self.assertEqual(list(self.batch.trip_objs.keys()), ['done'])
+        self.assertTrue(self.batch.trips.empty)
+        self.batch.process_trips.assert_called_once_with()
+
+    @patch("event.batch.write_batch_metrics")
+    def test_ProcessTripsSkipsStreamedTrips(self, write_batch_metrics_mock):
+        streamed, remaining = Mock(), Mock()
+        streamed.trip_id, remaining.trip_id = 'streamed', 'remaining'
+        self.batch.trip_objs = {'streamed': streamed, 'remaining': remaining}
+        self.batch.scored_trip_ids = ['streamed']
+        self.batch.stats = pd.DataFrame()
+        self.batch.score_trips = Mock()
+
+        with patch("event.batch.save_failed_trips"):
+            self.batch.process_trips()
+
+        self.batch.score_trips.assert_called_once_with([remaining])
+        self.assertTrue(write_batch_metrics_mock.called)
+
+    @patch("event.batch.Trip.build_pub_creds", Mock())
+    def test_FromLegacy(self):
+        # A batch pickled before the state format: no deadline/streaming attributes, itineraries kept on the trip
+        legacy = Batch.__new__(Batch)
+        legacy.__dict__.update({'batch_id': self.BATCH_ID, 'list_mot_id': [self.LIST_MOT_ID], 'loc_bounds': None,
+                                'trips': self.TRIPS_DF, 'trips_processed': 1, 'CONFIG': None, 'DB': None,
+                                'time_log': None})
+        legacy_trip = Trip.__new__(Trip)
+        itinerary = Mock()
+        itinerary.trip_link_df = pd.DataFrame(TRIP_LINK_DF).reset_index(drop=True)
+        itinerary.legs_df = pd.DataFrame(LEGS_DF)
+        itinerary.segments_df = pd.DataFrame(SEGMENTS_DF)
+        legacy_trip.__dict__.update({'trip': self.TRIPS_DF.iloc[0], 'trip_id': 'legacy', 'batch_id': self.BATCH_ID,
+                                     'itineraries': [itinerary], 'request_params': {("6", "True"): 2},
+                                     'requests_processed': 1, 'params': {}})
+        (legacy_trip.trip_link_df, legacy_trip.itinerary_df, legacy_trip.legs_df,
+         legacy_trip.segments_df) = ids.initialize_all_empty_df()
+        legacy.trip_objs = {'legacy': legacy_trip}
+
+        b = Batch.from_legacy(legacy, self.config, self.db)
+
+        self.assertIs(b.DB, self.db)
+        self.assertEqual(b.scored_trip_ids, [])
+        self.assertIsNone(b.deadline)
+        t = b.trip_objs['legacy']
+        self.assertEqual(t.trip_link_df.shape[0], itinerary.trip_link_df.shape[0])
+        self.assertEqual(t.legs_df.shape[0], itinerary.legs_df.shape[0])
+        self.assertEqual(t.segments_df.shape[0], itinerary.segments_df.shape[0])
+        self.assertEqual(t.request_params, {("6", "True"): 2})
+        self.assertTrue(t.is_complete())
+
+    def test_RequestPriority(self):
+        done, pending = Mock(), Mock()
+        done.request_params, done.requests_processed = {'a': 2, 'b': 2}, 2
+        pending.request_params, pending.requests_processed = {'a': 0, 'b': 0}, 0
+        self.batch.trip_objs = {'done': done, 'pending': pending}
+        self.batch.created = 1000.0
+        self.batch.deadline = 1100.0
+
+        self.assertEqual(self.batch.completion(), 0.5)
+        self.assertIsNone(self.batch.request_priority(0))
+        # half complete, half way to the deadline
+        self.assertEqual(self.batch.request_priority(9, now=1050.0), 5)
+        # past the deadline
+        self.assertEqual(self.batch.request_priority(9, now=2000.0), 7)
+        pending.requests_processed = 2
+        self.assertEqual(self.batch.request_priority(9, now=1000.0), 5)
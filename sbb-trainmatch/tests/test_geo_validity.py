@@ -0,0 +1,48 @@
+import unittest
+import numpy as np
+import pandas as pd
+from shapely.geometry import Point, box
+
+from event.filters import geo_validity
+from event.filters.geo_validity import GeoValidity, RegionGrid, INSIDE, BOUNDARY
+
+
+class GeoValidityTest(unittest.TestCase):
+    GEOMS = [box(0, 0, 10, 10), Point(5, 5).buffer(4)]
+    SEGMENTS = pd.DataFrame({'start_lon': [5.0, 5.0, 0.5, 20.0],
+                             'start_lat': [5.0, 5.0, 0.5, 5.0],
+                             'end_lon': [6.0, 9.5, 5.0, 5.0],
+                             'end_lat': [6.0, 9.5, 5.0, 5.0]})
+
+    def expected_mask(self):
+        # The per row test GeoValidity replaces
+        return self.SEGMENTS.apply(lambda x: np.all([geom.contains(Point(x['start_lon'], x['start_lat'])) and
+                                                     geom.contains(Point(x['end_lon'], x['end_lat']))
+                                                     for geom in self.GEOMS]), axis=1).values
+
+    def test_SegmentsWithin(self):
+        within = GeoValidity(self.GEOMS).segments_within(self.SEGMENTS)
+
+        self.assertEqual(within.tolist(), [True, False, False, False])
+        self.assertEqual(within.tolist(), self.expected_mask().tolist())
+
+    def test_SegmentsWithinWithoutVectorized(self):
+        vectorized, geo_validity.vectorized = geo_validity.vectorized, None
+        self.addCleanup(setattr, geo_validity, 'vectorized', vectorized)
+
+        within = GeoValidity(self.GEOMS).segments_within(self.SEGMENTS)
+
+        self.assertEqual(within.tolist(), self.expected_mask().tolist())
+
+    def test_NoRegions(self):
+        self.assertTrue(GeoValidity([]).contains([1.0, 2.0], [3.0, 4.0]).all())
+
+    def test_RegionGrid(self):
+        grid = RegionGrid.build(self.GEOMS[1], 16, 'checksum')
+        lon, lat = np.random.RandomState(0).uniform(0, 10, (2, 500))
+
+        within = GeoValidity(self.GEOMS[1:], [grid]).contains(lon, lat)
+
+        self.assertEqual(within.tolist(), GeoValidity(self.GEOMS[1:]).contains(lon, lat).tolist())
+        self.assertEqual(grid.lookup(np.array([5.0]), np.array([5.0])).tolist(), [INSIDE])
+        self.assertTrue((grid.cells == BOUNDARY).any())
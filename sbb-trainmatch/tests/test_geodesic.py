@@ -0,0 +1,35 @@
+import unittest
+import numpy as np
+
+from event import geodesic
+
+
+class GeodesicTest(unittest.TestCase):
+    # Zurich HB - Bern and Geneva - St. Gallen, vincenty distances in meters
+    LAT1, LON1 = np.array([47.378177, 46.210208]), np.array([8.540192, 6.142452])
+    LAT2, LON2 = np.array([46.948832, 47.423180]), np.array([7.439131, 9.369750])
+    VINCENTY = np.array([96166.92, 280757.15])
+
+    def test_Ellipsoidal(self):
+        d = geodesic.distance(self.LAT1, self.LON1, self.LAT2, self.LON2)
+
+        np.testing.assert_allclose(d, self.VINCENTY, atol=1.0)
+
+    def test_Approximations(self):
+        haversine = geodesic.distance(self.LAT1, self.LON1, self.LAT2, self.LON2, geodesic.HAVERSINE)
+        lv95 = geodesic.distance(self.LAT1, self.LON1, self.LAT2, self.LON2, geodesic.LV95)
+
+        np.testing.assert_allclose(haversine, self.VINCENTY, rtol=0.003)
+        np.testing.assert_allclose(lv95, self.VINCENTY, rtol=0.0002, atol=1.0)
+
+    def test_SamePoint(self):
+        self.assertEqual(geodesic.distance(47.0, 8.0, 47.0, 8.0), 0.0)
+        self.assertEqual(geodesic.distance(47.0, 8.0, 47.0, 8.0, geodesic.HAVERSINE), 0.0)
+
+    def test_Broadcast(self):
+        d = geodesic.distance(self.LAT1[:, None], self.LON1[:, None], self.LAT2, self.LON2)
+
+        self.assertEqual(d.shape, (2, 2))
+
+    def test_UnknownMethod(self):
+        self.assertRaises(ValueError, geodesic.distance, 47.0, 8.0, 47.0, 8.0, 'flat')
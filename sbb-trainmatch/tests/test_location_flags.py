@@ -0,0 +1,19 @@
+import unittest
+from mock import Mock
+import pandas as pd
+
+from event.getstops.location_flags import update_location_flags
+
+
+class LocationFlagsTest(unittest.TestCase):
+
+    def test_UpdateLocationFlags(self):
+        db = Mock()
+        db.postgres2pandas.side_effect = [pd.DataFrame({'id': [1, 2]}), pd.DataFrame({'id': [3]}),
+                                          pd.DataFrame({'id': []})]
+
+        n = update_location_flags(db, batch_size=2)
+
+        self.assertEqual(n, 3)
+        self.assertEqual(db.execute.call_count, 2)
+        self.assertEqual(db.query_mogrify.call_args[0][1], {'location_id': [3]})
@@ -0,0 +1,103 @@
+import unittest
+from mock import patch
+
+from event.redis_client import RedisClient
+
+
+class RedisClientTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('event.redis_client.redis')
+        self.redis = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = RedisClient('localhost', '6379', cache_ttl=60, cache_size=2)
+        self.pipe = self.client.client.pipeline.return_value
+
+    def test_UploadMany(self):
+        self.client.upload_many({'xml': 'a', 'batch': {'status': 0}})
+
+        self.pipe.set.assert_called_once_with('xml', 'a', ex=RedisClient.EXPIRATION_TIME_IN_SECONDS)
+        self.pipe.hmset.assert_called_once_with('batch', {'status': 0})
+        self.pipe.expire.assert_called_once_with('batch', RedisClient.EXPIRATION_TIME_IN_SECONDS)
+        self.assertEqual(self.client.reset_round_trips(), 1)
+
+    def test_GetMany(self):
+        self.client.client.mget.return_value = ['a', None]
+
+        self.assertEqual(self.client.get_many(['x', 'y']), ['a', None])
+        self.client.client.mget.assert_called_once_with(['x', 'y'])
+        self.assertEqual(self.client.reset_round_trips(), 1)
+
+    def test_GetManyHashes(self):
+        self.pipe.execute.return_value = [['b1'], [None]]
+
+        self.assertEqual(self.client.get_many(['b1', 'b2'], inner_key='batch'), ['b1', None])
+        self.assertEqual(self.pipe.hmget.call_count, 2)
+        self.assertFalse(self.client.client.mget.called)
+        self.assertEqual(self.client.cache, {})
+        self.assertEqual(self.client.reset_round_trips(), 1)
+
+    def test_GetManyEmpty(self):
+        self.assertEqual(self.client.get_many([]), [])
+        self.assertEqual(self.client.reset_round_trips(), 0)
+
+    def test_Cache(self):
+        self.client.client.mget.return_value = ['a']
+        self.client.get_obj('x')
+
+        # Served locally
+        self.assertEqual(self.client.get_obj('x'), 'a')
+        self.assertEqual(self.client.client.mget.call_count, 1)
+
+        self.client.client.mget.return_value = ['b']
+        self.assertEqual(self.client.get_many(['x', 'y']), ['a', 'b'])
+        self.client.client.mget.assert_called_with(['y'])
+
+    def test_CacheInvalidated(self):
+        self.client.client.mget.return_value = ['a']
+        self.client.get_obj('x')
+
+        self.client.upload_to_redis('x', 'b')
+        self.client.get_obj('x')
+        self.client.delete('x')
+        self.client.get_obj('x')
+
+        self.assertEqual(self.client.client.mget.call_count, 3)
+
+    def test_CacheExpiry(self):
+        self.client.client.mget.return_value = ['a']
+        with patch('event.redis_client.time.time', return_value=1000):
+            self.client.get_obj('x')
+        with patch('event.redis_client.time.time', return_value=1061):
+            self.client.get_obj('x')
+
+        self.assertEqual(self.client.client.mget.call_count, 2)
+
+    def test_CacheSize(self):
+        self.client.client.mget.return_value = ['a', 'b', 'c']
+        self.client.get_many(['x', 'y', 'z'])
+
+        self.assertEqual(list(self.client.cache), ['y', 'z'])
+
+    def test_CacheDisabled(self):
+        client = RedisClient('localhost', '6379')
+        client.client.mget.return_value = ['a']
+        client.get_obj('x')
+        client.get_obj('x')
+
+        self.assertEqual(client.client.mget.call_count, 2)
+        self.assertEqual(client.cache, {})
+
+    def test_DeleteMany(self):
+        self.client.delete_many(['b1', 'b2'])
+
+        self.client.client.delete.assert_called_once_with('b1', 'b2')
+        self.assertEqual(self.client.reset_round_trips(), 1)
+
+    def test_RemoveDeadlines(self):
+        # b2 was claimed by another process in the meantime
+        self.pipe.execute.return_value = [1, 0, 1]
+
+        self.assertEqual(self.client.remove_deadlines(['b1', 'b2', 'b3']), ['b1', 'b3'])
+        self.pipe.zrem.assert_called_with(RedisClient.DEADLINE_KEY, 'b3')
+        self.assertEqual(self.client.reset_round_trips(), 1)
@@ -0,0 +1,64 @@
+import unittest
+from datetime import datetime
+from mock import Mock
+import numpy as np
+import pandas as pd
+
+from event.traineval.route_cache import RouteGeometry, RouteCache, route_key_hash
+from event.filters.order import line_orders
+
+
+class RouteCacheTest(unittest.TestCase):
+    KEYS = [('IC 1', '11', 'a', 'b'), ('IR 2', '11', 'b', 'c')]
+    GEOMS = pd.DataFrame({'route_name': ['IC 1', 'IR 2'], 'agency_id': ['11', '11'], 'stop_id_start': ['a', 'b'],
+                          'stop_id_end': ['b', 'c'], 'geom_id': [1, 2],
+                          'wkt': ['LINESTRING (7 47, 7.5 47.001, 8 47)', 'LINESTRING (8 47, 8 48)']})
+
+    def test_Simplified(self):
+        line = RouteGeometry([7.44, 7.44001, 7.44], [46.5, 47, 47.5])
+
+        self.assertEqual(len(line.simplified_east), 2)
+        self.assertEqual(len(line.east), 3)
+        self.assertAlmostEqual(line.simplified_cumdist[-1], line.length, delta=1)
+
+    def test_Locate(self):
+        line = RouteGeometry([8, 8], [47, 48])
+
+        position = line.locate(np.array([47.5, 47.1, 46.0, 49.0]), np.array([8.01, 7.99, 8.0, 8.0]))
+
+        self.assertEqual(np.argsort(position).tolist(), [2, 1, 0, 3])
+        self.assertEqual(position[2], 0)
+        self.assertAlmostEqual(position[3], line.length)
+
+    def test_Eviction(self):
+        db = Mock()
+        db.postgres2pandas.side_effect = [self.GEOMS[:1], self.GEOMS[1:], self.GEOMS[:1]]
+        first = RouteGeometry.from_wkt(self.GEOMS.loc[0, 'wkt'])
+        cache = RouteCache(max_bytes=first.nbytes)
+
+        cache.lines(self.KEYS[:1], db)
+        cache.lines(self.KEYS[:1], db)
+        self.assertEqual(db.postgres2pandas.call_count, 1)
+
+        cache.lines(self.KEYS[1:], db)
+        self.assertEqual(list(cache.routes), [route_key_hash(self.KEYS[1])])
+        self.assertLessEqual(cache.nbytes, first.nbytes)
+
+        lines = cache.lines(self.KEYS[:1], db)
+        self.assertEqual(db.postgres2pandas.call_count, 3)
+        self.assertEqual(len(lines[self.KEYS[0]]), 1)
+
+    def test_LineOrders(self):
+        db = Mock()
+        db.postgres2pandas.return_value = self.GEOMS[1:]
+        points_joined = pd.DataFrame({'itinerary_id': ['i'] * 3, 'leg_id': ['l'] * 3, 'segment_id': ['s'] * 3,
+                                      'point_id': [1, 2, 3], 'route_name': ['IR 2'] * 3, 'agency_id': ['11'] * 3,
+                                      'stop_id_start_legs': ['b'] * 3, 'stop_id_end_legs': ['c'] * 3,
+                                      'time': [datetime(2017, 6, 1, 8, m) for m in (0, 10, 20)],
+                                      'lat': [47.1, 47.6, 47.3], 'lon': [8.0, 8.0, 8.0]})
+
+        df = line_orders(points_joined, RouteCache(), db)
+
+        self.assertEqual(df['point_id'].tolist(), [1, 2, 3])
+        self.assertEqual(df['time_order'].tolist(), [1, 2, 3])
+        self.assertEqual(df['data_order'].tolist(), [1, 3, 2])
@@ -0,0 +1,56 @@
+import unittest
+from datetime import datetime
+from mock import Mock, patch
+import numpy as np
+import pandas as pd
+
+from event import geodesic
+from event.traineval.route_cache import RouteGeometry, RouteCache
+from event.traineval.route_distance import calc_point_distances
+
+
+class RouteDistanceTest(unittest.TestCase):
+    SEGMENTS = pd.DataFrame({'segment_id': ['s1', 's2'],
+                             'vid': ['v1', 'v1'],
+                             'route_name': ['IC 1', 'walk'],
+                             'agency_id': ['11', '11'],
+                             'time_start': [datetime(2017, 6, 1, 8), datetime(2017, 6, 1, 9)],
+                             'time_end': [datetime(2017, 6, 1, 9), datetime(2017, 6, 1, 9)],
+                             'stop_id_start': ['a', 'b'],
+                             'stop_id_end': ['b', 'c']})
+    POINTS = pd.DataFrame({'segment_id': ['s1', 's1', 's2'],
+                           'horizontal_accuracy': [10.0, 10.0, 10.0],
+                           'time': [datetime(2017, 6, 1, 8, 15), datetime(2017, 6, 1, 8, 45),
+                                    datetime(2017, 6, 1, 9)],
+                           'lat': [47.0, 47.0, 46.5],
+                           'lon': [7.5, 8.5, 8.0],
+                           'point_id': [1, 2, 3]})
+    GEOMS = pd.DataFrame({'route_name': ['IC 1'], 'agency_id': ['11'], 'stop_id_start': ['a'], 'stop_id_end': ['b'],
+                          'geom_id': [1], 'wkt': ['LINESTRING (7 47, 8 47, 8 48)']})
+    STATIONS = pd.DataFrame({'stop_id_parent': ['b', 'c'], 'lat': [46.0, 47.0], 'lon': [8.0, 8.0]})
+
+    def test_Interpolate(self):
+        line = RouteGeometry([7, 8, 8], [47, 47, 48])
+
+        lon, lat = line.interpolate(np.array([0, 0.25, 0.75, 1.5]))
+
+        self.assertEqual(lon.tolist(), [7, 7.5, 8, 8])
+        self.assertEqual(lat.tolist(), [47, 47, 47.5, 48])
+
+    @patch('event.traineval.route_distance.temptable_template', Mock(return_value=''))
+    def test_CalcPointDistances(self):
+        db = Mock()
+        db.get_query.return_value = ''
+        db.postgres2pandas.side_effect = [self.POINTS, self.GEOMS, self.STATIONS]
+        route_cache = RouteCache()
+
+        distances = calc_point_distances(self.SEGMENTS, db, route_cache)
+
+        np.testing.assert_allclose(distances['distance'].values,
+                                   geodesic.distance([47.0, 47.0, 46.5], [7.5, 8.5, 8.0], [47.0, 47.5, 47.0],
+                                                     [7.5, 8.0, 8.0]))
+        self.assertEqual(distances['point_id'].tolist(), [1, 2, 3])
+
+        # Cached: only the points are queried for the next batch
+        db.postgres2pandas.side_effect = [self.POINTS]
+        calc_point_distances(self.SEGMENTS, db, route_cache)
@@ -0,0 +1,45 @@
+import unittest
+from datetime import datetime
+import pandas as pd
+
+from event import state_codec
+from tests.data_structures import TRIPS_DF, TRIP_LINK_DF, LEGS_DF, TRIP_SERIES
+
+
+class StateCodecTest(unittest.TestCase):
+
+    def roundtrip(self, state, compression='zlib'):
+        return state_codec.loads(state_codec.dumps(state, compression=compression))
+
+    def test_FrameRoundtrip(self):
+        trips = pd.DataFrame(TRIPS_DF)
+        out = self.roundtrip({'trips': trips})['trips']
+
+        pd.util.testing.assert_frame_equal(out, trips)
+
+    def test_MultiIndexFrameRoundtrip(self):
+        trip_link = pd.DataFrame(TRIP_LINK_DF)
+        trip_link.index.names = ['itinerary_id', 'leg_id', 'segment_id']
+        out = self.roundtrip({'trip_link': trip_link}, compression='none')['trip_link']
+
+        pd.util.testing.assert_frame_equal(out, trip_link)
+
+    def test_EmptyFrameRoundtrip(self):
+        legs = pd.DataFrame(LEGS_DF).iloc[:0]
+        out = self.roundtrip({'legs': legs})['legs']
+
+        self.assertEqual(list(out.columns), list(legs.columns))
+        self.assertEqual(out.shape, legs.shape)
+
+    def test_SeriesAndScalarsRoundtrip(self):
+        state = {'trip': pd.Series(TRIP_SERIES),
+                 'params': [['6', 'True', {'rounded_timestamp': datetime(2016, 6, 27, 5, 29),
+                                           'trip_time_start': pd.Timestamp('2016-06-27 04:49:41')}]]}
+        out = self.roundtrip(state)
+
+        pd.util.testing.assert_series_equal(out['trip'], state['trip'])
+        self.assertEqual(out['params'], state['params'])
+
+    def test_RejectsUnknownBlob(self):
+        self.assertFalse(state_codec.is_encoded('\x80\x02}q\x00.'))
+        self.assertRaises(state_codec.StateFormatError, state_codec.loads, 'not a state')
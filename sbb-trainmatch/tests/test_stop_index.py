@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from event.getstops.hop_matrix import HopMatrix, DISCONNECTED
+from event.getstops.stop_index import StopIndex, select_stop_pairs
+
+
+class StopIndexTest(unittest.TestCase):
+    STATIONS = pd.DataFrame({'stop_id_parent': ['zurich', 'oerlikon', 'bern', 'lausanne'],
+                             'lat': [47.378177, 47.411525, 46.948832, 46.516792],
+                             'lon': [8.540192, 8.544115, 7.439131, 6.629086]})
+    ENDPOINTS = pd.DataFrame({'mot_segment_id': [1, 1, 2, 2],
+                              'is_start': [True, False, True, False],
+                              'datetime_created': [datetime(2017, 1, 1, 8), datetime(2017, 1, 1, 9),
+                                                   datetime(2017, 1, 1, 10), datetime(2017, 1, 1, 12)],
+                              'tz': ['Europe/Zurich'] * 4,
+                              'lat': [47.38, 46.95, 47.40, 46.52],
+                              'lon': [8.54, 7.44, 8.54, 6.63]})
+
+    def setUp(self):
+        self.index = StopIndex(self.STATIONS)
+
+    def test_Candidates(self):
+        candidates = self.index.candidates(self.ENDPOINTS)
+
+        start_1 = candidates[(candidates['mot_segment_id'] == 1) & candidates['is_start']]
+        self.assertEqual(sorted(start_1['stop_id_parent']), ['oerlikon', 'zurich'])
+        self.assertTrue((candidates['distance'] < 10000).all())
+
+    def test_SelectStopPairs(self):
+        hops = pd.DataFrame({'stop_id_start': ['zurich', 'oerlikon', 'zurich', 'oerlikon'],
+                             'stop_id_end': ['bern', 'bern', 'lausanne', 'lausanne'],
+                             'n_hops': [1, 1, 2, 1]})
+
+        pairs = select_stop_pairs(self.index.candidates(self.ENDPOINTS), hops)
+
+        self.assertEqual(pairs['mot_segment_id'].tolist(), [1, 2])
+        # Same number of hops: nearest stations
+        self.assertEqual(pairs.loc[0, 'stop_id_start'], 'zurich')
+        self.assertEqual(pairs.loc[0, 'stop_id_end'], 'bern')
+        # Fewer hops first, even if further away
+        self.assertEqual(pairs.loc[1, 'stop_id_start'], 'oerlikon')
+        self.assertEqual(pairs.loc[1, 'time_end'], datetime(2017, 1, 1, 12))
+
+    def test_NoEndpoints(self):
+        candidates = self.index.candidates(self.ENDPOINTS.iloc[:0])
+
+        self.assertTrue(candidates.empty)
+
+    def test_SelectStopPairsHopMatrix(self):
+        hops = pd.DataFrame({'stop_id_start': ['zurich', 'oerlikon', 'zurich', 'oerlikon'],
+                             'stop_id_end': ['bern', 'bern', 'lausanne', 'lausanne'],
+                             'n_hops': [1, 1, 2, 1]})
+        # zurich, oerlikon, bern, lausanne; oerlikon isn't connected to bern in the matrix
+        matrix = np.array([[0, 0, 1, 2],
+                           [0, 0, DISCONNECTED, 1],
+                           [1, DISCONNECTED, 0, 1],
+                           [2, 1, 1, 0]], dtype=np.uint8)
+        candidates = self.index.candidates(self.ENDPOINTS)
+
+        pairs = select_stop_pairs(candidates, HopMatrix(self.STATIONS['stop_id_parent'], matrix))
+
+        self.assertEqual(pairs.values.tolist(), select_stop_pairs(candidates, hops).values.tolist())
+
+    def test_HopMatrixLoad(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        np.save(os.path.join(path, 'stn_hops.npy'), np.array([[0, 3], [DISCONNECTED, 0]], dtype=np.uint8))
+        with open(os.path.join(path, 'stn_hops.stations.txt'), 'w') as f:
+            f.write('zurich\nbern\n')
+
+        matrix = HopMatrix.load(os.path.join(path, 'stn_hops'))
+
+        self.assertEqual(matrix.n_hops(['zurich', 'bern', 'zurich'], ['bern', 'zurich', 'geneva']).tolist(),
+                         [3, -1, -1])
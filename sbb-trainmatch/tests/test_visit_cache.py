@@ -0,0 +1,52 @@
+import unittest
+from datetime import datetime
+from mock import Mock
+import pandas as pd
+
+from event.getstops.visit_cache import VisitCache, EPOCH
+
+
+class VisitCacheTest(unittest.TestCase):
+    MOT_TIMES = pd.DataFrame({'mot_segment_id': ['a', 'b'],
+                              'vid': ['v1', 'v1'],
+                              'datetime_created': [datetime(2017, 6, 1, 8, 30), datetime(2017, 6, 1, 18)]})
+    VISITS = pd.DataFrame({'vid': ['v1', 'v1'],
+                           'id': [1, 2],
+                           'datetime_arrived': [datetime(2017, 5, 31, 20), datetime(2017, 6, 1, 9)],
+                           'datetime_departed': [datetime(2017, 6, 1, 8), datetime(2017, 6, 1, 17)],
+                           'tz': ['Europe/Zurich', 'Europe/Zurich']})
+
+    def setUp(self):
+        self.db = Mock()
+        self.cache = VisitCache()
+
+    def test_TripTimes(self):
+        self.db.postgres2pandas.side_effect = [self.MOT_TIMES, self.VISITS]
+
+        trips = self.cache.trip_times(['a', 'b'], self.db, 300)
+
+        self.assertEqual(trips['mot_segment_id'].tolist(), ['a', 'b'])
+        self.assertEqual(trips['visit_id_start'].tolist(), [1, 2])
+        self.assertEqual(trips.loc[0, 'visit_id_end'], 2)
+        self.assertTrue(pd.isnull(trips.loc[1, 'visit_id_end']))
+        # Local (CEST) times
+        self.assertEqual(trips.loc[0, 'trip_time_start'], datetime(2017, 6, 1, 10))
+        self.assertEqual(trips.loc[0, 'trip_time_end'], datetime(2017, 6, 1, 11))
+
+    def test_IncrementalUpdate(self):
+        new_visit = pd.DataFrame({'vid': ['v1', 'v1'],
+                                  'id': [2, 3],
+                                  'datetime_arrived': [datetime(2017, 6, 1, 9), datetime(2017, 6, 1, 19)],
+                                  'datetime_departed': [datetime(2017, 6, 1, 17), datetime(2017, 6, 1, 21)],
+                                  'tz': ['Europe/Zurich', 'Europe/Zurich']})
+        self.db.postgres2pandas.side_effect = [self.MOT_TIMES, self.VISITS, self.MOT_TIMES, new_visit]
+
+        self.cache.trip_times(['a', 'b'], self.db, 300)
+        trips = self.cache.trip_times(['a', 'b'], self.db, 300)
+
+        first_since = self.db.postgres2pandas.call_args_list[1][1]['params']['since']
+        since = self.db.postgres2pandas.call_args_list[3][1]['params']['since']
+        self.assertEqual(first_since, [EPOCH])
+        self.assertEqual(since, [datetime(2017, 6, 1, 9)])
+        self.assertEqual(trips['visit_id_end'].tolist(), [2, 3])
+        self.assertEqual(self.cache.vids['v1'][0]['id'].tolist(), [1, 2, 3])
@@ -22,7 +22,7 @@ setup(
     # Versions should comply with PEP440.  For a discussion on single-sourcing
     # the version across setup.py and the project code, see
     # https://packaging.python.org/en/latest/single_source_version.html
-    version='0.0.11',
+    version='0.0.12',
 
     description='Provides classes and helpers for creating python bots, for example connecting to rabbit mq to receive messages',
     long_description=long_description,
@@ -79,7 +79,7 @@ setup(
     # your project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
-    install_requires=['pika>=0.10.0', 'graypy>=0.2.14', 'statsd>=3.2.1', 'vibepy>=0.0.14'],
+    install_requires=['pika>=0.10.0', 'graypy>=0.2.14', 'statsd>=3.2.1,<5', 'vibepy>=0.0.14'],
 
     # List additional groups of dependencies here (e.g. development
     # dependencies). You can install these using the following syntax,
@@ -88,6 +88,8 @@ setup(
     extras_require={
         # 'dev': ['check-manifest'],
         # 'test': ['coverage'],
+        'msgpack': ['msgpack>=0.5.2'],
+        'zstd': ['zstandard>=0.8.0'],
     },
 
     # If there are data files included in your packages that need to be
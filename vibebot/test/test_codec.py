@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from mock import patch
+
+from vibebot import codec
+from vibebot.codec import CodecError
+
+
+class CodecTest(unittest.TestCase):
+    OBJ = {u'trip_id': u'abc', u'n': 3, u'xml': u'<a>Zürich</a>', u'list': [1, 2.5, None, True]}
+
+    def test_Json(self):
+        body = codec.encode(self.OBJ)
+
+        self.assertEqual(codec.decode(body), self.OBJ)
+        self.assertEqual(codec.decode(body, codec.JSON, codec.IDENTITY), self.OBJ)
+
+    @unittest.skipIf(codec.msgpack is None, 'msgpack is not installed')
+    def test_Msgpack(self):
+        obj = dict(self.OBJ, raw=b'\x00\xff')
+        for content_type in codec.MSGPACK_TYPES:
+            body = codec.encode(obj, content_type)
+
+            self.assertEqual(codec.decode(body, content_type), obj)
+
+    def test_Zlib(self):
+        body = codec.encode(self.OBJ, codec.JSON, codec.ZLIB)
+
+        self.assertNotEqual(body, codec.encode(self.OBJ))
+        self.assertEqual(codec.decode(body, codec.JSON, codec.ZLIB), self.OBJ)
+
+    @unittest.skipIf(codec.msgpack is None, 'msgpack is not installed')
+    def test_MsgpackZlib(self):
+        body = codec.encode(self.OBJ, codec.MSGPACK, codec.ZLIB)
+
+        self.assertEqual(codec.decode(body, codec.MSGPACK, codec.ZLIB), self.OBJ)
+
+    @unittest.skipIf(codec.zstd is None, 'zstandard is not installed')
+    def test_Zstd(self):
+        body = codec.encode(self.OBJ, codec.JSON, codec.ZSTD)
+
+        self.assertEqual(codec.decode(body, codec.JSON, codec.ZSTD), self.OBJ)
+
+    def test_UnknownEncodingIsIdentity(self):
+        body = codec.encode(self.OBJ)
+
+        with patch('vibebot.codec.logger') as logger:
+            self.assertEqual(codec.decode(body, codec.JSON, 'utf-8'), self.OBJ)
+        self.assertTrue(logger.warning.called)
+
+    def test_UnknownEncodingNotCompressed(self):
+        with self.assertRaises(CodecError):
+            codec.encode(self.OBJ, codec.JSON, 'gzip')
+
+    def test_CorruptZlib(self):
+        with self.assertRaises(CodecError):
+            codec.decode(b'not zlib', codec.JSON, codec.ZLIB)
+
+    @unittest.skipIf(codec.msgpack is None, 'msgpack is not installed')
+    def test_CorruptMsgpack(self):
+        with self.assertRaises(CodecError):
+            codec.decode(b'\xc1', codec.MSGPACK)
+
+    def test_InvalidJson(self):
+        # Handled by the consumers as ValueError, like CodecError
+        with self.assertRaises(ValueError):
+            codec.decode(b'{not json')
+
+    def test_ZstdNotInstalled(self):
+        with patch('vibebot.codec.zstd', None):
+            with self.assertRaises(CodecError) as cm:
+                codec.decode(b'\x28\xb5\x2f\xfd', codec.JSON, codec.ZSTD)
+            self.assertIn('zstandard', str(cm.exception))
+
+            with self.assertRaises(CodecError):
+                codec.encode(self.OBJ, codec.JSON, codec.ZSTD)
+
+    def test_MsgpackNotInstalled(self):
+        with patch('vibebot.codec.msgpack', None):
+            with self.assertRaises(CodecError):
+                codec.decode(b'\x80', codec.MSGPACK)
@@ -0,0 +1,98 @@
+import unittest
+
+from mock import Mock, patch
+
+from vibebot.event_bot import EventBot
+from vibebot.exchange_callback import ExchangeCallback
+
+
+class AutoscaleTest(unittest.TestCase):
+
+    def setUp(self):
+        # Only what __autoscale__ needs, without rabbit or config
+        self.bot = EventBot.__new__(EventBot)
+        self.bot.bot_id = 'bot'
+        self.bot.logger = Mock()
+        self.bot.statsd = Mock()
+        self.bot.shared_connection = False
+        self.bot.consumers = {}
+        self.bot.consumers_callbacks = {}
+        self.bot.next_consumer_id = 0
+        self.bot.retired_consumers = []
+        self.bot.autoscale_backlog = 10
+        self.bot.autoscale_idle_samples = 2
+        self.bot.autoscale_busy_utilization = 0.75
+        self.bot.autoscale_idle_utilization = 0.25
+        self.bot.busy_samples = {}
+        self.bot.__create_consumer__ = Mock(side_effect=lambda consumer_id, callback: Mock())
+
+        self.exchange_callback = ExchangeCallback('ex', Mock(), consumer_count=2, min_consumers=1, max_consumers=4)
+        self.bot.exchange_callbacks = [self.exchange_callback]
+        self.bot.exchange_consumers = {self.exchange_callback: []}
+        self.bot.idle_samples = {self.exchange_callback: 0}
+        for _ in range(2):
+            self.bot.__add_consumer__(self.exchange_callback)
+
+        self.now = 1000.0
+        patcher = patch('vibebot.event_bot.time')
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.time.time.side_effect = lambda: self.now
+
+    def sample(self, depth, busy_seconds, elapsed=10.0):
+        # Each consumer spent busy_seconds in the callback during the last elapsed seconds
+        self.now += elapsed
+        for consumer_id in self.bot.exchange_consumers[self.exchange_callback]:
+            self.bot.consumers_callbacks[consumer_id].busy_seconds.value += busy_seconds
+        self.bot.__queue_depth__ = Mock(return_value=depth)
+        self.bot.__autoscale__()
+        return len(self.bot.exchange_consumers[self.exchange_callback])
+
+    def test_Utilization(self):
+        self.assertIsNone(self.bot.__utilization__(self.exchange_callback))
+        self.now += 10
+        for callback in self.bot.consumers_callbacks.values():
+            callback.busy_seconds.value += 4
+
+        self.assertAlmostEqual(self.bot.__utilization__(self.exchange_callback), 0.4)
+
+    def test_UtilizationWorkers(self):
+        self.exchange_callback.worker_count = 4
+        self.bot.__utilization__(self.exchange_callback)
+        self.now += 10
+        for callback in self.bot.consumers_callbacks.values():
+            callback.busy_seconds.value += 20
+
+        self.assertAlmostEqual(self.bot.__utilization__(self.exchange_callback), 0.5)
+
+    def test_ScaleUpFirstSample(self):
+        # No utilization yet, the queue depth decides
+        self.assertEqual(self.sample(depth=100, busy_seconds=0), 3)
+
+    def test_ScaleUpBusy(self):
+        self.sample(depth=0, busy_seconds=0)
+
+        self.assertEqual(self.sample(depth=100, busy_seconds=9), 3)
+        self.assertTrue(self.bot.statsd.gauge.called)
+
+    def test_NoScaleUpIdle(self):
+        self.sample(depth=0, busy_seconds=0)
+
+        # Backlog but the consumers are held back, more of them wouldn't help
+        self.assertEqual(self.sample(depth=100, busy_seconds=1), 2)
+
+    def test_ScaleDownIdle(self):
+        self.sample(depth=0, busy_seconds=0)
+
+        self.assertEqual(self.sample(depth=0, busy_seconds=1), 2)
+        self.assertEqual(self.sample(depth=0, busy_seconds=1), 1)
+        self.assertEqual(len(self.bot.retired_consumers), 1)
+        self.assertEqual(sorted(self.bot.busy_samples), self.bot.exchange_consumers[self.exchange_callback])
+
+    def test_NoScaleDownBusy(self):
+        self.sample(depth=0, busy_seconds=0)
+
+        # An empty queue but the consumers only just keep up
+        for _ in range(4):
+            self.assertEqual(self.sample(depth=0, busy_seconds=9), 2)
+        self.assertEqual(self.bot.idle_samples[self.exchange_callback], 0)
@@ -0,0 +1,79 @@
+import unittest
+
+from vibebot.flow_control import FlowController
+
+
+class FlowControllerTest(unittest.TestCase):
+
+    def record_window(self, controller, latency_ms, errors=0):
+        # Only the last record of a window returns a decision
+        for _ in range(controller.window - 1):
+            self.assertIsNone(controller.record(latency_ms))
+        return controller.record(latency_ms, errors)
+
+    def test_Healthy(self):
+        controller = FlowController(8, max_latency_ms=100, window=5)
+
+        self.assertIsNone(self.record_window(controller, 50))
+        self.assertEqual(controller.prefetch, 8)
+
+    def test_HalveOnLatency(self):
+        controller = FlowController(8, max_latency_ms=100, window=5)
+
+        self.assertEqual(self.record_window(controller, 200), FlowController.QOS)
+        self.assertEqual(controller.prefetch, 4)
+        self.assertEqual(self.record_window(controller, 200), FlowController.QOS)
+        self.assertEqual(controller.prefetch, 2)
+
+    def test_PauseAtOne(self):
+        controller = FlowController(2, max_latency_ms=100, window=5)
+
+        self.assertEqual(self.record_window(controller, 200), FlowController.QOS)
+        self.assertEqual(controller.prefetch, 1)
+        self.assertEqual(self.record_window(controller, 200), FlowController.PAUSE)
+        self.assertTrue(controller.paused)
+        self.assertEqual(controller.prefetch, 1)
+
+        controller.resume()
+        self.assertFalse(controller.paused)
+
+    def test_AdditiveIncrease(self):
+        controller = FlowController(8, max_latency_ms=100, window=5)
+        self.record_window(controller, 200)
+        self.record_window(controller, 200)
+
+        for expected in (3, 4):
+            self.assertEqual(self.record_window(controller, 50), FlowController.QOS)
+            self.assertEqual(controller.prefetch, expected)
+
+        for _ in range(10):
+            self.record_window(controller, 50)
+        # Capped at max_prefetch
+        self.assertEqual(controller.prefetch, 8)
+        self.assertIsNone(self.record_window(controller, 50))
+
+    def test_ErrorRate(self):
+        controller = FlowController(4, max_error_rate=0.2, window=5)
+
+        # 1 error out of 5 messages is not above the rate
+        self.assertIsNone(self.record_window(controller, 10, errors=1))
+        self.assertEqual(self.record_window(controller, 10, errors=2), FlowController.QOS)
+        self.assertEqual(controller.prefetch, 2)
+
+    def test_AverageLatency(self):
+        controller = FlowController(4, max_latency_ms=100, window=4)
+
+        for latency_ms in (20, 20, 20):
+            controller.record(latency_ms)
+        # Average of 80ms despite the slow message
+        self.assertIsNone(controller.record(260))
+
+    def test_ResumeClearsWindow(self):
+        controller = FlowController(4, max_latency_ms=100, window=5)
+        for _ in range(4):
+            controller.record(500)
+
+        controller.resume()
+
+        self.assertIsNone(self.record_window(controller, 50))
+        self.assertEqual(controller.prefetch, 4)
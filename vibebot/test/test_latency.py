@@ -0,0 +1,116 @@
+import Queue
+import unittest
+import urllib2
+
+from mock import patch
+
+from vibebot import latency
+from vibebot.latency import LatencyRegistry
+
+
+class LatencyRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = LatencyRegistry(window_size=100)
+
+    def test_Quantiles(self):
+        for millis in range(100, 0, -1):
+            self.registry.observe('ex', 'callback', millis)
+
+        snapshot = self.registry.snapshot()
+
+        self.assertEqual(snapshot, {('ex', 'callback'): {'count': 100, 'quantiles': {0.5: 51, 0.95: 96, 0.99: 100}}})
+
+    def test_SingleSample(self):
+        self.registry.observe('ex', 'callback', 7)
+
+        self.assertEqual(self.registry.snapshot()[('ex', 'callback')]['quantiles'], {0.5: 7, 0.95: 7, 0.99: 7})
+
+    def test_SlidingWindow(self):
+        registry = LatencyRegistry(window_size=10)
+        for millis in range(1000, 1010):
+            registry.observe('ex', 'callback', millis)
+        for millis in range(1, 11):
+            registry.observe('ex', 'callback', millis)
+
+        values = registry.snapshot()[('ex', 'callback')]
+
+        # The count is since start, the quantiles only over the last window_size samples
+        self.assertEqual(values['count'], 20)
+        self.assertEqual(values['quantiles'], {0.5: 6, 0.95: 10, 0.99: 10})
+
+    def test_Render(self):
+        self.registry.observe('ex', 'callback', 5)
+        self.registry.observe(None, 'fpga', 12)
+
+        self.assertEqual(self.registry.render(),
+                         '# TYPE latency_ms summary\n'
+                         'latency_ms{exchange="",stage="fpga",quantile="0.5"} 12\n'
+                         'latency_ms{exchange="",stage="fpga",quantile="0.95"} 12\n'
+                         'latency_ms{exchange="",stage="fpga",quantile="0.99"} 12\n'
+                         'latency_ms_count{exchange="",stage="fpga"} 1\n'
+                         'latency_ms{exchange="ex",stage="callback",quantile="0.5"} 5\n'
+                         'latency_ms{exchange="ex",stage="callback",quantile="0.95"} 5\n'
+                         'latency_ms{exchange="ex",stage="callback",quantile="0.99"} 5\n'
+                         'latency_ms_count{exchange="ex",stage="callback"} 1\n')
+
+    def test_RenderEmpty(self):
+        self.assertEqual(self.registry.render(), '# TYPE latency_ms summary\n')
+
+    def test_Forwarding(self):
+        queue = Queue.Queue()
+        self.registry.forward_to(queue)
+
+        # Observed in a consumer process: forwarded rather than recorded
+        with patch('vibebot.latency.os.getpid', return_value=-1):
+            self.registry.observe('ex', 'callback', 3)
+        self.assertEqual(queue.qsize(), 1)
+        self.assertEqual(self.registry._samples, {})
+
+        # Merged by the bot process
+        self.assertEqual(self.registry.snapshot()[('ex', 'callback')]['count'], 1)
+        self.assertTrue(queue.empty())
+
+    def test_ForwardingQueueFull(self):
+        queue = Queue.Queue(maxsize=1)
+        self.registry.forward_to(queue)
+
+        with patch('vibebot.latency.os.getpid', return_value=-1):
+            self.registry.observe('ex', 'callback', 3)
+            # Dropped rather than blocking the consumer
+            self.registry.observe('ex', 'callback', 4)
+
+        self.assertEqual(self.registry.snapshot()[('ex', 'callback')]['count'], 1)
+
+    def test_ExchangeContext(self):
+        with patch('vibebot.latency.REGISTRY', self.registry):
+            with latency.exchange_context('ex'):
+                latency.observe('fpga', 1)
+                latency.observe('fpga', 2, exchange='other')
+            latency.observe('fpga', 3)
+
+        self.assertEqual(sorted(self.registry.snapshot()), [('', 'fpga'), ('ex', 'fpga'), ('other', 'fpga')])
+
+
+class MetricsServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = latency.start_metrics_server(0, host='127.0.0.1')
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def test_Metrics(self):
+        registry = LatencyRegistry()
+        registry.observe('ex', 'callback', 5)
+
+        with patch('vibebot.latency.REGISTRY', registry):
+            response = urllib2.urlopen(self.url + '/metrics')
+
+        self.assertEqual(response.info()['Content-Type'], 'text/plain; version=0.0.4')
+        self.assertEqual(response.read(), registry.render())
+
+    def test_NotFound(self):
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            urllib2.urlopen(self.url + '/other')
+        self.assertEqual(cm.exception.code, 404)
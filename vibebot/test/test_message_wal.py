@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from vibebot.message_wal import MessageWal
+
+
+class MessageWalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'wal', 'queue-0.db')
+        self.wal = MessageWal(self.path, compact_every=3)
+        self.addCleanup(self.wal.close)
+
+    def test_AppendPending(self):
+        ids = self.wal.append([('{"a": 1}', None, None), ('\x78\x9c', 'application/json', 'zlib')])
+
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(self.wal.pending(), [(ids[0], '{"a": 1}', None, None),
+                                              (ids[1], '\x78\x9c', 'application/json', 'zlib')])
+
+    def test_MarkProcessed(self):
+        ids = self.wal.append([('1', None, None), ('2', None, None), ('3', None, None)])
+
+        self.wal.mark_processed(ids[:2])
+
+        self.assertEqual([p[0] for p in self.wal.pending()], ids[2:])
+
+    def test_PendingSurvivesReopen(self):
+        ids = self.wal.append([('1', None, None), ('2', None, None)])
+        self.wal.mark_processed(ids[:1])
+        self.wal.close()
+
+        reopened = MessageWal(self.path)
+        self.addCleanup(reopened.close)
+        self.assertEqual(reopened.pending(), [(ids[1], '2', None, None)])
+
+    def test_Compact(self):
+        ids = self.wal.append([('1', None, None), ('2', None, None), ('3', None, None), ('4', None, None)])
+
+        self.wal.mark_processed(ids[:3])
+
+        rows = self.wal._conn.execute('SELECT id FROM messages').fetchall()
+        self.assertEqual([r[0] for r in rows], ids[3:])
+
+    def test_Lock(self):
+        self.wal.open()
+
+        other = MessageWal(self.path)
+        self.addCleanup(other.close)
+        self.assertFalse(other.lock(blocking=False))
+        self.wal.close()
+        self.assertTrue(other.lock(blocking=False))
+
+    def test_SynchronousNormal(self):
+        self.wal.open()
+
+        self.assertEqual(self.wal._conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        # 1 = NORMAL
+        self.assertEqual(self.wal._conn.execute('PRAGMA synchronous').fetchone()[0], 1)
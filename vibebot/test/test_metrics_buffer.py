@@ -0,0 +1,101 @@
+import unittest
+
+from mock import patch
+
+from vibebot.metrics_buffer import BufferedStatsClient
+
+
+class BufferedStatsClientTest(unittest.TestCase):
+
+    def setUp(self):
+        # No flush thread, flush() is called explicitly
+        self.statsd = BufferedStatsClient('localhost', 8125, flush_interval=0, max_events=100, max_timings=10)
+        self.sent = []
+        self.statsd.client._send = self.sent.append
+
+    def lines(self):
+        return sorted(line for packet in self.sent for line in packet.split('\n'))
+
+    def test_Aggregate(self):
+        self.statsd.incr('a')
+        self.statsd.incr('a', 2)
+        self.statsd.decr('b')
+        self.statsd.gauge('g', 1)
+        self.statsd.gauge('g', 5)
+        self.statsd.gauge('d', 2, delta=True)
+        self.statsd.gauge('d', 3, delta=True)
+        self.assertEqual(self.sent, [])
+
+        self.statsd.flush()
+
+        self.assertEqual(self.lines(), ['a:3|c', 'b:-1|c', 'd:+5|g', 'g:5|g'])
+
+    def test_FlushEmpties(self):
+        self.statsd.incr('a')
+        self.statsd.flush()
+        self.statsd.flush()
+
+        self.assertEqual(self.lines(), ['a:1|c'])
+
+    def test_ZeroCounterNotSent(self):
+        self.statsd.incr('a')
+        self.statsd.decr('a')
+        self.statsd.incr('b')
+
+        self.statsd.flush()
+
+        self.assertEqual(self.lines(), ['b:1|c'])
+
+    def test_Timings(self):
+        for delta in (10, 20):
+            self.statsd.timing('t', delta)
+
+        self.statsd.flush()
+
+        self.assertEqual(self.lines(), ['t:10.000000|ms', 't:20.000000|ms'])
+
+    def test_SampledTimings(self):
+        for delta in range(40):
+            self.statsd.timing('t', delta)
+
+        self.statsd.flush()
+
+        lines = self.lines()
+        # max_timings samples out of 40, each standing for 4 timings
+        self.assertEqual(len(lines), 10)
+        self.assertTrue(all(line.endswith('|ms|@0.25') for line in lines))
+
+    def test_FlushWhenFull(self):
+        for _ in range(99):
+            self.statsd.incr('a')
+        self.assertEqual(self.sent, [])
+
+        self.statsd.incr('a')
+
+        self.assertEqual(self.lines(), ['a:100|c'])
+
+    def test_Fork(self):
+        self.statsd.incr('a')
+
+        # Metrics recorded by the parent are not sent again by the child
+        with patch('vibebot.metrics_buffer.os.getpid', return_value=-1):
+            self.statsd.incr('b')
+            self.statsd.flush()
+
+        self.assertEqual(self.lines(), ['b:1|c'])
+
+    def test_FlushOtherProcess(self):
+        self.statsd.incr('a')
+
+        # A client inherited through a fork only flushes once it was used in the child
+        with patch('vibebot.metrics_buffer.os.getpid', return_value=-1):
+            self.statsd.flush()
+
+        self.assertEqual(self.sent, [])
+
+    def test_SendError(self):
+        self.statsd.client._send = None
+        self.statsd.incr('a')
+
+        # Logged, never raised
+        self.statsd.flush()
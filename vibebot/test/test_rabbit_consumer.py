@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock
+
+from vibebot.message_wal import MessageWal
+from vibebot.rabbit_consumer import RabbitConsumer, RabbitConsumerHost, Message
+
+
+class RabbitConsumerWalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.wal_dir)
+        self.callback = Mock(return_value=[])
+
+    def consumer(self, consumer_id=0, **kwargs):
+        consumer = RabbitConsumer('bot', 'exchange', self.callback, 'user', 'pw', 'host', 5672, consumer_id,
+                                  statsd=Mock(), wal_dir=self.wal_dir, **kwargs)
+        consumer._channel = Mock()
+        self.addCleanup(consumer.wal.close)
+        return consumer
+
+    def write_wal(self, consumer_id, bodies, processed=0):
+        wal = MessageWal(os.path.join(self.wal_dir, 'exchange-bot-{}.db'.format(consumer_id)))
+        ids = wal.append([Message(body, None, None) for body in bodies])
+        wal.mark_processed(ids[:processed])
+        wal.close()
+
+    def test_ReplayWal(self):
+        self.write_wal(0, ['{"i": 0}', '{"i": 1}', '{"i": 2}'], processed=1)
+        consumer = self.consumer()
+
+        consumer.replay_wal()
+        # Only once, not on every reconnect
+        consumer.replay_wal()
+
+        self.assertEqual([c[0][0] for c in self.callback.call_args_list], [{'i': 1}, {'i': 2}])
+        self.assertEqual(consumer.wal.pending(), [])
+
+    def test_ReplayWalBatches(self):
+        self.write_wal(0, ['{"i": 0}', '{"i": 1}', '{"i": 2}'])
+        consumer = self.consumer(batch_size=2)
+
+        consumer.replay_wal()
+
+        self.assertEqual([c[0][0] for c in self.callback.call_args_list], [[{'i': 0}, {'i': 1}], [{'i': 2}]])
+
+    def test_ReplayWalOfOtherConsumers(self):
+        self.write_wal(3, ['{"i": 3}'])
+        self.write_wal(5, ['{"i": 5}'])
+        busy = MessageWal(os.path.join(self.wal_dir, 'exchange-bot-5.db'))
+        busy.lock()
+        self.addCleanup(busy.close)
+        consumer = self.consumer()
+
+        consumer.replay_wal()
+
+        # The log of consumer 5 is held by a running consumer
+        self.assertEqual([c[0][0] for c in self.callback.call_args_list], [{'i': 3}])
+
+    def test_ReplayWalErrors(self):
+        self.write_wal(0, ['not json'])
+        consumer = self.consumer()
+
+        consumer.replay_wal()
+
+        self.assertFalse(self.callback.called)
+        self.assertEqual(consumer._channel.basic_publish.call_args[1]['routing_key'], consumer.error_queue_name)
+        self.assertEqual(consumer.wal.pending(), [])
+
+    def test_PoolModeSkipsWal(self):
+        consumer = self.consumer(worker_count=2)
+        consumer._connection = Mock()
+        consumer.start_pool()
+        self.addCleanup(consumer._pool.terminate)
+
+        for tag in (1, 2):
+            consumer.on_message(None, Mock(delivery_tag=tag), Mock(content_type=None, content_encoding=None),
+                                '{"i": %d}' % tag)
+        # Not acked until processed, rabbit redelivers them if the consumer dies: nothing to replay on top of that
+        self.assertEqual(consumer.wal.pending(), [])
+        self.assertFalse(consumer._channel.basic_ack.called)
+
+        consumer._pool.close()
+        consumer._pool.join()
+        consumer.complete_jobs()
+
+        self.assertEqual(sorted(c[0][0]['i'] for c in self.callback.call_args_list), [1, 2])
+        consumer._channel.basic_ack.assert_called_once_with(2, multiple=True)
+        self.assertEqual(consumer.wal.pending(), [])
+
+
+class RabbitConsumerStopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = Mock()
+        self.consumer = RabbitConsumer('bot', 'exchange', Mock(), 'user', 'pw', 'host', 5672, statsd=Mock())
+        self.consumer.attach(self.connection)
+        self.consumer._channel = Mock()
+
+    def test_StopConsuming(self):
+        self.consumer._consumer_tag = 'tag'
+        self.consumer.request_stop()
+
+        self.consumer.check_stop_requested()
+
+        self.assertTrue(self.consumer._channel.basic_cancel.called)
+
+    def test_StopPaused(self):
+        # Paused by the flow control: no consumer tag, the channel is still open
+        self.consumer._consumer_tag = None
+        channel = self.consumer._channel
+        self.consumer.request_stop()
+
+        self.consumer.check_stop_requested()
+
+        channel.close.assert_called_once_with()
+        self.assertFalse(channel.basic_cancel.called)
+        self.assertFalse(self.connection.close.called)
+
+    def test_HostClosesOnceConsumersStopped(self):
+        host = RabbitConsumerHost('bot', [self.consumer], 'user', 'pw', 'host', 5672)
+        host._connection = self.connection
+
+        self.consumer._closing = True
+        host.check_consumers_stopped()
+        self.assertFalse(self.connection.close.called)
+
+        self.consumer._channel = None
+        host.check_consumers_stopped()
+        self.connection.close.assert_called_once_with()
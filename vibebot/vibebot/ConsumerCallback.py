@@ -1,29 +1,42 @@
 import time
 import logging
+import multiprocessing
+
+import latency
 
 
 class ConsumerCallback(object):
 
     logger = logging.getLogger(__name__)
 
-    def __init__(self, consumer_id, exchange, callback_func):
+    def __init__(self, consumer_id, exchange, callback_func, consumer_options=None):
         self.consumer_id = consumer_id
         self.exchange = exchange
         self.callback_func = callback_func
+        self.consumer_options = consumer_options or {}
         self.function_calls = 0
         self.total_execution_time = 0
+        # Seconds spent in the callback since start, shared with the consumer process, see EventBot.__utilization__
+        self.busy_seconds = multiprocessing.Value('d', 0.0)
 
     def timed_callback_execution(self, func_arg):
         self.function_calls += 1
         start = time.time()
-        func_ret = self.callback_func(func_arg)
+        try:
+            # Stages timed by the callback are recorded under this exchange
+            with latency.exchange_context(self.exchange):
+                func_ret = self.callback_func(func_arg)
+        finally:
+            with self.busy_seconds.get_lock():
+                self.busy_seconds.value += time.time() - start
         exec_time = int((time.time() - start) * 1000)
         self.total_execution_time += exec_time
+        latency.observe('callback', exec_time, exchange=self.exchange)
 
         self.logger.debug("Consumer {0} Callback execution time: {1}ms".format(self.consumer_id, exec_time))
 
         # if we have processed 100 callbacks, log out the average execution time at INFO then reset the total
-        if self.function_calls % 2 == 0:
+        if self.function_calls % 100 == 0:
             average_execution_time = self.total_execution_time / 100
             self.logger.info("Consumer {0} Avg callback execution time (last 100): {1}ms".format(self.consumer_id,
                                                                                                  average_execution_time))
@@ -7,11 +7,15 @@ from vibepy import read_config
 
 # logging
 import logging
+import multiprocessing
 import graypy
 
 # local
 from exchange_callback import ExchangeCallback
-from rabbit_consumer import RabbitConsumerProc, RabbitConsumerThread
+from metrics_buffer import BufferedStatsClient
+import latency
+from rabbit_consumer import RabbitConsumer, RabbitConsumerProc, RabbitConsumerThread, RabbitConsumerHostProc, \
+    RabbitConsumerHostThread
 
 
 class AbstractBot(object):
@@ -19,7 +23,12 @@ class AbstractBot(object):
     db = None
     statsd = None
 
-    def __init__(self, bot_id_setting, config, exchange_callbacks, callback_consumer_num=1, use_threading=False):
+    def __init__(self, bot_id_setting, config, exchange_callbacks, callback_consumer_num=1, use_threading=False,
+                 shared_connection=False):
+        """
+        :param shared_connection: run all the consumers on their own channel of a single connection (one thread or
+        process) instead of a connection and thread/process each. Also enabled by [bot] SHARED_CONNECTION
+        """
 
         self.config = config
 
@@ -40,11 +49,27 @@ class AbstractBot(object):
             self.logger.error("Statsd config must be supplied! Section [statsd] missing from config")
             exit()
 
-        if use_threading:
+        self.shared_connection = shared_connection
+        if self.config.has_option('bot', 'SHARED_CONNECTION'):
+            self.shared_connection = self.config.getboolean('bot', 'SHARED_CONNECTION')
+
+        if self.shared_connection:
+            # Consumers are run by the host
+            self.rabbit_klass = RabbitConsumer
+            self.host_klass = RabbitConsumerHostThread if use_threading else RabbitConsumerHostProc
+        elif use_threading:
             self.rabbit_klass = RabbitConsumerThread
         else:
             self.rabbit_klass = RabbitConsumerProc
 
+        # Latency histograms per exchange and stage served on http://host:METRICS_PORT/metrics
+        self.metrics_port = None
+        if self.config.has_option('bot', 'METRICS_PORT'):
+            self.metrics_port = self.config.getint('bot', 'METRICS_PORT')
+            if not use_threading:
+                # Must be set before the consumer processes are forked
+                latency.REGISTRY.forward_to(multiprocessing.Queue(maxsize=100000))
+
         exchange_callbacks = self.__configure_callbacks__(exchange_callbacks, callback_consumer_num)
         self.consumers = self.__build_consumers__(exchange_callbacks)
 
@@ -55,9 +80,13 @@ class AbstractBot(object):
     def stop(self):
         self.logger.info("Stopping consumers")
         self.__stop_consumers__()
+        self.flush_metrics()
         exit()
 
     def start(self):
+        if self.metrics_port:
+            latency.start_metrics_server(self.metrics_port)
+
         self.logger.info("Starting consumers")
 
         try:
@@ -86,8 +115,25 @@ class AbstractBot(object):
         statsdport = config.get('statsd', 'STATSD_PORT')
         statsd_namespace = config.get('statsd', 'STATSD_NAMESPACE')
         statsd_namespace += "." + self.bot_id
-        self.logger.info("Creating StatsClient with prefix " + statsd_namespace)
-        return StatsClient(host=statsdhost, port=statsdport, prefix=statsd_namespace, maxudpsize=512)
+
+        # Metrics are aggregated in process and flushed every STATSD_FLUSH_INTERVAL seconds, 0 sends each one right away
+        flush_interval = 1.0
+        if config.has_option('statsd', 'STATSD_FLUSH_INTERVAL'):
+            flush_interval = config.getfloat('statsd', 'STATSD_FLUSH_INTERVAL')
+        if flush_interval <= 0:
+            self.logger.info("Creating StatsClient with prefix " + statsd_namespace)
+            return StatsClient(host=statsdhost, port=statsdport, prefix=statsd_namespace, maxudpsize=512)
+
+        max_events = 10000
+        if config.has_option('statsd', 'STATSD_BUFFER_SIZE'):
+            max_events = config.getint('statsd', 'STATSD_BUFFER_SIZE')
+        self.logger.info("Creating BufferedStatsClient with prefix " + statsd_namespace)
+        return BufferedStatsClient(host=statsdhost, port=statsdport, prefix=statsd_namespace, maxudpsize=512,
+                                   flush_interval=flush_interval, max_events=max_events)
+
+    def flush_metrics(self):
+        if hasattr(self.statsd, 'flush'):
+            self.statsd.flush()
 
     def __build_consumers__(self, exchange_callbacks):
         raise NotImplementedError
@@ -0,0 +1,93 @@
+import json
+import logging
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+MSGPACK_TYPES = (MSGPACK, 'application/x-msgpack')
+
+IDENTITY = 'identity'
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+
+logger = logging.getLogger(__name__)
+
+
+class CodecError(ValueError):
+    # A ValueError so that undecodable messages are handled like invalid JSON always was
+    pass
+
+
+def decode(body, content_type=None, content_encoding=None):
+    """
+    Decodes a message body according to its AMQP content_type and content_encoding properties. Messages without
+    content type are JSON, like every message before the codecs were introduced.
+
+    msgpack keeps binary values (e.g. an XML document published as bytes) as they are, JSON strings come back as
+    unicode.
+    """
+    body = decompress(body, content_encoding)
+    if content_type in MSGPACK_TYPES:
+        if msgpack is None:
+            raise CodecError('Received a msgpack message but the msgpack module is not installed')
+        try:
+            return msgpack.unpackb(body, raw=False)
+        except Exception as e:
+            raise CodecError('Invalid msgpack message: {}'.format(e))
+    return json.loads(body)
+
+
+def encode(obj, content_type=JSON, content_encoding=None):
+    """
+    :return: the message body, to be published with the same content_type and content_encoding properties
+    """
+    if content_type in MSGPACK_TYPES:
+        if msgpack is None:
+            raise CodecError('msgpack is not installed')
+        body = msgpack.packb(obj, use_bin_type=True)
+    else:
+        body = json.dumps(obj, ensure_ascii=True)
+    return compress(body, content_encoding)
+
+
+def compress(body, content_encoding):
+    if content_encoding in (None, '', IDENTITY):
+        return body
+    if content_encoding == ZLIB:
+        return zlib.compress(body, 1)
+    if content_encoding == ZSTD:
+        if zstd is None:
+            raise CodecError('zstandard is not installed')
+        return zstd.ZstdCompressor(level=3).compress(body)
+    raise CodecError('Unsupported content encoding {}'.format(content_encoding))
+
+
+def decompress(body, content_encoding):
+    """
+    Unknown encodings (e.g. a charset such as utf-8, which many publishers set) are treated as identity
+    """
+    if content_encoding == ZSTD and zstd is None:
+        raise CodecError('Received a zstd message but the zstandard module is not installed')
+    try:
+        if content_encoding == ZLIB:
+            return zlib.decompress(body)
+        if content_encoding == ZSTD:
+            # Frames written by the stream API don't carry their size
+            return zstd.ZstdDecompressor().decompressobj().decompress(body)
+    except Exception as e:
+        raise CodecError('Unable to decompress a {} message: {}'.format(content_encoding, e))
+
+    if content_encoding not in (None, '', IDENTITY):
+        logger.warning('Unknown content encoding {}, reading the message as is'.format(content_encoding))
+    return body
@@ -2,6 +2,8 @@ import Queue
 
 import time
 
+import pika
+
 from rabbit_consumer import RabbitConsumerProc, RabbitConsumerThread
 from abstract_bot import AbstractBot
 from vibebot.ConsumerCallback import ConsumerCallback
@@ -10,35 +12,97 @@ from vibebot.ConsumerCallback import ConsumerCallback
 class EventBot(AbstractBot):
     def __build_consumers__(self, exchange_callbacks):
 
-        self.logger.info("Event bot created v0.0.11")
+        self.logger.info("Event bot created v0.0.12")
 
         if len(exchange_callbacks) == 0:
             self.logger.error("No callbacks declared, exiting EventBot")
             exit()
 
-        consumers = {}
-        consumer_id_ctr = 0
+        self.consumers = {}
+        self.next_consumer_id = 0
         self.consumers_callbacks = {}
         self.internal_error_queue = Queue.Queue()
+        self.exchange_callbacks = exchange_callbacks
+        # Consumer ids of each exchange callback, in creation order
+        self.exchange_consumers = dict((exchange_callback, []) for exchange_callback in exchange_callbacks)
+        # Consumers asked to stop, kept until they are done
+        self.retired_consumers = []
 
         self.rabbit_user = self.config.get('rabbit', 'RABBIT_USER')
         self.rabbit_pw = self.config.get('rabbit', 'RABBIT_PW')
         self.rabbit_host = self.config.get('rabbit', 'RABBIT_HOST')
         self.rabbit_port = int(self.config.get('rabbit', 'RABBIT_PORT'))
+        # Directory of the consumers write ahead logs, messages are acked without being persisted if not set
+        self.wal_dir = None
+        if self.config.has_option('rabbit', 'WAL_DIR'):
+            self.wal_dir = self.config.get('rabbit', 'WAL_DIR')
         self.stopping = False
 
+        # Autoscaling of the consumers of the exchange callbacks with min_consumers < max_consumers: every
+        # AUTOSCALE_INTERVAL seconds a consumer is added when the queue holds more than AUTOSCALE_BACKLOG messages per
+        # consumer and the consumers spent at least AUTOSCALE_BUSY_UTILIZATION of their time in the callback, and one
+        # is retired after the queue was found empty with consumers busy less than AUTOSCALE_IDLE_UTILIZATION of their
+        # time AUTOSCALE_IDLE_SAMPLES times in a row
+        self.autoscale_interval = 10
+        if self.config.has_option('bot', 'AUTOSCALE_INTERVAL'):
+            self.autoscale_interval = self.config.getint('bot', 'AUTOSCALE_INTERVAL')
+        self.autoscale_backlog = 10
+        if self.config.has_option('bot', 'AUTOSCALE_BACKLOG'):
+            self.autoscale_backlog = self.config.getint('bot', 'AUTOSCALE_BACKLOG')
+        self.autoscale_idle_samples = 3
+        if self.config.has_option('bot', 'AUTOSCALE_IDLE_SAMPLES'):
+            self.autoscale_idle_samples = self.config.getint('bot', 'AUTOSCALE_IDLE_SAMPLES')
+        self.autoscale_busy_utilization = 0.75
+        if self.config.has_option('bot', 'AUTOSCALE_BUSY_UTILIZATION'):
+            self.autoscale_busy_utilization = self.config.getfloat('bot', 'AUTOSCALE_BUSY_UTILIZATION')
+        self.autoscale_idle_utilization = 0.25
+        if self.config.has_option('bot', 'AUTOSCALE_IDLE_UTILIZATION'):
+            self.autoscale_idle_utilization = self.config.getfloat('bot', 'AUTOSCALE_IDLE_UTILIZATION')
+        self.idle_samples = dict((exchange_callback, 0) for exchange_callback in exchange_callbacks)
+        # Consumer id -> (time, busy_seconds) of its previous utilization sample
+        self.busy_samples = {}
+        self.last_autoscale = 0
+        self.autoscale_connection = None
+
         for exchange_callback in exchange_callbacks:
-            for consumerCount in range(0, exchange_callback.consumer_count):
-                self.logger.info("Creating exchange callback for exchange: %s with consumer id: %s", exchange_callback.exchange, consumer_id_ctr)
-                consumer_callback = ConsumerCallback(consumer_id_ctr, exchange_callback.exchange, exchange_callback.callback_func)
-                thread = self.rabbit_klass(self.bot_id, exchange_callback.exchange, self.callback_wrapper(consumer_callback), self.rabbit_user, self.rabbit_pw,
-                                      self.rabbit_host, self.rabbit_port, consumer_id_ctr, self.internal_error_queue, self.statsd)
-                consumers[consumer_id_ctr] = thread
-                self.consumers_callbacks[consumer_id_ctr] = consumer_callback
-                consumer_id_ctr += 1
+            consumer_count = min(max(exchange_callback.consumer_count, exchange_callback.min_consumers),
+                                 exchange_callback.max_consumers)
+            for consumerCount in range(0, consumer_count):
+                self.__add_consumer__(exchange_callback)
+
+        if self.shared_connection:
+            # A single host runs all the consumers, it is what gets started, restarted and stopped
+            self.consumers = {0: self.__create_host__(0)}
 
         self.logger.info("Event bot created!")
-        return consumers
+        return self.consumers
+
+    def __create_host__(self, host_id):
+        consumers = [self.__create_consumer__(consumer_id, consumer_callback)
+                     for consumer_id, consumer_callback in sorted(self.consumers_callbacks.iteritems())]
+        return self.host_klass(self.bot_id, consumers, self.rabbit_user, self.rabbit_pw, self.rabbit_host,
+                               self.rabbit_port, host_id, self.internal_error_queue)
+
+    def __add_consumer__(self, exchange_callback):
+        consumer_id = self.next_consumer_id
+        self.next_consumer_id += 1
+        self.logger.info("Creating exchange callback for exchange: %s with consumer id: %s", exchange_callback.exchange, consumer_id)
+        consumer_callback = ConsumerCallback(consumer_id, exchange_callback.exchange, exchange_callback.callback_func,
+                                             exchange_callback.consumer_options())
+        thread = self.__create_consumer__(consumer_id, consumer_callback)
+        self.consumers[consumer_id] = thread
+        self.consumers_callbacks[consumer_id] = consumer_callback
+        self.exchange_consumers[exchange_callback].append(consumer_id)
+        return thread
+
+    def __retire_consumer__(self, exchange_callback):
+        consumer_id = self.exchange_consumers[exchange_callback].pop()
+        self.logger.info("Retiring consumer id: %s of exchange: %s", consumer_id, exchange_callback.exchange)
+        thread = self.consumers.pop(consumer_id)
+        del self.consumers_callbacks[consumer_id]
+        self.busy_samples.pop(consumer_id, None)
+        thread.request_stop()
+        self.retired_consumers.append(thread)
 
     def __start_consumers__(self):
 
@@ -47,23 +111,125 @@ class EventBot(AbstractBot):
 
         while not self.stopping:
             time.sleep(2)
+            if time.time() - self.last_autoscale >= self.autoscale_interval:
+                self.last_autoscale = time.time()
+                self.__autoscale__()
+
             while not self.internal_error_queue.empty():
                 consumer_id = self.internal_error_queue.get()
+                if consumer_id not in self.consumers:
+                    # retired meanwhile
+                    continue
                 self.logger.warn("Internal error detected restarting consumer:" + str(consumer_id))
 
                 thread = self.consumers[consumer_id]
-                callback = self.consumers_callbacks[consumer_id]
                 # Exception thrown so this threadess should be dead - call join
                 thread.join()
 
-                new_thread = self.rabbit_klass(self.bot_id, callback.exchange, self.callback_wrapper(callback), self.rabbit_user,
-                                          self.rabbit_pw, self.rabbit_host, self.rabbit_port, consumer_id, self.internal_error_queue, self.statsd)
+                if self.shared_connection:
+                    new_thread = self.__create_host__(consumer_id)
+                    self.statsd.incr('host.restart')
+                else:
+                    callback = self.consumers_callbacks[consumer_id]
+                    new_thread = self.__create_consumer__(consumer_id, callback)
+                    self.statsd.incr(callback.exchange + "." + 'callback.restart')
 
                 self.consumers[consumer_id] = new_thread
-
-                self.statsd.incr(callback.exchange + "." + 'callback.restart')
                 new_thread.start()
 
+    def __autoscale__(self):
+        if self.shared_connection:
+            # Consumers can't be added to a running host
+            return
+
+        # Reap the retired consumers which are done
+        for thread in list(self.retired_consumers):
+            thread.join(0)
+            if not thread.is_alive():
+                self.retired_consumers.remove(thread)
+
+        for exchange_callback in self.exchange_callbacks:
+            if not exchange_callback.autoscaled():
+                continue
+
+            depth = self.__queue_depth__(exchange_callback.get_queue_name(self.bot_id))
+            if depth is None:
+                continue
+
+            consumer_count = len(self.exchange_consumers[exchange_callback])
+            prefix = exchange_callback.exchange + "."
+            self.statsd.gauge(prefix + 'queue.depth', depth)
+            utilization = self.__utilization__(exchange_callback)
+            if utilization is not None:
+                self.statsd.gauge(prefix + 'consumers.utilization', round(utilization, 2))
+
+            # Consumers mostly idle despite a backlog are held back (flow control pause, slow publisher acks...), more
+            # of them wouldn't drain the queue faster. An empty queue with busy consumers is only just kept up with
+            busy = utilization is None or utilization >= self.autoscale_busy_utilization
+            idle = utilization is not None and utilization < self.autoscale_idle_utilization
+
+            if depth > self.autoscale_backlog * consumer_count and consumer_count < exchange_callback.max_consumers \
+                    and busy:
+                self.__add_consumer__(exchange_callback).start()
+                self.statsd.incr(prefix + 'autoscale.up')
+                self.idle_samples[exchange_callback] = 0
+            elif depth == 0 and idle:
+                self.idle_samples[exchange_callback] += 1
+                if self.idle_samples[exchange_callback] >= self.autoscale_idle_samples and \
+                        consumer_count > exchange_callback.min_consumers:
+                    self.__retire_consumer__(exchange_callback)
+                    self.statsd.incr(prefix + 'autoscale.down')
+                    self.idle_samples[exchange_callback] = 0
+            else:
+                self.idle_samples[exchange_callback] = 0
+
+            self.statsd.gauge(prefix + 'consumers', len(self.exchange_consumers[exchange_callback]))
+
+    def __utilization__(self, exchange_callback):
+        """
+        :return: fraction of the time the consumers of the exchange callback spent in the callback since the previous
+        sample, out of worker_count callbacks at a time per consumer. None when none of them was sampled before
+        """
+        now = time.time()
+        workers = max(1, exchange_callback.worker_count)
+        busy, capacity = 0.0, 0.0
+        for consumer_id in self.exchange_consumers[exchange_callback]:
+            busy_seconds = self.consumers_callbacks[consumer_id].busy_seconds.value
+            previous = self.busy_samples.get(consumer_id)
+            self.busy_samples[consumer_id] = (now, busy_seconds)
+            if previous is not None:
+                busy += busy_seconds - previous[1]
+                capacity += (now - previous[0]) * workers
+        if capacity <= 0:
+            return None
+        return min(1.0, busy / capacity)
+
+    def __queue_depth__(self, queue_name):
+        """
+        :return: number of ready messages of the queue through a passive declare, None if it can't be sampled
+        """
+        try:
+            if self.autoscale_connection is None or not self.autoscale_connection.is_open:
+                creds = pika.PlainCredentials(self.rabbit_user, self.rabbit_pw)
+                self.autoscale_connection = pika.BlockingConnection(
+                    pika.ConnectionParameters(host=self.rabbit_host, port=self.rabbit_port, credentials=creds))
+            channel = self.autoscale_connection.channel()
+            try:
+                return channel.queue_declare(queue=queue_name, passive=True).method.message_count
+            finally:
+                if channel.is_open:
+                    channel.close()
+        except Exception as e:
+            # e.g. the queue isn't declared yet by the consumers, a passive declare then closes the channel
+            self.logger.warn("Unable to sample the depth of queue {}: {}".format(queue_name, e))
+            return None
+
+    def __create_consumer__(self, consumer_id, consumer_callback):
+        return self.rabbit_klass(self.bot_id, consumer_callback.exchange, self.callback_wrapper(consumer_callback),
+                                 self.rabbit_user, self.rabbit_pw, self.rabbit_host, self.rabbit_port, consumer_id,
+                                 self.internal_error_queue, self.statsd, wal_dir=self.wal_dir,
+                                 **consumer_callback.consumer_options)
+
     def __stop_consumers__(self):
         self.stopping = True
         for thread in self.consumers.values():
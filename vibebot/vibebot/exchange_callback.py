@@ -1,8 +1,62 @@
 class ExchangeCallback(object):
-    def __init__(self, exchange, callback_func, consumer_count=1):
+    def __init__(self, exchange, callback_func, consumer_count=1, routing_key='', queue_name=None,
+                 prefetch_count=None, batch_size=1, batch_timeout_ms=100, worker_count=0, min_consumers=None,
+                 max_consumers=None, max_latency_ms=None, max_error_rate=None, max_priority=None):
+        """
+        :param routing_key: routing key the queue is bound with, messages published with another key are not received
+        (for direct/topic exchanges)
+        :param queue_name: defaults to <exchange>-<bot_id>, shared by all the instances of the bot
+        :param prefetch_count: unacked messages rabbit delivers to each consumer, defaults to
+        max(1, batch_size * worker_count)
+        :param batch_size: when > 1 callback_func receives a list of up to batch_size json bodies instead of a single
+        one, with whatever arrived within batch_timeout_ms of the first message of the batch
+        :param worker_count: when > 0 callback_func runs on a pool of worker threads so that slow callbacks don't block
+        the connection (heartbeats, other deliveries). Messages are then acked once processed. callback_func must be
+        thread safe
+        :param min_consumers, max_consumers: bounds within which EventBot adds or retires consumers depending on the
+        queue depth, both default to consumer_count (no autoscaling)
+        :param max_latency_ms, max_error_rate: when the average callback latency or the fraction of messages sent to
+        the error queue exceed these the prefetch is reduced, down to pausing the consumer for a while (None disables).
+        The prefetch is only adapted in pool mode with a prefetch above 1, see FlowController, otherwise the consumer is
+        only paused
+        :param max_priority: declares a priority queue (x-max-priority), messages published with a higher AMQP priority
+        are delivered first. Can't be changed on an existing queue
+        """
         self.exchange = exchange
         self.callback_func = callback_func
         self.consumer_count = consumer_count
+        self.routing_key = routing_key
+        self.queue_name = queue_name
+        self.prefetch_count = prefetch_count
+        self.batch_size = batch_size
+        self.batch_timeout_ms = batch_timeout_ms
+        self.worker_count = worker_count
+        self.max_latency_ms = max_latency_ms
+        self.max_error_rate = max_error_rate
+        self.max_priority = max_priority
+        self.min_consumers = consumer_count if min_consumers is None else min_consumers
+        self.max_consumers = max(consumer_count if max_consumers is None else max_consumers, self.min_consumers)
+
+    def autoscaled(self):
+        return self.max_consumers > self.min_consumers
+
+    def get_queue_name(self, bot_id):
+        # Same default as RabbitConsumer
+        return self.queue_name or self.exchange + "-" + bot_id
+
+    def consumer_options(self):
+        """
+        :return: keyword arguments of the RabbitConsumer
+        """
+        return {'routing_key': self.routing_key,
+                'queue_name': self.queue_name,
+                'prefetch_count': self.prefetch_count,
+                'batch_size': self.batch_size,
+                'batch_timeout_ms': self.batch_timeout_ms,
+                'worker_count': self.worker_count,
+                'max_latency_ms': self.max_latency_ms,
+                'max_error_rate': self.max_error_rate,
+                'max_priority': self.max_priority}
 
 
 
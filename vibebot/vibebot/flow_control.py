@@ -0,0 +1,57 @@
+class FlowController(object):
+    """Adapts the prefetch of a consumer to what its callback can sustain (AIMD).
+
+    The latency and errors of the processed messages are evaluated every window messages. When the average latency
+    is above max_latency_ms or the error rate above max_error_rate the prefetch is halved, and consumption is paused
+    for pause_seconds once the prefetch is down to 1. When healthy again the prefetch grows back by one per window up
+    to max_prefetch.
+
+    The prefetch only throttles a consumer in pool mode (worker_count > 0), where messages stay unacked while they are
+    processed, and only adapts when max_prefetch is above 1. Otherwise the only lever left is pausing the consumption.
+    """
+
+    QOS = 'qos'
+    PAUSE = 'pause'
+
+    def __init__(self, max_prefetch, max_latency_ms=None, max_error_rate=None, window=20, pause_seconds=5):
+        self.max_prefetch = max_prefetch
+        self.max_latency_ms = max_latency_ms
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.pause_seconds = pause_seconds
+
+        self.prefetch = max_prefetch
+        self.paused = False
+        self._latencies = []
+        self._errors = 0
+
+    def record(self, latency_ms, errors=0):
+        """
+        :return: None, QOS when the prefetch must be set to self.prefetch or PAUSE when consumption must be paused
+        """
+        self._latencies.append(latency_ms)
+        self._errors += errors
+        if len(self._latencies) < self.window:
+            return None
+
+        avg_latency = sum(self._latencies) / float(len(self._latencies))
+        error_rate = self._errors / float(len(self._latencies))
+        self._latencies, self._errors = [], 0
+
+        overloaded = (self.max_latency_ms is not None and avg_latency > self.max_latency_ms) or \
+                     (self.max_error_rate is not None and error_rate > self.max_error_rate)
+        if overloaded:
+            if self.prefetch > 1:
+                self.prefetch = max(1, self.prefetch // 2)
+                return self.QOS
+            self.paused = True
+            return self.PAUSE
+
+        if self.prefetch < self.max_prefetch:
+            self.prefetch += 1
+            return self.QOS
+        return None
+
+    def resume(self):
+        self.paused = False
+        self._latencies, self._errors = [], 0
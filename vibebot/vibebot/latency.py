@@ -0,0 +1,146 @@
+import os
+import Queue
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_context = threading.local()
+
+
+class LatencyRegistry(object):
+    """Latency histograms (in ms) keyed by exchange and stage.
+
+    Each histogram keeps the last window_size samples so the quantiles follow recent behaviour rather than being
+    diluted by the whole uptime of the bot. Consumer processes can't share memory with the bot, once forward_to()
+    was called observations made in another process are sent to the bot through a multiprocessing queue and merged
+    by collect().
+    """
+
+    def __init__(self, window_size=1024):
+        self.window_size = window_size
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._counts = {}
+        self._queue = None
+        self._owner_pid = os.getpid()
+
+    def forward_to(self, queue):
+        self._queue = queue
+        self._owner_pid = os.getpid()
+
+    def observe(self, exchange, stage, millis):
+        key = (exchange or '', stage)
+        if self._queue is not None and os.getpid() != self._owner_pid:
+            try:
+                self._queue.put_nowait((key, millis))
+            except Queue.Full:
+                pass
+            return
+        self._record(key, millis)
+
+    def collect(self):
+        # Merges the observations forwarded by the consumer processes
+        if self._queue is None:
+            return
+        while True:
+            try:
+                key, millis = self._queue.get_nowait()
+            except Queue.Empty:
+                return
+            self._record(key, millis)
+
+    def snapshot(self):
+        """
+        :return: dict of (exchange, stage) -> {'count': n, 'quantiles': {q: ms}}, count is since start, the quantiles
+        are computed over the window
+        """
+        self.collect()
+        with self._lock:
+            items = [(key, sorted(samples), self._counts[key]) for key, samples in self._samples.iteritems()]
+
+        snapshot = {}
+        for key, samples, count in items:
+            quantiles = dict((q, samples[min(len(samples) - 1, int(q * len(samples)))]) for q in QUANTILES)
+            snapshot[key] = {'count': count, 'quantiles': quantiles}
+        return snapshot
+
+    def render(self):
+        """
+        :return: the snapshot in the prometheus text format
+        """
+        lines = ['# TYPE latency_ms summary']
+        for (exchange, stage), values in sorted(self.snapshot().iteritems()):
+            labels = 'exchange="{}",stage="{}"'.format(exchange, stage)
+            for q in QUANTILES:
+                lines.append('latency_ms{{{},quantile="{}"}} {}'.format(labels, q, values['quantiles'][q]))
+            lines.append('latency_ms_count{{{}}} {}'.format(labels, values['count']))
+        return '\n'.join(lines) + '\n'
+
+    def _record(self, key, millis):
+        with self._lock:
+            if key not in self._samples:
+                self._samples[key] = deque(maxlen=self.window_size)
+                self._counts[key] = 0
+            self._samples[key].append(millis)
+            self._counts[key] += 1
+
+
+# Process wide registry, used by the consumers and by the bots' own stages
+REGISTRY = LatencyRegistry()
+
+
+def observe(stage, millis, exchange=None):
+    """
+    Records the latency of a stage, under the exchange whose message is being processed by the current thread unless
+    one is given
+    """
+    REGISTRY.observe(exchange if exchange is not None else current_exchange(), stage, millis)
+
+
+def current_exchange():
+    return getattr(_context, 'exchange', None)
+
+
+@contextmanager
+def exchange_context(exchange):
+    previous = current_exchange()
+    _context.exchange = exchange
+    try:
+        yield
+    finally:
+        _context.exchange = previous
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would flood the bot logs otherwise
+        logger.debug(format, *args)
+
+
+def start_metrics_server(port, host='0.0.0.0'):
+    """
+    Serves GET /metrics from a daemon thread
+    """
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http')
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving latency metrics on http://{}:{}/metrics".format(host, port))
+    return server
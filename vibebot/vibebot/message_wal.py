@@ -0,0 +1,111 @@
+import fcntl
+import os
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWal(object):
+    """Local write ahead log of the messages received by a consumer.
+
+    Messages are appended before being acked to rabbit and marked as processed once the callback returned, so
+    anything left unprocessed after a crash can be replayed on restart. Processed messages are deleted in batches
+    every compact_every messages.
+
+    The sqlite connection is opened lazily since consumers are created in the parent process and run in a child
+    process (or thread), and sqlite connections can't be shared across either. The log is locked (<path>.lock) while
+    open, so that a log left by another consumer is only replayed when no running consumer uses it.
+    """
+
+    def __init__(self, path, compact_every=100):
+        self.path = path
+        self.compact_every = compact_every
+        self._conn = None
+        self._lock_file = None
+        self._processed_since_compact = 0
+
+    def lock(self, blocking=True):
+        """
+        :return: False if blocking is False and the log is locked by another instance, True once locked
+        """
+        if self._lock_file is not None:
+            return True
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        lock_file = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def open(self):
+        if self._conn is not None:
+            return
+        # Creates the directory of the log as well
+        self.lock()
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # In WAL journal mode NORMAL only syncs at checkpoints: a commit survives the consumer process dying, which is
+        # what the log guards against, but not a power loss. FULL would fsync every append on the IO loop thread
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS messages ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT, body BLOB NOT NULL, processed INTEGER DEFAULT 0, '
+                           'content_type TEXT, content_encoding TEXT)')
+        # Logs written before the messages had codecs only hold JSON bodies
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(messages)')]
+        for column in ('content_type', 'content_encoding'):
+            if column not in columns:
+                self._conn.execute('ALTER TABLE messages ADD COLUMN {} TEXT'.format(column))
+        self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def append(self, messages):
+        """
+        :param messages: list of (body, content_type, content_encoding), written in a single transaction
+        :return: list of the ids of the messages in the log
+        """
+        self.open()
+        ids = []
+        with self._conn:
+            for body, content_type, content_encoding in messages:
+                cursor = self._conn.execute(
+                    'INSERT INTO messages (body, content_type, content_encoding) VALUES (?, ?, ?)',
+                    (sqlite3.Binary(body), content_type, content_encoding))
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def mark_processed(self, ids):
+        self.open()
+        with self._conn:
+            self._conn.executemany('UPDATE messages SET processed = 1 WHERE id = ?', [(i,) for i in ids])
+
+        self._processed_since_compact += len(ids)
+        if self._processed_since_compact >= self.compact_every:
+            self.compact()
+
+    def pending(self):
+        """
+        :return: list of (id, body, content_type, content_encoding) of the messages not processed yet, oldest first
+        """
+        self.open()
+        rows = self._conn.execute('SELECT id, body, content_type, content_encoding FROM messages '
+                                  'WHERE processed = 0 ORDER BY id').fetchall()
+        return [(i, str(body), content_type, content_encoding) for i, body, content_type, content_encoding in rows]
+
+    def compact(self):
+        self.open()
+        with self._conn:
+            self._conn.execute('DELETE FROM messages WHERE processed = 1')
+        self._processed_since_compact = 0
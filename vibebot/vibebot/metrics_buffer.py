@@ -0,0 +1,138 @@
+import os
+import time
+import atexit
+import random
+import logging
+import threading
+from contextlib import contextmanager
+
+from statsd import StatsClient
+
+logger = logging.getLogger(__name__)
+
+
+class BufferedStatsClient(object):
+    """Drop-in replacement of statsd.StatsClient (incr, decr, gauge, timing) aggregating the metrics in process.
+
+    Counters are summed and gauges keep their last value, timings keep up to max_timings samples per metric (reservoir
+    sampling beyond that, sent with its sample rate) so that the statsd server still computes the percentiles. Everything is sent through a
+    statsd pipeline, i.e. packed in as few UDP packets as possible, every flush_interval seconds or as soon as
+    max_events metrics were recorded since the last flush.
+
+    Safe to share between threads. A client created before forking starts over with an empty buffer in the child.
+    """
+
+    def __init__(self, host, port, prefix=None, maxudpsize=512, flush_interval=1.0, max_events=10000,
+                 max_timings=1000):
+        self.client = StatsClient(host=host, port=port, prefix=prefix, maxudpsize=maxudpsize)
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self.max_timings = max_timings
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._reset()
+
+        atexit.register(self.flush)
+
+    def incr(self, stat, count=1, rate=1):
+        with self._record():
+            self._counters[stat] = self._counters.get(stat, 0) + count
+
+    def decr(self, stat, count=1, rate=1):
+        self.incr(stat, -count, rate)
+
+    def gauge(self, stat, value, rate=1, delta=False):
+        with self._record():
+            if delta:
+                self._gauge_deltas[stat] = self._gauge_deltas.get(stat, 0) + value
+            else:
+                self._gauges[stat] = value
+
+    def timing(self, stat, delta, rate=1):
+        with self._record():
+            samples, seen = self._timings.get(stat, ([], 0))
+            seen += 1
+            if len(samples) < self.max_timings:
+                samples.append(delta)
+            else:
+                # Reservoir sampling, keeps an unbiased sample of the distribution with bounded memory
+                i = random.randint(0, seen - 1)
+                if i < self.max_timings:
+                    samples[i] = delta
+            self._timings[stat] = (samples, seen)
+
+    def flush(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            counters, gauges, timings = self._counters, self._gauges, self._timings
+            gauge_deltas = self._gauge_deltas
+            self._counters, self._gauges, self._timings, self._gauge_deltas = {}, {}, {}, {}
+            self._events = 0
+
+        if not (counters or gauges or timings or gauge_deltas):
+            return
+        try:
+            pipe = self.client.pipeline()
+            for stat, count in counters.iteritems():
+                if count:
+                    pipe.incr(stat, count)
+            for stat, value in gauges.iteritems():
+                pipe.gauge(stat, value)
+            for stat, value in gauge_deltas.iteritems():
+                pipe.gauge(stat, value, delta=True)
+            for stat, (samples, seen) in timings.iteritems():
+                rate = len(samples) / float(seen)
+                for delta in samples:
+                    self._timing(pipe, stat, delta, rate)
+            pipe.send()
+        except Exception as e:
+            # Metrics must never take the bot down
+            logger.warning("Unable to flush metrics: {}".format(e))
+
+    @staticmethod
+    def _timing(pipe, stat, delta, rate):
+        # The samples kept by the reservoir are sent with its sample rate so that the statsd server scales the timer
+        # count back up. pipe.timing(stat, delta, rate) would drop samples at random again, the rate is appended to
+        # the value instead, as StatsClient does for the samples it keeps. _send_stat(stat, value, rate) is the same
+        # from statsd 3.2.1 to 4.x, see the pin in setup.py
+        if rate < 1:
+            pipe._send_stat(stat, '%0.6f|ms|@%s' % (delta, rate), 1)
+        else:
+            pipe.timing(stat, delta)
+
+    def _reset(self):
+        self._counters = {}
+        self._gauges = {}
+        self._gauge_deltas = {}
+        self._timings = {}
+        self._events = 0
+
+    @contextmanager
+    def _record(self):
+        # Holds the lock while a metric is recorded, flushes afterwards if the buffer is full
+        with self._lock:
+            self._check_process()
+            yield
+            self._events += 1
+            full = self._events >= self.max_events
+        if full:
+            self.flush()
+
+    def _check_process(self):
+        # Called with the lock held. The flush thread doesn't survive a fork, start one in each process
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._reset()
+            if self.flush_interval > 0:
+                thread = threading.Thread(target=self._run_flusher, name='statsd-flusher')
+                thread.daemon = True
+                thread.start()
+
+    def _run_flusher(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_interval)
+            self.flush()
+
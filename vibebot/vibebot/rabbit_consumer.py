@@ -1,16 +1,26 @@
 # -*- coding: utf-8 -*-
 
-import json
 import logging
+import os
+import re
 import threading
 import multiprocessing
 import sys
 import time
+from collections import deque, namedtuple
+from multiprocessing.pool import ThreadPool
 
 import pika
 
+import codec
+from message_wal import MessageWal
+from flow_control import FlowController
+
 logger = logging.getLogger(__name__)
 
+# A received message with the AMQP properties needed to decode it, see codec
+Message = namedtuple('Message', ['body', 'content_type', 'content_encoding'])
+
 class RabbitConsumer(object):
     """This is an example consumer that will handle unexpected interactions
     with RabbitMQ such as channel and connection closures.
@@ -26,13 +36,32 @@ class RabbitConsumer(object):
     """
 
     DEFAULT_PREFETCH_COUNT = 1
+    # Seconds between two checks for completed jobs when the connection has no add_callback_threadsafe (pika < 0.12)
+    COMPLETION_POLL_INTERVAL = 0.01
+    # Seconds between two checks of request_stop() from the IO loop
+    STOP_CHECK_INTERVAL = 1
 
     def __init__(self, bot_id, exchange, callback_func, rabbit_user, rabbit_pw, rabbit_host,
-                 rabbit_port, consumer_id = 0, internal_error_queue = None, statsd = None):
+                 rabbit_port, consumer_id = 0, internal_error_queue = None, statsd = None, routing_key = '',
+                 queue_name = None, prefetch_count = None, batch_size = 1, batch_timeout_ms = 100, wal_dir = None,
+                 worker_count = 0, max_latency_ms = None, max_error_rate = None, max_priority = None):
         """Create a new instance of the consumer class, passing in the AMQP
         URL used to connect to RabbitMQ.
 
         :param str amqp_url: The AMQP url to connect with
+        :param str routing_key: The routing key the queue is bound with
+        :param str queue_name: Overrides the default <exchange>-<bot_id> queue
+        :param int prefetch_count: Defaults to max(DEFAULT_PREFETCH_COUNT, batch_size * worker_count)
+        :param int batch_size: When > 1 callback_func is invoked with a list of json bodies, see on_message
+        :param int batch_timeout_ms: Max time a batch waits for more messages once its first message arrived
+        :param str wal_dir: When set messages are persisted in a local write ahead log before being acked and
+        replayed on restart if their processing didn't complete. Not written in pool mode (worker_count > 0), where
+        messages are only acked once processed
+        :param int worker_count: When > 0 callbacks run on a pool of worker_count threads instead of the IO loop
+        thread, see dispatch
+        :param int max_latency_ms: Average callback latency above which the prefetch is reduced, see FlowController
+        :param float max_error_rate: Fraction of messages sent to the error queue above which the prefetch is reduced
+        :param int max_priority: Declares the queue as a priority queue (x-max-priority)
 
         """
 
@@ -52,11 +81,49 @@ class RabbitConsumer(object):
         self._closing = False
         self._consumer_tag = None
 
-        self.queue_name = self.exchange + "-" + self.bot_id
+        self.routing_key = routing_key
+        self.queue_name = queue_name or self.exchange + "-" + self.bot_id
+        self.max_priority = max_priority
         self.error_queue_name = 'error-' + self.bot_id + "-" + self.exchange
         self.consumer_id = consumer_id
         self.internal_error_queue = internal_error_queue
 
+        self.batch_size = batch_size
+        self.batch_timeout_ms = batch_timeout_ms
+        self.worker_count = worker_count
+        self.prefetch_count = prefetch_count or max(self.DEFAULT_PREFETCH_COUNT, batch_size * max(1, worker_count))
+        # (delivery_tag, Message) of the messages waiting for the batch to be full or to time out
+        self._batch = []
+        self._batch_timeout = None
+
+        # Worker pool mode, created in run() so that the threads belong to the consumer process
+        self._pool = None
+        # Jobs dispatched to the pool in delivery order, only touched from the IO loop thread
+        self._inflight = deque()
+        self._completion_timeout = None
+
+        # Backpressure, only when a threshold is given
+        self.flow_control = None
+        if max_latency_ms is not None or max_error_rate is not None:
+            self.flow_control = FlowController(self.prefetch_count, max_latency_ms, max_error_rate)
+            if self.worker_count == 0 or self.prefetch_count <= 1:
+                logger.warning("[{}] Flow control of {} only pauses the consumer, the prefetch is only adapted in pool "
+                               "mode (worker_count > 0) with a prefetch above 1".format(bot_id, exchange))
+        self._errors_since_record = 0
+
+        # Running on the connection of a RabbitConsumerHost rather than its own, see attach
+        self._attached = False
+
+        # Set from another thread or the parent process to retire the consumer, see request_stop
+        self._stop_requested = multiprocessing.Event()
+
+        self.wal = None
+        self.wal_dir = wal_dir
+        # Pending WAL messages are only replayed at startup, not on every reconnect, see replay_wal
+        self._wal_replayed = False
+        if wal_dir:
+            self.wal = MessageWal(os.path.join(wal_dir, '{}-{}.db'.format(self.queue_name, self.consumer_id)))
+
         self.statsd = statsd
 
         self.statsd_prefix = self.exchange + "."
@@ -94,8 +161,50 @@ class RabbitConsumer(object):
         """
         logger.info('Connection opened')
         self.add_on_connection_close_callback()
+        self._connection.add_timeout(self.STOP_CHECK_INTERVAL, self.check_stop_requested)
+        self.open_channel()
+
+    def request_stop(self):
+        """Asks the consumer to cancel its consumer and close its connection, then run() returns. Unlike stop() it can
+        be called from any thread or process, the shutdown itself happens on the IO loop.
+
+        """
+        self._stop_requested.set()
+
+    def check_stop_requested(self):
+        if not self._stop_requested.is_set():
+            self._connection.add_timeout(self.STOP_CHECK_INTERVAL, self.check_stop_requested)
+            return
+
+        logger.info("Stop requested for consumer id %s", str(self.consumer_id))
+        self._closing = True
+        if self._channel is not None and self._consumer_tag is not None:
+            # Messages still waiting for their batch were not acked, rabbit requeues them when the channel closes
+            self.stop_consuming()
+        elif self._channel is not None and self._channel.is_open:
+            # Paused by the flow control, there is no consumer to cancel. resume_consuming won't run once closing
+            self.close_channel()
+        elif not self._attached:
+            self._connection.close()
+
+    def attach(self, connection):
+        """Runs the consumer on its own channel of a connection opened by a RabbitConsumerHost, called again with
+        the new connection when the host reconnects. The QoS being per channel each consumer keeps its own prefetch.
+
+        :param pika.SelectConnection connection: The open connection of the host
+
+        """
+        self._attached = True
+        self._connection = connection
+        self._consumer_tag = None
+        self.start_pool()
+        self._connection.add_timeout(self.STOP_CHECK_INTERVAL, self.check_stop_requested)
         self.open_channel()
 
+    def start_pool(self):
+        if self.worker_count > 0 and self._pool is None:
+            self._pool = ThreadPool(self.worker_count)
+
     def add_on_connection_close_callback(self):
         """This method adds an on close callback that will be invoked by pika
         when RabbitMQ closes the connection to the publisher unexpectedly.
@@ -115,6 +224,7 @@ class RabbitConsumer(object):
 
         """
         self._channel = None
+        self.discard_batch()
         if self._closing:
             self._connection.ioloop.stop()
         else:
@@ -157,8 +267,11 @@ class RabbitConsumer(object):
         """
         logger.info('Channel opened')
         self._channel = channel
+        if self.flow_control is not None:
+            # A new channel starts consuming, don't stay paused
+            self.flow_control.resume()
         self._channel.basic_qos(prefetch_count=
-                                self.DEFAULT_PREFETCH_COUNT)
+                                self.current_prefetch())
         self.add_on_channel_close_callback()
         self.setup_queues_and_bindings()
 
@@ -184,7 +297,31 @@ class RabbitConsumer(object):
         """
         logger.warning('Channel %i was closed: (%s) %s',
                        channel, reply_code, reply_text)
-        self._connection.close()
+        self._channel = None
+        self._consumer_tag = None
+        self.discard_batch()
+        if not self._attached:
+            self._connection.close()
+        elif not self._closing and self._connection.is_open:
+            # The connection is shared with other consumers, only re-open our channel
+            self._connection.add_timeout(5, self.reopen_channel)
+
+    def discard_batch(self):
+        """Drops the messages waiting for their batch when the channel is gone. They were not acked, rabbit redelivers
+        them, and their delivery tags are meaningless on the next channel: a multiple ack of a stale tag would close it
+        with PRECONDITION_FAILED.
+
+        """
+        if self._batch_timeout is not None:
+            self._connection.remove_timeout(self._batch_timeout)
+            self._batch_timeout = None
+        if self._batch:
+            logger.info("[{}] Dropping {} batched messages of the closed channel".format(self.bot_id, len(self._batch)))
+            self._batch = []
+
+    def reopen_channel(self):
+        if not self._closing and self._channel is None and self._connection.is_open:
+            self.open_channel()
 
     def setup_queues_and_bindings(self):
         """Check that the expected exchange is present on the server, only proceed if so
@@ -202,7 +339,12 @@ class RabbitConsumer(object):
         logger.info('Declaring queue %s', self.queue_name)
         # self._channel.queue_declare(self.on_queue_declareok, queue_name)
 
-        self._channel.queue_declare(self.on_queue_declareok, exclusive=False, durable=True, queue=self.queue_name)
+        arguments = None
+        if self.max_priority:
+            # Rabbit refuses the declaration if the queue already exists without (or with another) max priority
+            arguments = {'x-max-priority': self.max_priority}
+        self._channel.queue_declare(self.on_queue_declareok, exclusive=False, durable=True, queue=self.queue_name,
+                                    arguments=arguments)
 
 
     def on_queue_declareok(self, method_frame):
@@ -220,13 +362,13 @@ class RabbitConsumer(object):
         # self._channel.queue_bind(self.on_bindok, self.QUEUE,
         #                          self.EXCHANGE, self.ROUTING_KEY)
         logger.info(
-            "[{}] Binding to {} with queue {} and routing key \"\"".format(self.bot_id, self.exchange,
-                                                                            self.queue_name))
+            "[{}] Binding to {} with queue {} and routing key \"{}\"".format(self.bot_id, self.exchange,
+                                                                              self.queue_name, self.routing_key))
 
         self._channel.queue_bind(self.on_bindok,
                                  queue=self.queue_name,
                                  exchange=self.exchange,
-                                 routing_key="")
+                                 routing_key=self.routing_key)
 
     def on_bindok(self, unused_frame):
         """Invoked by pika when the Queue.Bind method has completed. At this
@@ -273,6 +415,7 @@ class RabbitConsumer(object):
 
         """
         logger.info('Issuing consumer related RPC commands')
+        self.replay_wal()
         self.add_on_cancel_callback()
         logger.info("[{}]  Waiting for messages on exchange {}".format(self.bot_id, self.exchange))
         self._consumer_tag = self._channel.basic_consume(self.on_message,
@@ -312,58 +455,283 @@ class RabbitConsumer(object):
         :param pika.Spec.BasicProperties: properties
         :param str|unicode body: The message body
 
-        """
+        When batch_size > 1 the message is only queued, the batch is processed by process_batch once it holds
+        batch_size messages or batch_timeout_ms after its first message.
 
-        start = time.time()
-        self.invocations += 1
+        """
 
+        message = Message(body, properties.content_type, properties.content_encoding)
         logger.info(
             u"[{}] received message #{} from exchange {}: {}".format(self.bot_id,
                                                                       basic_deliver.delivery_tag, self.exchange,
-                                                                      body.decode('utf-8')))
+                                                                      self.describe(message)))
 
         self.statsd.incr(self.statsd_prefix + "message.receive")
 
-        # Ack the message before processing to tell rabbit we got it.
-        # TODO before sending ack we should persist the message in a local queue to avoid the possibility of losing it
+        if self.batch_size > 1:
+            self._batch.append((basic_deliver.delivery_tag, message))
+            if len(self._batch) >= self.batch_size:
+                self.process_batch()
+            elif self._batch_timeout is None:
+                self._batch_timeout = self._connection.add_timeout(self.batch_timeout_ms / 1000.0, self.process_batch)
+            return
+
+        if self._pool is not None:
+            self.dispatch([basic_deliver.delivery_tag], [message], False)
+            return
+
+        start = time.time()
+        self.invocations += 1
+
+        # Ack the message before processing to tell rabbit we got it, once persisted in the WAL (if any)
+        wal_ids = self.persist_messages([message])
         self.acknowledge_message(basic_deliver.delivery_tag)
 
+        self.process_message(message)
+        self.mark_processed(wal_ids)
+
+        self.log_execution_time(start)
+
+    def process_message(self, message):
         try:
+            json_body = self.parse_body(message)
+            self.publish_responses(self.callback_func(json_body))
 
-            try:
-                json_body = json.loads(body)
+        except Exception as e:
+            self.send_to_error_queue([message], e)
+
+    def process_batch(self):
+        """Acks the queued messages at once (multiple=True) and invokes the callback with the list of their
+        decoded bodies. Messages which can't be decoded are sent to the error queue and left out of the list.
 
+        """
+        if self._batch_timeout is not None:
+            self._connection.remove_timeout(self._batch_timeout)
+            self._batch_timeout = None
+        if not self._batch:
+            return
+
+        batch, self._batch = self._batch, []
+        self.statsd.incr(self.statsd_prefix + "batch.receive")
+        self.statsd.gauge(self.statsd_prefix + "batch.size", len(batch))
+
+        if self._pool is not None:
+            self.dispatch([tag for tag, _ in batch], [message for _, message in batch], True)
+            return
+
+        start = time.time()
+        self.invocations += 1
+
+        # Same as on_message, acked before processing
+        wal_ids = self.persist_messages([message for _, message in batch])
+        self.acknowledge_message(batch[-1][0], multiple=True)
+
+        responses, errors = self.run_callback([message for _, message in batch], True)
+        for messages, e in errors:
+            self.send_to_error_queue(messages, e)
+        self.publish_responses(responses)
+
+        self.mark_processed(wal_ids)
+        self.log_execution_time(start)
+
+    def run_callback(self, messages, batch):
+        """Invokes the callback without touching the channel, so that it can run on a worker thread.
+
+        :param bool batch: callback_func takes the list of decoded bodies rather than a single one
+        :return: the response messages and a list of (messages, exception) to send to the error queue
+        """
+        json_bodies, valid_messages, errors = [], [], []
+        for message in messages:
+            try:
+                json_bodies.append(self.parse_body(message))
+                valid_messages.append(message)
             except ValueError as ve:
-                logger.exception(
-                    "[{}] Invalid JSON received from exchange: {} error: {} msg body: []".format(self.bot_id,
-                                                                                                  self.exchange,
-                                                                                                  ve.message, body))
-                raise
+                errors.append(([message], ve))
 
-            else:
-                response_messages = self.callback_func(json_body)
+        responses = None
+        if json_bodies:
+            try:
+                responses = self.callback_func(json_bodies if batch else json_bodies[0])
+            except Exception as e:
+                errors.append((valid_messages, e))
+        return responses, errors
 
-                if response_messages is None:
-                    response_messages = []
+    def dispatch(self, delivery_tags, messages, batch):
+        """Hands the callback to the worker pool. Unlike the IO loop mode the messages are only acked once processed,
+        so that the prefetch count caps the work in flight. The channel is only used from the IO loop thread:
+        complete_jobs publishes the responses and acks the jobs in delivery order once they are done.
 
-                logger.info("[{}] Sending {} response messages".format(self.bot_id, len(response_messages)))
+        The messages are not written to the WAL: until acked rabbit redelivers them if the consumer dies, replaying
+        them from the WAL as well would process them twice.
 
-                for message in response_messages:
-                    self._channel.basic_publish(exchange=message.get('exchange', self.exchange),
-                                                routing_key=message.get('queue', self.queue_name),
-                                                body=message.get('body'))
-                    logger.info("[{}] published message {}".format(self.bot_id, message))
-                    self.statsd.incr(self.statsd_prefix + "message.publish")
+        """
+        job = {'tags': delivery_tags, 'messages': messages, 'batch': batch, 'channel': self._channel,
+               'start': time.time(), 'done': False}
+        self._inflight.append(job)
+        self._pool.apply_async(self.run_job, (job,))
+        self.statsd.gauge(self.statsd_prefix + "jobs.inflight", len(self._inflight))
+
+        if self._completion_timeout is None and not hasattr(self._connection, 'add_callback_threadsafe'):
+            self._completion_timeout = self._connection.add_timeout(self.COMPLETION_POLL_INTERVAL, self.poll_jobs)
+
+    def run_job(self, job):
+        # Runs on a worker thread
+        job['responses'], job['errors'] = self.run_callback(job['messages'], job['batch'])
+        job['done'] = True
+        if hasattr(self._connection, 'add_callback_threadsafe'):
+            self._connection.add_callback_threadsafe(self.complete_jobs)
+
+    def poll_jobs(self):
+        self._completion_timeout = None
+        self.complete_jobs()
+        if self._inflight:
+            self._completion_timeout = self._connection.add_timeout(self.COMPLETION_POLL_INTERVAL, self.poll_jobs)
+
+    def complete_jobs(self):
+        """Publishes the results of the finished jobs and acks them with a single multiple ack. A job finished ahead
+        of an earlier one waits for it, acks are always sent in delivery order.
 
-        except Exception as e:
-            msg = "[{}] Unexpected error - {}, message {}, from exchange {}. sending to error queue {}"
+        """
+        last_tag = None
+        while self._inflight and self._inflight[0]['done']:
+            job = self._inflight.popleft()
+            self.invocations += 1
+            if job['channel'] is not self._channel:
+                # The channel was re-opened meanwhile, rabbit will redeliver these messages
+                continue
+
+            for messages, e in job['errors']:
+                self.send_to_error_queue(messages, e)
+            self.publish_responses(job['responses'])
+            last_tag = job['tags'][-1]
+            self.log_execution_time(job['start'])
+
+        if last_tag is not None:
+            self.acknowledge_message(last_tag, multiple=True)
+
+    def persist_messages(self, messages):
+        """Appends the messages to the WAL, must happen before they are acked.
+
+        :return: the WAL ids to pass to mark_processed, empty if there is no WAL
+        """
+        if self.wal is None:
+            return []
+        return self.wal.append(messages)
+
+    def mark_processed(self, wal_ids):
+        if self.wal is not None and wal_ids:
+            self.wal.mark_processed(wal_ids)
+
+    def replay_wal(self):
+        """Processes the messages which were acked but whose processing didn't complete, i.e. the consumer died
+        while handling them in IO loop mode. Also done in pool mode, for the logs left by a previous run. Called
+        once, before the first consume, so they are handled first (at least once).
+
+        Consumer ids restart from 0 with the bot and autoscaled consumers get new ones, so the logs of the other
+        consumers of the queue (<queue>-<consumer id>.db) are replayed as well unless a running consumer holds them.
+
+        """
+        if self.wal is None or self._wal_replayed:
+            return
+        self._wal_replayed = True
+        self.replay_messages(self.wal)
+
+        for path in self.queue_wal_paths():
+            if path == self.wal.path:
+                continue
+            wal = MessageWal(path)
+            if not wal.lock(blocking=False):
+                continue
+            try:
+                self.replay_messages(wal)
+            finally:
+                wal.close()
+
+    def queue_wal_paths(self):
+        """
+        :return: the paths of the logs of all the consumers of the queue in wal_dir
+        """
+        if not os.path.isdir(self.wal_dir):
+            return []
+        pattern = re.compile(re.escape(self.queue_name) + r'-\d+\.db$')
+        return [os.path.join(self.wal_dir, name) for name in sorted(os.listdir(self.wal_dir)) if pattern.match(name)]
+
+    def replay_messages(self, wal):
+        """Passes the pending messages of the log to the callback in batches of batch_size, as on_message would.
+
+        """
+        pending = wal.pending()
+        if not pending:
+            return
+
+        logger.warning("[{}] Replaying {} messages from the WAL {}".format(self.bot_id, len(pending), wal.path))
+        if self.statsd is not None:
+            self.statsd.incr(self.statsd_prefix + "message.replay", len(pending))
+        batch_size = max(1, self.batch_size)
+        for i in range(0, len(pending), batch_size):
+            chunk = pending[i:i + batch_size]
+            messages = [Message(body, content_type, content_encoding)
+                        for _, body, content_type, content_encoding in chunk]
+            responses, errors = self.run_callback(messages, self.batch_size > 1)
+            for error_messages, e in errors:
+                self.send_to_error_queue(error_messages, e)
+            self.publish_responses(responses)
+            wal.mark_processed([wal_id for wal_id, _, _, _ in chunk])
+
+    def parse_body(self, message):
+        """Decodes the body according to the content type and encoding it was published with, JSON by default.
+
+        :raises ValueError: also for codec.CodecError
+        """
+        try:
+            return codec.decode(message.body, message.content_type, message.content_encoding)
+
+        except ValueError as ve:
+            logger.exception(
+                "[{}] Invalid {} message received from exchange: {} error: {} msg body: {}".format(
+                    self.bot_id, message.content_type or codec.JSON, self.exchange, ve, self.describe(message)))
+            raise
+
+    @staticmethod
+    def describe(message):
+        # Binary bodies are logged by their size only
+        if message.content_encoding not in (None, '', codec.IDENTITY) or message.content_type in codec.MSGPACK_TYPES:
+            return u"<{} bytes {} {}>".format(len(message.body), message.content_type, message.content_encoding)
+        return message.body.decode('utf-8', 'replace')
+
+    def publish_responses(self, response_messages):
+        if response_messages is None:
+            response_messages = []
+
+        logger.info("[{}] Sending {} response messages".format(self.bot_id, len(response_messages)))
+
+        for message in response_messages:
+            properties = None
+            if message.get('content_type') or message.get('content_encoding') or message.get('priority') is not None:
+                properties = pika.BasicProperties(content_type=message.get('content_type'),
+                                                  content_encoding=message.get('content_encoding'),
+                                                  priority=message.get('priority'))
+            self._channel.basic_publish(exchange=message.get('exchange', self.exchange),
+                                        routing_key=message.get('queue', self.queue_name),
+                                        body=message.get('body'),
+                                        properties=properties)
+            logger.info("[{}] published message {}".format(self.bot_id, message))
+            self.statsd.incr(self.statsd_prefix + "message.publish")
+
+    def send_to_error_queue(self, messages, e):
+        msg = u"[{}] Unexpected error - {}, message {}, from exchange {}. sending to error queue {}"
+        self._errors_since_record += len(messages)
+        for message in messages:
             self.statsd.incr(self.statsd_prefix + "message.error")
-            logger.exception(msg.format(self.bot_id, e, body, self.exchange, self.error_queue_name))
+            logger.exception(msg.format(self.bot_id, e, self.describe(message), self.exchange, self.error_queue_name))
+            # Kept as received so that the message can be replayed
             self._channel.basic_publish(exchange='',
                                         routing_key=self.error_queue_name,
-                                        body=body)
-
+                                        body=message.body,
+                                        properties=pika.BasicProperties(content_type=message.content_type,
+                                                                        content_encoding=message.content_encoding))
 
+    def log_execution_time(self, start):
         exec_time_millis = int((time.time() - start) * 1000)
         self.total_execution_time += exec_time_millis
 
@@ -376,16 +744,61 @@ class RabbitConsumer(object):
             self.total_execution_time = 0
 
         self.statsd.timing(self.statsd_prefix + 'message.process.time', int((time.time() - start) * 1000))
+        self.update_flow_control(exec_time_millis)
+
+    def current_prefetch(self):
+        if self.flow_control is not None:
+            return self.flow_control.prefetch
+        return self.prefetch_count
+
+    def update_flow_control(self, exec_time_millis):
+        """Applies the decision of the flow controller: a new prefetch count, or pausing the consumption for
+        pause_seconds when even a prefetch of 1 is too much for the callback.
 
-    def acknowledge_message(self, delivery_tag):
+        """
+        if self.flow_control is None:
+            return
+        errors, self._errors_since_record = self._errors_since_record, 0
+        action = self.flow_control.record(exec_time_millis, errors)
+
+        if action == FlowController.QOS:
+            logger.info("[{}] Setting prefetch of consumer {} to {}".format(self.bot_id, self.consumer_id,
+                                                                          self.flow_control.prefetch))
+            self._channel.basic_qos(prefetch_count=self.flow_control.prefetch)
+            self.statsd.incr(self.statsd_prefix + 'flow.qos')
+        elif action == FlowController.PAUSE and self._consumer_tag is not None:
+            logger.warning("[{}] Consumer {} overloaded, pausing for {}s".format(self.bot_id, self.consumer_id,
+                                                                               self.flow_control.pause_seconds))
+            self._channel.basic_cancel(self.on_pause_cancelok, self._consumer_tag)
+            self._consumer_tag = None
+            self._connection.add_timeout(self.flow_control.pause_seconds, self.resume_consuming)
+            self.statsd.incr(self.statsd_prefix + 'flow.pause')
+
+        self.statsd.gauge(self.statsd_prefix + 'flow.prefetch', self.flow_control.prefetch)
+        self.statsd.gauge(self.statsd_prefix + 'flow.paused', int(self.flow_control.paused))
+
+    def on_pause_cancelok(self, unused_frame):
+        # Unlike on_cancelok the channel stays open
+        logger.info("[{}] Consumer {} paused".format(self.bot_id, self.consumer_id))
+
+    def resume_consuming(self):
+        if self._closing or self._channel is None or not self._channel.is_open or self._consumer_tag is not None:
+            return
+        logger.info("[{}] Resuming consumer {}".format(self.bot_id, self.consumer_id))
+        self.flow_control.resume()
+        self._consumer_tag = self._channel.basic_consume(self.on_message, self.queue_name)
+        self.statsd.gauge(self.statsd_prefix + 'flow.paused', 0)
+
+    def acknowledge_message(self, delivery_tag, multiple=False):
         """Acknowledge the message delivery from RabbitMQ by sending a
         Basic.Ack RPC method for the delivery tag.
 
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param bool multiple: Also acknowledge every unacked message delivered before delivery_tag
 
         """
         logger.info('Acknowledging message %s process %s consumer_id %s', delivery_tag, threading.current_thread, str(self.consumer_id))
-        self._channel.basic_ack(delivery_tag)
+        self._channel.basic_ack(delivery_tag, multiple=multiple)
 
 
     def stop_consuming(self):
@@ -423,6 +836,7 @@ class RabbitConsumer(object):
 
         """
         try:
+            self.start_pool()
 
             self._connection = self.connect()
             self._connection.ioloop.start()
@@ -432,6 +846,10 @@ class RabbitConsumer(object):
             logger.warn("Exception: %s", str(e))
             logger.warn("Exception caught on rabbit consumer for process: %s with consumer id %s", threading.current_thread, str(self.consumer_id))
             self.internal_error_queue.put(self.consumer_id)
+        finally:
+            # Buffered metrics of a consumer process would be lost otherwise
+            if hasattr(self.statsd, 'flush'):
+                self.statsd.flush()
 
     def stop(self):
         """Cleanly shutdown the connection to RabbitMQ by stopping the consumer
@@ -473,4 +891,125 @@ class RabbitConsumerThread(RabbitConsumer, threading.Thread):
 
     def total_stop(self):
         super(RabbitConsumerThread, self).stop()
-        # super(RabbitConsumerThread, self).join()
\ No newline at end of file
+        # super(RabbitConsumerThread, self).join()
+
+
+class RabbitConsumerHost(object):
+    """Runs several RabbitConsumer over a single connection, each on its own channel with its own QoS, rather than a
+    connection (and in proc mode an OS process) per consumer.
+
+    Consumers are plain RabbitConsumer instances, the host is the thread or process (see RabbitConsumerHostProc and
+    RabbitConsumerHostThread). On an unexpected error the whole host is restarted through the internal error queue.
+
+    """
+
+    def __init__(self, bot_id, consumers, rabbit_user, rabbit_pw, rabbit_host, rabbit_port, host_id=0,
+                 internal_error_queue=None):
+        super(RabbitConsumerHost, self).__init__()
+
+        self.bot_id = bot_id
+        self.consumers = consumers
+        self.rabbit_user = rabbit_user
+        self.rabbit_pw = rabbit_pw
+        self.rabbit_host = rabbit_host
+        self.rabbit_port = rabbit_port
+        self.host_id = host_id
+        self.consumer_id = host_id
+        self.internal_error_queue = internal_error_queue
+
+        self._connection = None
+        self._closing = False
+        self.stopped = False
+
+    def connect(self):
+        logger.info("[{}] Connecting consumer host {} ({} consumers)".format(self.bot_id, self.host_id,
+                                                                           len(self.consumers)))
+        creds = pika.PlainCredentials(self.rabbit_user, self.rabbit_pw)
+        return pika.SelectConnection(pika.ConnectionParameters(host=self.rabbit_host,
+                                                               port=self.rabbit_port,
+                                                               virtual_host='/',
+                                                               credentials=creds,
+                                                               socket_timeout=1,
+                                                               retry_delay=5  # 5 seconds
+                                                               ),
+                                     self.on_connection_open,
+                                     stop_ioloop_on_close=False)
+
+    def on_connection_open(self, unused_connection):
+        logger.info('Consumer host connection opened')
+        self._connection.add_on_close_callback(self.on_connection_closed)
+        for consumer in self.consumers:
+            consumer.attach(self._connection)
+        self._connection.add_timeout(RabbitConsumer.STOP_CHECK_INTERVAL, self.check_consumers_stopped)
+
+    def check_consumers_stopped(self):
+        # Once every consumer was asked to stop and closed its channel, the connection is closed and run() returns
+        if self._closing or not self._connection.is_open:
+            return
+        if self.consumers and all(c._closing and c._channel is None for c in self.consumers):
+            logger.info("All the consumers of host %s stopped", str(self.host_id))
+            self._closing = True
+            self._connection.close()
+            return
+        self._connection.add_timeout(RabbitConsumer.STOP_CHECK_INTERVAL, self.check_consumers_stopped)
+
+    def on_connection_closed(self, connection, reply_code, reply_text):
+        for consumer in self.consumers:
+            consumer._channel = None
+            consumer.discard_batch()
+        if self._closing:
+            self._connection.ioloop.stop()
+        else:
+            logger.warning('Consumer host connection closed, reopening in 5 seconds: (%s) %s',
+                           reply_code, reply_text)
+            self._connection.add_timeout(5, self.reconnect)
+
+    def reconnect(self):
+        self._connection.ioloop.stop()
+
+        if not self._closing:
+            self._connection = self.connect()
+            self._connection.ioloop.start()
+
+    def request_stop(self):
+        for consumer in self.consumers:
+            consumer.request_stop()
+
+    def run(self):
+        try:
+            self._connection = self.connect()
+            self._connection.ioloop.start()
+        except (KeyboardInterrupt, SystemExit):
+            self.stop()
+        except Exception as e:
+            logger.warn("Exception: %s", str(e))
+            logger.warn("Exception caught on rabbit consumer host %s", str(self.host_id))
+            self.internal_error_queue.put(self.host_id)
+        finally:
+            # The consumers share the bot's statsd client
+            statsd = self.consumers[0].statsd if self.consumers else None
+            if hasattr(statsd, 'flush'):
+                statsd.flush()
+
+    def stop(self):
+        """Closes the connection, and with it the channels of all the consumers. Unacked messages are requeued.
+
+        """
+        logger.info("Stopping rabbit consumer host %s", str(self.host_id))
+        self._closing = True
+        for consumer in self.consumers:
+            consumer._closing = True
+        if self._connection is not None:
+            self._connection.close()
+            self._connection.ioloop.start()
+        self.stopped = True
+
+
+class RabbitConsumerHostProc(RabbitConsumerHost, multiprocessing.Process):
+    def total_stop(self):
+        super(RabbitConsumerHostProc, self).join(10)
+
+
+class RabbitConsumerHostThread(RabbitConsumerHost, threading.Thread):
+    def total_stop(self):
+        super(RabbitConsumerHostThread, self).stop()